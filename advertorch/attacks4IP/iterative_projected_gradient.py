@@ -24,6 +24,8 @@ from advertorch.utils import batch_clamp
 from advertorch.utils import replicate_input
 from advertorch.utils import batch_l1_proj
 
+from advertorch.context import ctx_input_grad_only
+
 from .base import Attack
 from .base import LabelMixin
 from .utils import rand_init_delta
@@ -32,7 +34,7 @@ from .utils import rand_init_delta
 def perturb_iterative(xvar, yvar, predict, nb_iter, eps, eps_iter, loss_fn,
                       delta_init=None, minimize=False, ord=np.inf,
                       clip_min=0.0, clip_max=1.0,
-                      l1_sparsity=None):
+                      l1_sparsity=None, input_grad_only=False):
     """
     Iteratively maximize the loss over the input. It is a shared method for
     iterative attacks including IterativeGradientSign, LinfPGD, etc.
@@ -53,6 +55,9 @@ def perturb_iterative(xvar, yvar, predict, nb_iter, eps, eps_iter, loss_fn,
                   - if None, then perform regular L1 projection.
                   - if float value, then perform sparse L1 descent from
                     Algorithm 1 in https://arxiv.org/pdf/1904.13000v1.pdf
+    :param input_grad_only: (optional bool) compute the gradient with respect
+                  to the perturbation only, with torch.autograd.grad instead
+                  of loss.backward(); run under ctx_input_grad_only.
     :return: tensor containing the perturbed input.
     """
     if delta_init is not None:
@@ -68,7 +73,10 @@ def perturb_iterative(xvar, yvar, predict, nb_iter, eps, eps_iter, loss_fn,
         if minimize:
             loss = -loss
 
-        loss.backward()
+        if input_grad_only:
+            delta.grad, = torch.autograd.grad(loss, delta)
+        else:
+            loss.backward()
         if ord == np.inf:
             grad_sign = delta.grad.data.sign()
             delta.data = delta.data + batch_multiply(eps_iter, grad_sign)
@@ -104,9 +112,7 @@ def perturb_iterative(xvar, yvar, predict, nb_iter, eps, eps_iter, loss_fn,
             grad = normalize_by_pnorm(grad, p=1)
             delta.data = delta.data + batch_multiply(eps_iter, grad)
 
-            delta.data = batch_l1_proj(delta.data.cpu(), eps)
-            if xvar.is_cuda:
-                delta.data = delta.data.cuda()
+            delta.data = batch_l1_proj(delta.data, eps)
             delta.data = clamp(xvar.data + delta.data, clip_min, clip_max
                                ) - xvar.data
         else:
@@ -181,14 +187,16 @@ class PGDAttack(Attack, LabelMixin):
             delta.data = clamp(
                 x + delta.data, min=self.clip_min, max=self.clip_max) - x
 
-        rval = perturb_iterative(
-            x, y, self.predict, nb_iter=self.nb_iter,
-            eps=self.eps, eps_iter=self.eps_iter,
-            loss_fn=self.loss_fn, minimize=self.targeted,
-            ord=self.ord, clip_min=self.clip_min,
-            clip_max=self.clip_max, delta_init=delta,
-            l1_sparsity=self.l1_sparsity,
-        )
+        # no weight gradients for the attack, the model may be training
+        with ctx_input_grad_only(self.predict) as predict:
+            rval = perturb_iterative(
+                x, y, predict, nb_iter=self.nb_iter,
+                eps=self.eps, eps_iter=self.eps_iter,
+                loss_fn=self.loss_fn, minimize=self.targeted,
+                ord=self.ord, clip_min=self.clip_min,
+                clip_max=self.clip_max, delta_init=delta,
+                l1_sparsity=self.l1_sparsity, input_grad_only=True,
+            )
 
         return rval.data
 
@@ -16,6 +16,7 @@ from advertorch.utils import batch_clamp
 from advertorch.utils import replicate_input
 from advertorch.utils import batch_l1_proj
 
+from advertorch.context import ctx_input_grad_only
 
 from .base import Attack
 from .base import LabelMixin
@@ -23,6 +24,10 @@ from .utils import rand_init_delta
 
 
 def zero_mean_projection(x):
+    """
+    Reference projection of each sample on the zero-mean hyperplane, kept
+    for equivalence checks of :func:`l2_zero_mean_step_`.
+    """
     B,C,H,W = x.shape
     data = x.view(B, 1, -1)
     normal_vectors = torch.ones_like(data).transpose(dim0=1, dim1=2)
@@ -30,10 +35,59 @@ def zero_mean_projection(x):
     batch_inner_product = torch.bmm(data, normal_vectors) / (normal_vectors**2).sum(dim=(1,2), keepdim=True)
     return (data - batch_inner_product * normal_vectors.transpose(dim0=1, dim1=2)).view(B,C,H,W)
 
+
+def _per_sample(value, x):
+    """Float or per-sample tensor, broadcastable against x."""
+    if isinstance(value, torch.Tensor):
+        return value.view(-1, *([1] * (x.dim() - 1)))
+    return value
+
+
+@torch.no_grad()
+def l2_zero_mean_step_(delta, grad, xvar, eps_iter, eps=None,
+                       clip_min=0.0, clip_max=1.0, small_constant=1e-6):
+    """
+    One L2 zero-mean PGD step, in place on delta.
+
+    Same result as the reference sequence ``normalize_by_pnorm``, step,
+    clamp to the input range, :func:`zero_mean_projection` and
+    ``clamp_by_pnorm``. The per-sample norms and means are reductions, and
+    delta is updated in place without full-size temporaries.
+
+    :param delta: perturbation, updated in place.
+    :param grad: gradient of the loss with respect to delta.
+    :param xvar: input data.
+    :param eps_iter: attack step size, float or per-sample tensor.
+    :param eps: maximum L2 distortion, float or per-sample tensor.
+    :param clip_min: mininum value per input dimension.
+    :param clip_max: maximum value per input dimension.
+    :param small_constant: (optional float) to avoid dividing by zero.
+    :return: delta.
+    """
+    dims = tuple(range(1, delta.dim()))
+    norm = grad.norm(p=2, dim=dims, keepdim=True).clamp_(min=small_constant)
+    delta.addcmul_(grad, _per_sample(eps_iter, delta) / norm)
+
+    delta.add_(xvar)
+    if isinstance(clip_min, (float, int)) and isinstance(clip_max, (float, int)):
+        delta.clamp_(clip_min, clip_max)
+    else:
+        delta.copy_(clamp(delta, clip_min, clip_max))
+    delta.sub_(xvar)
+
+    # closed-form projection on the zero-mean hyperplane
+    delta.sub_(delta.mean(dim=dims, keepdim=True))
+
+    if eps is not None:
+        norm = delta.norm(p=2, dim=dims, keepdim=True)
+        # eps / 0 = inf keeps a zero delta as it is
+        delta.mul_(torch.clamp(_per_sample(eps, delta) / norm, max=1.))
+    return delta
+
 def perturb_iterative(xvar, yvar, predict, nb_iter, eps, eps_iter, loss_fn,
                       delta_init=None, minimize=False, ord=np.inf,
                       clip_min=0.0, clip_max=1.0,
-                      l1_sparsity=None):
+                      l1_sparsity=None, fused=True, input_grad_only=False):
     """
     Iteratively maximize the loss over the input. It is a shared method for
     iterative attacks including IterativeGradientSign, LinfPGD, etc.
@@ -54,6 +108,12 @@ def perturb_iterative(xvar, yvar, predict, nb_iter, eps, eps_iter, loss_fn,
                   - if None, then perform regular L1 projection.
                   - if float value, then perform sparse L1 descent from
                     Algorithm 1 in https://arxiv.org/pdf/1904.13000v1.pdf
+    :param fused: (optional bool) take each step with
+                  :func:`l2_zero_mean_step_`, otherwise with the reference
+                  sequence of separate operations.
+    :param input_grad_only: (optional bool) compute the gradient with respect
+                  to the perturbation only, with torch.autograd.grad instead
+                  of loss.backward(); run under ctx_input_grad_only.
     :return: tensor containing the perturbed input.
     """
     if delta_init is not None:
@@ -69,8 +129,14 @@ def perturb_iterative(xvar, yvar, predict, nb_iter, eps, eps_iter, loss_fn,
         if minimize:
             loss = -loss
 
-        loss.backward()
-        if ord == 2:
+        if input_grad_only:
+            delta.grad, = torch.autograd.grad(loss, delta)
+        else:
+            loss.backward()
+        if ord == 2 and fused:
+            l2_zero_mean_step_(delta.data, delta.grad.data, xvar.data,
+                               eps_iter, eps, clip_min, clip_max)
+        elif ord == 2:
             grad = delta.grad.data
             grad = normalize_by_pnorm(grad)
             delta.data = delta.data + batch_multiply(eps_iter, grad)
@@ -112,7 +178,7 @@ class PGDAttack(Attack, LabelMixin):
     def __init__(
             self, predict, loss_fn=None, eps=0.3, nb_iter=40,
             eps_iter=0.01, rand_init=True, clip_min=0., clip_max=1.,
-            ord=np.inf, l1_sparsity=None, targeted=False):
+            ord=np.inf, l1_sparsity=None, targeted=False, fused=True):
         """
         Create an instance of the PGDAttack.
 
@@ -128,6 +194,7 @@ class PGDAttack(Attack, LabelMixin):
         if self.loss_fn is None:
             self.loss_fn = nn.CrossEntropyLoss(reduction="sum")
         self.l1_sparsity = l1_sparsity
+        self.fused = fused
         assert is_float_or_torch_tensor(self.eps_iter)
         assert is_float_or_torch_tensor(self.eps)
 
@@ -153,14 +220,17 @@ class PGDAttack(Attack, LabelMixin):
             delta.data = clamp(
                 x + delta.data, min=self.clip_min, max=self.clip_max) - x
 
-        rval = perturb_iterative(
-            x, y, self.predict, nb_iter=self.nb_iter,
-            eps=self.eps, eps_iter=self.eps_iter,
-            loss_fn=self.loss_fn, minimize=self.targeted,
-            ord=self.ord, clip_min=self.clip_min,
-            clip_max=self.clip_max, delta_init=delta,
-            l1_sparsity=self.l1_sparsity,
-        )
+        # no weight gradients for the attack, the model may be training
+        with ctx_input_grad_only(self.predict) as predict:
+            rval = perturb_iterative(
+                x, y, predict, nb_iter=self.nb_iter,
+                eps=self.eps, eps_iter=self.eps_iter,
+                loss_fn=self.loss_fn, minimize=self.targeted,
+                ord=self.ord, clip_min=self.clip_min,
+                clip_max=self.clip_max, delta_init=delta,
+                l1_sparsity=self.l1_sparsity, fused=self.fused,
+                input_grad_only=True,
+            )
 
         return rval.data
     
@@ -178,15 +248,16 @@ class L2PGDAttack(PGDAttack):
     :param clip_min: mininum value per input dimension.
     :param clip_max: maximum value per input dimension.
     :param targeted: if the attack is targeted.
+    :param fused: (optional bool) use the fused zero-mean step.
     """
 
     def __init__(
             self, predict, loss_fn=None, eps=0.3, nb_iter=40,
             eps_iter=0.01, rand_init=True, clip_min=0., clip_max=1.,
-            targeted=False):
+            targeted=False, fused=True):
         ord = 2
         super(L2PGDAttack, self).__init__(
             predict=predict, loss_fn=loss_fn, eps=eps, nb_iter=nb_iter,
             eps_iter=eps_iter, rand_init=rand_init, clip_min=clip_min,
             clip_max=clip_max, targeted=targeted,
-            ord=ord)
\ No newline at end of file
+            ord=ord, fused=fused)
\ No newline at end of file
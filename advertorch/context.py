@@ -7,6 +7,9 @@
 
 from contextlib import contextmanager
 
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
 
 class ctx_noparamgrad(object):
     def __init__(self, module):
@@ -42,6 +45,25 @@ def ctx_noparamgrad_and_eval(module):
         yield (a, b)
 
 
+@contextmanager
+def ctx_input_grad_only(predict):
+    """
+    Freeze the parameters of predict, so that attack backwards compute the
+    input gradient only. Yields the callable to run the attack with: the
+    wrapped module of a DistributedDataParallel, whose own forward would
+    expect a gradient reduction that never comes, or predict itself.
+
+    :param predict: forward pass function or module.
+    """
+    if isinstance(predict, DistributedDataParallel):
+        predict = predict.module
+    if not isinstance(predict, nn.Module):
+        yield predict
+        return
+    with ctx_noparamgrad(predict):
+        yield predict
+
+
 def get_module_training_state(module):
     return {mod: mod.training for mod in module.modules()}
 
@@ -6,6 +6,7 @@
 #
 
 from advertorch.functional import JPEGEncodingDecoding
+from advertorch.functional import jpeg_dct_approximation
 
 from .base import Processor
 
@@ -15,10 +16,23 @@ class JPEGFilter(Processor):
     JPEG Filter.
 
     :param quality: quality of the output.
+    :param differentiable: use the on-device DCT-quantization approximation
+        instead of libjpeg.
+    :param straight_through: with differentiable, identity gradient for the
+        rounding instead of its cubic approximation.
+    :param num_workers: threads of the libjpeg path, None for the default
+        of ThreadPoolExecutor and 0 to code in the calling thread.
     """
-    def __init__(self, quality=75):
+    def __init__(self, quality=75, differentiable=False,
+                 straight_through=True, num_workers=None):
         super(JPEGFilter, self).__init__()
         self.quality = quality
+        self.differentiable = differentiable
+        self.straight_through = straight_through
+        self.num_workers = num_workers
 
     def forward(self, x):
-        return JPEGEncodingDecoding.apply(x, self.quality)
+        if self.differentiable:
+            return jpeg_dct_approximation(
+                x, self.quality, straight_through=self.straight_through)
+        return JPEGEncodingDecoding.apply(x, self.quality, self.num_workers)
@@ -5,12 +5,17 @@
 # LICENSE file in the root directory of this source tree.
 #
 
+import math
+from concurrent.futures import ThreadPoolExecutor
+
 try:
     from cStringIO import StringIO as BytesIO
 except ImportError:
     from io import BytesIO
 
+import numpy as np
 import torch
+import torch.nn.functional as F
 from torchvision import transforms
 from PIL import Image
 
@@ -33,18 +38,160 @@ class FloatToIntSqueezing(torch.autograd.Function):
 
 
 
+def _jpeg_roundtrip(img, quality):
+    """Encode and decode one (h, w) or (h, w, c) uint8 image with libjpeg."""
+    virtualpath = BytesIO()
+    Image.fromarray(img).save(virtualpath, 'JPEG', quality=quality)
+    virtualpath.seek(0)
+    return np.asarray(Image.open(virtualpath))
+
+
 class JPEGEncodingDecoding(torch.autograd.Function):
+    """
+    JPEG compression of a batch with libjpeg (through PIL).
+
+    The batch is converted to uint8 and copied to the host once, the images
+    are encoded and decoded by a thread pool (PIL releases the GIL while
+    coding) and the result is copied back once.
+    """
     @staticmethod
-    def forward(ctx, x, quality):
-        lst_img = []
-        for img in x:
-            img = _to_pil_image(img.detach().clone().cpu())
-            virtualpath = BytesIO()
-            img.save(virtualpath, 'JPEG', quality=quality)
-            lst_img.append(_to_tensor(Image.open(virtualpath)))
-        return x.new_tensor(torch.stack(lst_img))
+    def forward(ctx, x, quality, num_workers=None):
+        # same uint8 conversion as ToPILImage
+        imgs = x.detach().mul(255).byte().permute(0, 2, 3, 1).cpu().numpy()
+        if imgs.shape[-1] == 1:
+            imgs = imgs[..., 0]
+        if num_workers == 0 or len(imgs) == 1:
+            lst_img = [_jpeg_roundtrip(img, quality) for img in imgs]
+        else:
+            with ThreadPoolExecutor(num_workers) as pool:
+                lst_img = list(pool.map(
+                    lambda img: _jpeg_roundtrip(img, quality), imgs))
+        out = torch.from_numpy(np.stack(lst_img)).to(x.device)
+        out = out.view(*imgs.shape[:3], -1).permute(0, 3, 1, 2)
+        return out.to(x.dtype).div_(255)
 
     @staticmethod
     def backward(ctx, grad_output):
         raise NotImplementedError(
             "backward not implemented", JPEGEncodingDecoding)
+
+
+_JPEG_LUMINANCE_TABLE = [
+    [16, 11, 10, 16, 24, 40, 51, 61],
+    [12, 12, 14, 19, 26, 58, 60, 55],
+    [14, 13, 16, 24, 40, 57, 69, 56],
+    [14, 17, 22, 29, 51, 87, 80, 62],
+    [18, 22, 37, 56, 68, 109, 103, 77],
+    [24, 35, 55, 64, 81, 104, 113, 92],
+    [49, 64, 78, 87, 103, 121, 120, 101],
+    [72, 92, 95, 98, 112, 100, 103, 99]]
+
+_JPEG_CHROMINANCE_TABLE = [
+    [17, 18, 24, 47, 99, 99, 99, 99],
+    [18, 21, 26, 66, 99, 99, 99, 99],
+    [24, 26, 56, 99, 99, 99, 99, 99],
+    [47, 66, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99],
+    [99, 99, 99, 99, 99, 99, 99, 99]]
+
+
+def jpeg_quantization_table(quality, chroma=False, device=None, dtype=None):
+    """
+    Quantization table of libjpeg for a quality in [1, 100].
+
+    :param quality: JPEG quality.
+    :param chroma: chrominance instead of luminance table.
+    :return: tensor of shape (8, 8).
+    """
+    quality = min(max(int(quality), 1), 100)
+    scale = 5000 // quality if quality < 50 else 200 - 2 * quality
+    table = torch.tensor(
+        _JPEG_CHROMINANCE_TABLE if chroma else _JPEG_LUMINANCE_TABLE,
+        dtype=torch.float64)
+    table = torch.clamp(torch.floor((table * scale + 50) / 100), 1, 255)
+    return table.to(device=device, dtype=dtype)
+
+
+def _dct_matrix(device=None, dtype=None):
+    """Orthonormal 8-point DCT-II matrix."""
+    n = torch.arange(8, dtype=torch.float64)
+    mat = torch.cos((2 * n[None] + 1) * n[:, None] * math.pi / 16)
+    mat[0] *= 1 / math.sqrt(2)
+    return (mat * 0.5).to(device=device, dtype=dtype)
+
+
+def _round_approx(x, straight_through):
+    if straight_through:
+        # round in the forward pass, identity in the backward pass
+        return x + (torch.round(x) - x).detach()
+    # differentiable approximation of Shin & Song, 2017
+    return torch.round(x) + (x - torch.round(x)) ** 3
+
+
+def _dct_quantize(x, table, straight_through):
+    """Quantize the 8x8 block DCT of x (b, c, h, w), h and w multiples of 8,
+    with table."""
+    b, c, h, w = x.shape
+    dct = _dct_matrix(x.device, x.dtype)
+    blocks = x.view(b, c, h // 8, 8, w // 8, 8).transpose(3, 4)
+    coef = dct @ blocks @ dct.t()
+    coef = _round_approx(coef / table, straight_through) * table
+    blocks = dct.t() @ coef @ dct
+    return blocks.transpose(3, 4).reshape(b, c, h, w)
+
+
+def jpeg_dct_approximation(x, quality, subsampling=True,
+                           straight_through=True):
+    """
+    Differentiable approximation of JPEG compression, on the device.
+
+    Follows the libjpeg baseline: YCbCr conversion, 2x2 chroma subsampling,
+    8x8 block DCT and quantization with the quality-scaled tables, then
+    decoding. Huffman coding is lossless and skipped; the rounding steps
+    are straight-through or a cubic approximation, so that attacks can
+    backpropagate through the defense.
+
+    :param x: batch of images in [0, 1] with shape (b, c, h, w), c = 1 or 3.
+    :param quality: JPEG quality in [1, 100].
+    :param subsampling: subsample the chroma 2x2 (4:2:0), as PIL does.
+    :param straight_through: identity gradient for the rounding, instead
+        of the cubic approximation.
+    :return: compressed and decoded batch, quantized to 8 bits.
+    """
+    b, c, h, w = x.shape
+    color = c == 3
+    if c not in (1, 3):
+        raise ValueError("JPEG supports 1 or 3 channels, got {}".format(c))
+    # whole MCUs, padded by edge replication as libjpeg does
+    mcu = 16 if color and subsampling else 8
+    pad_h, pad_w = (-h) % mcu, (-w) % mcu
+    x = F.pad(x * 255, (0, pad_w, 0, pad_h), mode='replicate')
+
+    table_y = jpeg_quantization_table(quality, False, x.device, x.dtype)
+    if not color:
+        out = _dct_quantize(x - 128, table_y, straight_through) + 128
+    else:
+        r, g, bl = x.unbind(dim=1)
+        y = 0.299 * r + 0.587 * g + 0.114 * bl
+        cb = -0.168736 * r - 0.331264 * g + 0.5 * bl
+        cr = 0.5 * r - 0.418688 * g - 0.081312 * bl
+        y = _dct_quantize(y[:, None] - 128, table_y, straight_through) + 128
+        chroma = torch.stack([cb, cr], dim=1)
+        if subsampling:
+            chroma = F.avg_pool2d(chroma, 2)
+        table_c = jpeg_quantization_table(quality, True, x.device, x.dtype)
+        chroma = _dct_quantize(chroma, table_c, straight_through)
+        if subsampling:
+            # close to the triangular "fancy upsampling" of libjpeg
+            chroma = F.interpolate(chroma, scale_factor=2, mode='bilinear',
+                                   align_corners=False)
+        cb, cr = chroma.unbind(dim=1)
+        y = y[:, 0]
+        out = torch.stack([y + 1.402 * cr,
+                           y - 0.344136 * cb - 0.714136 * cr,
+                           y + 1.772 * cb], dim=1)
+
+    out = torch.clamp(out[..., :h, :w], 0, 255)
+    return _round_approx(out, straight_through) / 255
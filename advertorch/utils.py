@@ -251,10 +251,68 @@ def batch_l1_proj_flat(x, z=1):
     return proj_x
 
 
+def batch_l1_proj_flat_nosync(x, z=1):
+    """
+    Same projection as :func:`batch_l1_proj_flat`, computed for every row
+    of the batch on its device: rows already in the l1-ball get a zero
+    threshold instead of being selected with ``torch.nonzero``, so there is
+    no host synchronization and no data-dependent indexing.
+
+    :param x: input data, of shape (batch_size, n).
+    :param z: l1 radius, float or tensor of shape (batch_size,).
+
+    :return: tensor containing the projection.
+    """
+    if isinstance(z, torch.Tensor):
+        z = z.view(-1, 1).to(x)
+    mu = x.abs().sort(1, descending=True)[0]
+    cumsum = mu.cumsum(1)
+    vv = torch.arange(1, x.size(1) + 1, device=x.device, dtype=x.dtype)
+    st = (cumsum - z) / vv
+    u = (mu - st) > 0
+    rho = (~u).cumsum(dim=1).eq(0).sum(1, keepdim=True) - 1
+    theta = st.gather(1, rho.clamp(min=0))
+    # zero threshold inside the ball
+    theta = torch.where(cumsum[:, -1:] > z, theta, torch.zeros_like(theta))
+    return _thresh_by_magnitude(theta, x)
+
+
 def batch_l1_proj(x, eps):
+    """
+    Projection of each sample of a batch on the l1-ball of radius eps,
+    on the device of x.
+
+    :param x: input data, of shape (batch_size, ...).
+    :param eps: l1 radius, float or tensor of shape (batch_size,).
+
+    :return: tensor containing the projection.
+    """
+    batch_size = x.size(0)
+    view = x.reshape(batch_size, -1)
+    proj_flat = batch_l1_proj_flat_nosync(view, z=eps)
+    return proj_flat.view_as(x)
+
+
+def batch_l1_proj_sparse(x, eps, k):
+    """
+    Projection of each sample of a batch on the set of k-sparse vectors in
+    the l1-ball of radius eps: all but the k largest entries in magnitude
+    are zeroed, the rest is projected on the l1-ball.
+
+    Ref: Kyrillidis et al., Sparse projections onto the simplex, 2013.
+
+    :param x: input data, of shape (batch_size, ...).
+    :param eps: l1 radius, float or tensor of shape (batch_size,).
+    :param k: number of nonzero entries kept per sample.
+
+    :return: tensor containing the projection.
+    """
     batch_size = x.size(0)
-    view = x.view(batch_size, -1)
-    proj_flat = batch_l1_proj_flat(view, z=eps)
+    view = x.reshape(batch_size, -1)
+    k = max(1, min(int(k), view.size(1)))
+    idx = view.abs().topk(k, dim=1)[1]
+    vals = batch_l1_proj_flat_nosync(view.gather(1, idx), z=eps)
+    proj_flat = torch.zeros_like(view).scatter_(1, idx, vals)
     return proj_flat.view_as(x)
 
 
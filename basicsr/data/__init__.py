@@ -10,9 +10,11 @@ import numpy as np
 import random
 import torch
 import torch.utils.data
+from torch.utils.data.dataloader import default_collate
 from functools import partial
 from os import path as osp
 
+from basicsr.data.data_sampler import ShardSampler
 from basicsr.data.prefetch_dataloader import PrefetchDataLoader
 from basicsr.utils import get_root_logger, scandir
 from basicsr.utils.dist_util import get_dist_info
@@ -74,6 +76,11 @@ def create_dataloader(dataset,
             phase (str): 'train' or 'val'.
             num_worker_per_gpu (int): Number of workers for each GPU.
             batch_size_per_gpu (int): Training batch size for each GPU.
+            batched (bool): For 'val'/'test', decode with
+                num_worker_per_gpu workers and batch up to
+                batch_size_per_gpu same-shaped images, see
+                :func:`shape_grouped_collate`. Each network call still
+                takes at most val.max_minibatch images. Default: False.
         num_gpu (int): Number of GPUs. Used only in the train phase.
             Default: 1.
         dist (bool): Whether in distributed training. Used only in the train
@@ -105,6 +112,20 @@ def create_dataloader(dataset,
         dataloader_args['worker_init_fn'] = partial(
             worker_init_fn, num_workers=num_workers, rank=rank,
             seed=seed) if seed is not None else None
+    elif phase in ['val', 'test'] and dataset_opt.get('batched', False):
+        # parallel decoding, same-shaped images batched together
+        world_size = get_dist_info()[1]
+        num_workers = dataset_opt.get('num_worker_per_gpu', 4)
+        dataloader_args = dict(
+            dataset=dataset,
+            batch_size=dataset_opt.get('batch_size_per_gpu', 8),
+            shuffle=False,
+            num_workers=num_workers,
+            sampler=ShardSampler(dataset, world_size, rank) if dist else None,
+            collate_fn=shape_grouped_collate)
+        if num_workers > 0:
+            dataloader_args['prefetch_factor'] = dataset_opt.get(
+                'prefetch_factor', 2)
     elif phase in ['val', 'test']:  # validation
         dataloader_args = dict(
             dataset=dataset, batch_size=1, shuffle=False, num_workers=0)
@@ -128,6 +149,23 @@ def create_dataloader(dataset,
         return torch.utils.data.DataLoader(**dataloader_args)
 
 
+def shape_grouped_collate(samples):
+    """Collate samples into batches of same-shaped images.
+
+    Samples are grouped by the shapes of all their tensors, keeping the
+    order of first appearance.
+
+    Returns:
+        list[dict]: One collated batch per group.
+    """
+    groups = {}
+    for sample in samples:
+        key = tuple((k, tuple(v.shape)) for k, v in sample.items()
+                    if torch.is_tensor(v))
+        groups.setdefault(key, []).append(sample)
+    return [default_collate(group) for group in groups.values()]
+
+
 def worker_init_fn(worker_id, num_workers, rank, seed):
     # Set the worker seed to num_workers * rank + worker_id + seed
     worker_seed = num_workers * rank + worker_id + seed
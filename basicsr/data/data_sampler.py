@@ -54,3 +54,26 @@ class EnlargedSampler(Sampler):
 
     def set_epoch(self, epoch):
         self.epoch = epoch
+
+
+class ShardSampler(Sampler):
+    """Sampler that gives each process every num_replicas-th sample, in
+    order and without padding, so that no sample is seen twice, e.g. by
+    validation metrics.
+
+    Args:
+        dataset (torch.utils.data.Dataset): Dataset used for sampling.
+        num_replicas (int): Number of processes, usually the world_size.
+        rank (int): Rank of the current process within num_replicas.
+    """
+
+    def __init__(self, dataset, num_replicas, rank):
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __iter__(self):
+        return iter(range(self.rank, len(self.dataset), self.num_replicas))
+
+    def __len__(self):
+        return len(range(self.rank, len(self.dataset), self.num_replicas))
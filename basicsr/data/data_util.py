@@ -160,6 +160,47 @@ def paired_paths_from_lmdb(folders, keys):
         return paths
 
 
+def paired_paths_from_mmap(folders, keys):
+    """Generate paired paths from memory-mapped stores.
+
+    The stores are made by
+    :func:`basicsr.utils.mmap_util.make_mmap_from_imgs`, their meta_info.txt
+    lists one image key per line, the same for corresponding lq and gt
+    images.
+
+    Args:
+        folders (list[str]): A list of folder path. The order of list should
+            be [input_folder, gt_folder].
+        keys (list[str]): A list of keys identifying folders. The order should
+            be in consistent with folders, e.g., ['lq', 'gt'].
+
+    Returns:
+        list[str]: Returned path list.
+    """
+    assert len(folders) == 2, (
+        'The len of folders should be 2 with [input_folder, gt_folder]. '
+        f'But got {len(folders)}')
+    input_folder, gt_folder = folders
+    input_key, gt_key = keys
+
+    if not (input_folder.endswith('.mmap') and gt_folder.endswith('.mmap')):
+        raise ValueError(
+            f'{input_key} folder and {gt_key} folder should both in mmap '
+            f'formats. But received {input_key}: {input_folder}; '
+            f'{gt_key}: {gt_folder}')
+    with open(osp.join(input_folder, 'meta_info.txt')) as fin:
+        input_mmap_keys = [line.split(' ')[0] for line in fin]
+    with open(osp.join(gt_folder, 'meta_info.txt')) as fin:
+        gt_mmap_keys = [line.split(' ')[0] for line in fin]
+    if set(input_mmap_keys) != set(gt_mmap_keys):
+        raise ValueError(
+            f'Keys in {input_key}_folder and {gt_key}_folder are different.')
+    return [
+        dict([(f'{input_key}_path', mmap_key), (f'{gt_key}_path', mmap_key)])
+        for mmap_key in sorted(input_mmap_keys)
+    ]
+
+
 def paired_paths_from_meta_info_file(folders, keys, meta_info_file,
                                      filename_tmpl):
     """Generate paired paths from an meta information file.
@@ -12,6 +12,7 @@ from basicsr.data.data_util import (paired_paths_from_folder,
                                     paired_paths_from_meta_info_file)
 from basicsr.data.transforms import augment, paired_random_crop_hw
 from basicsr.utils import FileClient, imfrombytes, img2tensor, padding
+from basicsr.utils.mmap_util import load_mmap_images
 import os
 import numpy as np
 
@@ -34,8 +35,9 @@ class PairedImageSRLRFullImageMemoryDataset(data.Dataset):
 
     Args:
         opt (dict): Config for train datasets. It contains the following keys:
-            dataroot_gt (str): Data root path for gt.
-            dataroot_lq (str): Data root path for lq.
+            dataroot_gt (str): Pickle of the gt image list, or a '.mmap'
+                store written by scripts/make_pickle.py.
+            dataroot_lq (str): Same for lq.
             meta_info_file (str): Path for meta information file.
             io_backend (dict): IO backend type and other kwarg.
             filename_tmpl (str): Template for each filename. Note that the
@@ -68,14 +70,21 @@ class PairedImageSRLRFullImageMemoryDataset(data.Dataset):
 
 
 
+    @staticmethod
+    def load_images(path):
+        # .mmap stores are mapped read-only and shared by all workers through
+        # the page cache, pickles are loaded into every worker
+        if path.endswith('.mmap'):
+            return load_mmap_images(path)
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
     def __getitem__(self, index):
         if self.lqs is None:
             # print('self.dataroot lq .. ', self.dataroot_lq, self.dataroot_gt)
-            with open(self.dataroot_lq, 'rb') as f:
-                self.lqs = pickle.load(f)
+            self.lqs = self.load_images(self.dataroot_lq)
         if self.gts is None:
-            with open(self.dataroot_gt, 'rb') as f:
-                self.gts = pickle.load(f)
+            self.gts = self.load_images(self.dataroot_gt)
             # with open(opt['dataroot_gt'], 'rb') as f:
             #     self.gts = pickle.load(f)
 
@@ -108,7 +117,9 @@ class PairedImageSRLRFullImageMemoryDataset(data.Dataset):
         #
         # assert img_hr.shape[0] == h * w * c
 
-        img_lq = self.lqs[index].copy().astype(np.float32) / 255.
+        # uint8 views of the mapped stores, converted to float32 after the
+        # crop in training
+        img_lq = self.lqs[index]
         #
         # print('index .. ', index)
         # if index >= len(self.gts1):
@@ -119,7 +130,7 @@ class PairedImageSRLRFullImageMemoryDataset(data.Dataset):
         #     img_gt = self.gts1[index_gt].copy().astype(np.float32) / 255.
         #
         #
-        img_gt = self.gts[index].copy().astype(np.float32) / 255.
+        img_gt = self.gts[index]
 
         # img_lr = img_lr.reshape(h // 4, w // 4, c).astype(np.float32) / 255.
         # img_hr = img_hr.reshape(h, w, c).astype(np.float32) / 255.
@@ -186,6 +197,31 @@ class PairedImageSRLRFullImageMemoryDataset(data.Dataset):
                 gt_size_h, gt_size_w = gt_size, gt_size
 
 
+            if 'random_offset' in self.opt and self.opt['random_offset'] > 0:
+                # if np.random.rand() < 0.9:
+                S = int(self.opt['random_offset'])
+
+                offsets = int(np.random.rand() * (S+1))  #1~S
+                s2, s4 = 0, 0
+
+                if np.random.rand() < 0.5:
+                    s2 = offsets
+                else:
+                    s4 = offsets
+
+                _, w, _ = img_lq.shape
+
+                img_lq = np.concatenate([img_lq[:, s2:w-s4, :3], img_lq[:, s4:w-s2, 3:]], axis=-1)
+                img_gt = np.concatenate(
+                    [img_gt[:, 4 * s2:4*w-4 * s4, :3], img_gt[:, 4 * s4:4*w-4 * s2, 3:]], axis=-1)
+
+            # random crop of the uint8 images, then float32 copies of the
+            # patches only, modified in place below
+            img_gt, img_lq = paired_random_crop_hw(img_gt, img_lq, gt_size_h, gt_size_w, scale,
+                                                'gt_path_L_and_R')
+            img_gt = img_gt.astype(np.float32) / 255.
+            img_lq = img_lq.astype(np.float32) / 255.
+
             if 'flip_LR' in self.opt and self.opt['flip_LR']:
                 if np.random.rand() < 0.5:
                     img_gt = img_gt[:, :, [3, 4, 5, 0, 1, 2]]
@@ -224,28 +260,6 @@ class PairedImageSRLRFullImageMemoryDataset(data.Dataset):
                     # img_lq[:, :, i] = 1 - img_lq[:, :, i]
                     # img_lq[:, :, i+3] = 1 - img_lq[:, :, i+3]
 
-            if 'random_offset' in self.opt and self.opt['random_offset'] > 0:
-                # if np.random.rand() < 0.9:
-                S = int(self.opt['random_offset'])
-
-                offsets = int(np.random.rand() * (S+1))  #1~S
-                s2, s4 = 0, 0
-
-                if np.random.rand() < 0.5:
-                    s2 = offsets
-                else:
-                    s4 = offsets
-
-                _, w, _ = img_lq.shape
-
-                img_lq = np.concatenate([img_lq[:, s2:w-s4, :3], img_lq[:, s4:w-s2, 3:]], axis=-1)
-                img_gt = np.concatenate(
-                    [img_gt[:, 4 * s2:4*w-4 * s4, :3], img_gt[:, 4 * s4:4*w-4 * s2, 3:]], axis=-1)
-
-            # random crop
-            img_gt, img_lq = img_gt.copy(), img_lq.copy()
-            img_gt, img_lq = paired_random_crop_hw(img_gt, img_lq, gt_size_h, gt_size_w, scale,
-                                                'gt_path_L_and_R')
             # flip, rotation
             imgs, status = augment([img_gt, img_lq], self.opt['use_hflip'],
                                     self.opt['use_rot'], vflip=self.opt['use_vflip'], return_status=True)
@@ -253,6 +267,9 @@ class PairedImageSRLRFullImageMemoryDataset(data.Dataset):
 
             img_gt, img_lq = imgs
             hflip, vflip, rot90 = status
+        else:
+            img_gt = img_gt.astype(np.float32) / 255.
+            img_lq = img_lq.astype(np.float32) / 255.
 
         # if self.opt['phase'] == 'train':
         #     gt_size = self.opt['gt_size']
@@ -4,28 +4,38 @@
 # Modified from BasicSR (https://github.com/xinntao/BasicSR)
 # Copyright 2018-2020 BasicSR Authors
 # ------------------------------------------------------------------------
+import numpy as np
 from torch.utils import data as data
 from torchvision.transforms.functional import normalize
 
 from basicsr.data.data_util import (paired_paths_from_folder,
                                     paired_paths_from_lmdb,
-                                    paired_paths_from_meta_info_file)
+                                    paired_paths_from_meta_info_file,
+                                    paired_paths_from_mmap)
 from basicsr.data.transforms import augment, paired_random_crop
 from basicsr.utils import FileClient, imfrombytes, img2tensor, padding
 
 
+def to_float32(img):
+    return img.astype(np.float32) / 255.
+
+
 class PairedImageDataset(data.Dataset):
     """Paired image dataset for image restoration.
 
     Read LQ (Low Quality, e.g. LR (Low Resolution), blurry, noisy, etc) and
     GT image pairs.
 
-    There are three modes:
+    There are four modes:
     1. 'lmdb': Use lmdb files.
         If opt['io_backend'] == lmdb.
-    2. 'meta_info_file': Use meta information file to generate paths.
+    2. 'mmap': Use memory-mapped stores of decoded images, see
+        basicsr/utils/mmap_util.py. Patches are cropped from the uint8
+        images before the float conversion.
+        If opt['io_backend'] == mmap.
+    3. 'meta_info_file': Use meta information file to generate paths.
         If opt['io_backend'] != lmdb and opt['meta_info_file'] is not None.
-    3. 'folder': Scan folders to generate paths.
+    4. 'folder': Scan folders to generate paths.
         The rest.
 
     Args:
@@ -40,6 +50,11 @@ class PairedImageDataset(data.Dataset):
             use_flip (bool): Use horizontal flips.
             use_rot (bool): Use rotation (use vertical flip and transposing h
                 and w for implementation).
+            batch_augment (bool): Leave the crop, flips and rotations to
+                :class:`BatchAugment` after the prefetcher. Images are then
+                only padded and cropped to coarse_gt_size (gt_size by
+                default, not smaller), so that they can be batched.
+                Default: False.
 
             scale (bool): Scale, which will be added automatically.
             phase (str): 'train' or 'val'.
@@ -51,6 +66,7 @@ class PairedImageDataset(data.Dataset):
         # file client (io backend)
         self.file_client = None
         self.io_backend_opt = opt['io_backend']
+        self.decoded = self.io_backend_opt['type'] == 'mmap'
         self.mean = opt['mean'] if 'mean' in opt else None
         self.std = opt['std'] if 'std' in opt else None
 
@@ -65,6 +81,11 @@ class PairedImageDataset(data.Dataset):
             self.io_backend_opt['client_keys'] = ['lq', 'gt']
             self.paths = paired_paths_from_lmdb(
                 [self.lq_folder, self.gt_folder], ['lq', 'gt'])
+        elif self.io_backend_opt['type'] == 'mmap':
+            self.io_backend_opt['db_paths'] = [self.lq_folder, self.gt_folder]
+            self.io_backend_opt['client_keys'] = ['lq', 'gt']
+            self.paths = paired_paths_from_mmap(
+                [self.lq_folder, self.gt_folder], ['lq', 'gt'])
         elif 'meta_info_file' in self.opt and self.opt[
                 'meta_info_file'] is not None:
             self.paths = paired_paths_from_meta_info_file(
@@ -85,24 +106,41 @@ class PairedImageDataset(data.Dataset):
         # Load gt and lq images. Dimension order: HWC; channel order: BGR;
         # image range: [0, 1], float32.
         gt_path = self.paths[index]['gt_path']
-        # print('gt path,', gt_path)
-        img_bytes = self.file_client.get(gt_path, 'gt')
-        try:
-            img_gt = imfrombytes(img_bytes, float32=True)
-        except:
-            raise Exception("gt path {} not working".format(gt_path))
-
         lq_path = self.paths[index]['lq_path']
-        # print(', lq path', lq_path)
-        img_bytes = self.file_client.get(lq_path, 'lq')
-        try:
-            img_lq = imfrombytes(img_bytes, float32=True)
-        except:
-            raise Exception("lq path {} not working".format(lq_path))
+        if self.decoded:
+            # uint8 views into the store, converted once cropped
+            img_gt = self.file_client.get(gt_path, 'gt')
+            img_lq = self.file_client.get(lq_path, 'lq')
+        else:
+            # one call for the pair, zero-copy buffers with lmdb
+            gt_bytes, lq_bytes = self.file_client.get_many(
+                [gt_path, lq_path], ['gt', 'lq'])
+            try:
+                img_gt = imfrombytes(gt_bytes, float32=True)
+            except:
+                raise Exception("gt path {} not working".format(gt_path))
+
+            try:
+                img_lq = imfrombytes(lq_bytes, float32=True)
+            except:
+                raise Exception("lq path {} not working".format(lq_path))
 
 
         # augmentation for training
-        if self.opt['phase'] == 'train':
+        if self.opt['phase'] == 'train' and self.opt.get('batch_augment'):
+            # coarse crop only, the rest is done on whole batches
+            gt_size = self.opt['gt_size']
+            coarse_size = self.opt.get('coarse_gt_size') or gt_size
+            assert coarse_size >= gt_size, (
+                f'coarse_gt_size {coarse_size} is smaller than gt_size '
+                f'{gt_size}.')
+            img_gt, img_lq = padding(img_gt, img_lq, coarse_size)
+            img_gt, img_lq = paired_random_crop(img_gt, img_lq, coarse_size,
+                                                scale, gt_path)
+            if self.decoded:
+                img_gt, img_lq = to_float32(img_gt), to_float32(img_lq)
+
+        elif self.opt['phase'] == 'train':
             gt_size = self.opt['gt_size']
             # padding
             img_gt, img_lq = padding(img_gt, img_lq, gt_size)
@@ -110,10 +148,16 @@ class PairedImageDataset(data.Dataset):
             # random crop
             img_gt, img_lq = paired_random_crop(img_gt, img_lq, gt_size, scale,
                                                 gt_path)
+            if self.decoded:
+                # augment flips in place, work on float copies
+                img_gt, img_lq = to_float32(img_gt), to_float32(img_lq)
             # flip, rotation
             img_gt, img_lq = augment([img_gt, img_lq], self.opt['use_flip'],
                                      self.opt['use_rot'])
 
+        elif self.decoded:
+            img_gt, img_lq = to_float32(img_gt), to_float32(img_lq)
+
         # TODO: color space transform
         # BGR to RGB, HWC to CHW, numpy to tensor
         img_gt, img_lq = img2tensor([img_gt, img_lq],
@@ -130,3 +130,29 @@ class CUDAPrefetcher():
     def reset(self):
         self.loader = iter(self.ori_loader)
         self.preload()
+
+
+class AugmentPrefetcher():
+    """Prefetcher wrapper that augments each batch where it lands.
+
+    Runs a batch transform, e.g. :class:`basicsr.data.transforms.BatchAugment`,
+    on the batches of a CPU or CUDA prefetcher, after they were copied to
+    the device.
+
+    Args:
+        prefetcher: CPUPrefetcher or CUDAPrefetcher.
+        augment (callable): Maps a batch dict to the augmented batch dict.
+    """
+
+    def __init__(self, prefetcher, augment):
+        self.prefetcher = prefetcher
+        self.augment = augment
+
+    def next(self):
+        batch = self.prefetcher.next()
+        if batch is None:
+            return None
+        return self.augment(batch)
+
+    def reset(self):
+        self.prefetcher.reset()
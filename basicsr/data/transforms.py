@@ -8,6 +8,7 @@ import cv2
 import random
 from cv2 import rotate
 import numpy as np
+import torch
 
 
 def mod_crop(img, scale):
@@ -245,3 +246,84 @@ def img_rotate(img, angle, center=None, scale=1.0):
     return rotated_img
 
 
+class BatchAugment():
+    """Paired random crop, flip and rotation of whole batches of tensors.
+
+    Counterpart of :func:`paired_random_crop` and :func:`augment` that runs
+    after the prefetcher, on the device of the batch, so that dataloader
+    workers only decode (and maybe coarse crop) the images. Every sample
+    gets its own crop, flips and transposition, drawn from a generator
+    seeded once per process.
+
+    Args:
+        gt_size (int): GT patch size.
+        scale (int): Scale factor. Default: 1.
+        use_flip (bool): Random horizontal flips. Default: True.
+        use_rot (bool): Random vertical flips and transpositions, i.e.
+            rotations by multiples of 90 degrees. Default: True.
+        seed (int | None): Seed of the generator. Default: None.
+    """
+
+    def __init__(self, gt_size, scale=1, use_flip=True, use_rot=True,
+                 seed=None):
+        self.gt_size = gt_size
+        self.scale = scale
+        self.use_flip = use_flip
+        self.use_rot = use_rot
+        self.seed = seed
+        self.generator = None
+
+    def rand(self, n, device, high=None):
+        if self.generator is None or self.generator.device != device:
+            self.generator = torch.Generator(device=device)
+            if self.seed is None:
+                self.generator.seed()
+            else:
+                self.generator.manual_seed(self.seed)
+        if high is None:
+            return torch.rand(n, generator=self.generator, device=device) < 0.5
+        return torch.randint(high, (n, ), generator=self.generator,
+                             device=device)
+
+    @staticmethod
+    def crop(imgs, top, left, size):
+        b = len(imgs)
+        rows = top[:, None] + torch.arange(size, device=imgs.device)
+        cols = left[:, None] + torch.arange(size, device=imgs.device)
+        # (b, size, size, c) -> (b, c, size, size)
+        imgs = imgs[torch.arange(b, device=imgs.device)[:, None, None], :,
+                    rows[:, :, None], cols[:, None, :]]
+        return imgs.permute(0, 3, 1, 2)
+
+    @staticmethod
+    def where(mask, a, b):
+        return torch.where(mask[:, None, None, None], a, b)
+
+    def __call__(self, data):
+        """Augment the 'gt' and 'lq' tensors (b, c, h, w) of a batch dict."""
+        gt, lq = data['gt'], data['lq']
+        b, _, h_lq, w_lq = lq.size()
+        device = lq.device
+        lq_size = self.gt_size // self.scale
+        if h_lq < lq_size or w_lq < lq_size:
+            raise ValueError(f'LQ batch ({h_lq}, {w_lq}) is smaller than the '
+                             f'patch size ({lq_size}, {lq_size}).')
+
+        top = self.rand(b, device, h_lq - lq_size + 1)
+        left = self.rand(b, device, w_lq - lq_size + 1)
+        lq = self.crop(lq, top, left, lq_size)
+        gt = self.crop(gt, top * self.scale, left * self.scale, self.gt_size)
+
+        flips = []
+        if self.use_flip:
+            flips.append((self.rand(b, device), lambda x: x.flip(-1)))
+        if self.use_rot:
+            flips.append((self.rand(b, device), lambda x: x.flip(-2)))
+            flips.append((self.rand(b, device), lambda x: x.transpose(-2, -1)))
+        for mask, flip in flips:
+            gt = self.where(mask, flip(gt), gt)
+            lq = self.where(mask, flip(lq), lq)
+
+        data = dict(data)
+        data['gt'], data['lq'] = gt.contiguous(), lq.contiguous()
+        return data
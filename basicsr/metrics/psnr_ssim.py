@@ -12,6 +12,7 @@ import numpy as np
 from basicsr.metrics.metric_util import reorder_image, to_y_channel
 from skimage.metrics import structural_similarity
 import torch
+import torch.nn.functional as F
 
 def calculate_psnr(img1,
                    img2,
@@ -186,10 +187,11 @@ def _ssim_3d(img1, img2, max_value):
     img1 = img1.astype(np.float64)
     img2 = img2.astype(np.float64)
 
-    kernel = _generate_3d_gaussian_kernel().cuda()
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    kernel = _generate_3d_gaussian_kernel().to(device)
 
-    img1 = torch.tensor(img1).float().cuda()
-    img2 = torch.tensor(img2).float().cuda()
+    img1 = torch.tensor(img1).float().to(device)
+    img2 = torch.tensor(img2).float().to(device)
 
 
     mu1 = _3d_gaussian_calculator(img1, kernel)
@@ -356,3 +358,175 @@ def calculate_skimage_ssim_left(img1, img2):
     img1 = img1[:,64:,:3]
     img2 = img2[:,64:,:3]
     return calculate_skimage_ssim(img1=img1, img2=img2)
+
+
+def _to_y_channel_pt(img, bgr=False):
+    """Y channel of (n, 3, h, w) images in [0, 255], like to_y_channel."""
+    weight = [24.966, 128.553, 65.481] if bgr else [65.481, 128.553, 24.966]
+    weight = torch.tensor(weight, device=img.device, dtype=img.dtype)
+    return torch.einsum('nchw,c->nhw', img / 255., weight)[:, None] + 16.
+
+
+def _prepare_pt(img1, img2, crop_border, test_y_channel, quantize, rgb2bgr):
+    """Crop, quantize and split stereo pairs of (b, c, h, w) tensors.
+
+    Returns:
+        tuple: The images, with stereo pairs as consecutive (3, h, w)
+            images, and the number of images per input image.
+    """
+    assert img1.shape == img2.shape, (
+        f'Image shapes are differnet: {img1.shape}, {img2.shape}.')
+    if img1.dim() == 3:
+        img1, img2 = img1[None], img2[None]
+    img1, img2 = img1.detach(), img2.detach()
+    if crop_border != 0:
+        img1 = img1[..., crop_border:-crop_border, crop_border:-crop_border]
+        img2 = img2[..., crop_border:-crop_border, crop_border:-crop_border]
+    if quantize:
+        # the uint8 round trip of tensor2img
+        img1 = (img1.clamp(0, 1) * 255.).round()
+        img2 = (img2.clamp(0, 1) * 255.).round()
+
+    b, c, h, w = img1.shape
+    views = 1
+    if c == 6:
+        views = 2
+        img1 = img1.reshape(b * 2, 3, h, w)
+        img2 = img2.reshape(b * 2, 3, h, w)
+    if test_y_channel and img1.shape[1] == 3:
+        # to_y_channel expects BGR, which tensor2img only makes of 3 channel
+        # images with rgb2bgr; stereo halves and other images reach it in RGB
+        # order and get the BGR weights all the same
+        bgr = views == 2 or not rgb2bgr
+        img1 = _to_y_channel_pt(img1, bgr=bgr)
+        img2 = _to_y_channel_pt(img2, bgr=bgr)
+    return img1, img2, views
+
+
+def _max_value_pt(img):
+    """Per image data range, 1 if the image is within [0, 1] else 255."""
+    peak = img.flatten(1).amax(dim=1)
+    return torch.where(peak <= 1, torch.ones_like(peak), 255. * torch.ones_like(peak))
+
+
+def calculate_psnr_pt(img1, img2, crop_border, test_y_channel=False,
+                      quantize=False, rgb2bgr=False):
+    """Calculate PSNR of batches of tensors on their device.
+
+    Tensor counterpart of :func:`calculate_psnr`, with the same results.
+
+    Args:
+        img1 (Tensor): RGB images with shape (b, c, h, w) and range [0, 1].
+        img2 (Tensor): RGB images with shape (b, c, h, w) and range [0, 1].
+        crop_border (int): Cropped pixels in each edge of an image.
+        test_y_channel (bool): Test on Y channel of YCbCr. Default: False.
+        quantize (bool): Clamp and round to uint8 levels first, as for the
+            images of tensor2img. Default: False.
+        rgb2bgr (bool): Match the host metric on the BGR images of
+            tensor2img(rgb2bgr=True), for the Y channel. Otherwise the host
+            metric sees RGB images, i.e. raw tensors or the images of
+            tensor2img(rgb2bgr=False). Default: False.
+
+    Returns:
+        Tensor: psnr of each image, with shape (b,).
+    """
+    img1, img2, views = _prepare_pt(img1.double(), img2.double(),
+                                    crop_border, test_y_channel, quantize,
+                                    rgb2bgr)
+    mse = ((img1 - img2)**2).flatten(1).mean(dim=1)
+    psnr = 20. * torch.log10(_max_value_pt(img1) / torch.sqrt(mse))
+    return psnr.view(-1, views).mean(dim=1)
+
+
+def _gaussian_kernel_pt(device, dtype, size=11, sigma=1.5):
+    """1D Gaussian kernel of cv2.getGaussianKernel."""
+    x = torch.arange(size, device=device, dtype=torch.float64) - size // 2
+    kernel = torch.exp(-x**2 / (2 * sigma**2))
+    return (kernel / kernel.sum()).to(dtype)
+
+
+def _gaussian_filter_pt(img, kernel, replicate):
+    """Separable Gaussian filter of (n, 1, *spatial) tensors over all
+    spatial dimensions, with replicated borders or 'valid' output."""
+    nd = img.dim() - 2
+    conv = F.conv2d if nd == 2 else F.conv3d
+    r = len(kernel) // 2
+    for axis in range(nd):
+        shape = [1, 1] + [1] * nd
+        shape[2 + axis] = len(kernel)
+        if replicate:
+            # F.pad lists the last dimension first
+            pad = [0] * (2 * nd)
+            pad[2 * (nd - 1 - axis)] = pad[2 * (nd - 1 - axis) + 1] = r
+            img = F.pad(img, pad, mode='replicate')
+        img = conv(img, kernel.view(shape))
+    return img
+
+
+def _ssim_pt(img1, img2, max_value, replicate):
+    """SSIM map mean of (n, 1, *spatial) tensors, see :func:`_ssim`."""
+    max_value = max_value.view(-1, *([1] * (img1.dim() - 1)))
+    C1 = (0.01 * max_value)**2
+    C2 = (0.03 * max_value)**2
+    kernel = _gaussian_kernel_pt(img1.device, img1.dtype)
+
+    def filt(x):
+        return _gaussian_filter_pt(x, kernel, replicate)
+
+    mu1, mu2 = filt(img1), filt(img2)
+    mu1_sq = mu1**2
+    mu2_sq = mu2**2
+    mu1_mu2 = mu1 * mu2
+    sigma1_sq = filt(img1**2) - mu1_sq
+    sigma2_sq = filt(img2**2) - mu2_sq
+    sigma12 = filt(img1 * img2) - mu1_mu2
+
+    ssim_map = ((2 * mu1_mu2 + C1) *
+                (2 * sigma12 + C2)) / ((mu1_sq + mu2_sq + C1) *
+                                       (sigma1_sq + sigma2_sq + C2))
+    return ssim_map.flatten(1).mean(dim=1)
+
+
+def calculate_ssim_pt(img1, img2, crop_border, test_y_channel=False,
+                      ssim3d=True, quantize=False, rgb2bgr=False):
+    """Calculate SSIM of batches of tensors on their device.
+
+    Tensor counterpart of :func:`calculate_ssim`, with the same results up
+    to float32 precision: the 3D Gaussian SSIM by default, the per channel
+    SSIM without ssim3d, and the SSIM with replicated borders of
+    :func:`_ssim_cly` on the Y channel.
+
+    Args:
+        img1 (Tensor): RGB images with shape (b, c, h, w) and range [0, 1].
+        img2 (Tensor): RGB images with shape (b, c, h, w) and range [0, 1].
+        crop_border (int): Cropped pixels in each edge of an image.
+        test_y_channel (bool): Test on Y channel of YCbCr. Default: False.
+        ssim3d (bool): Use the 3D Gaussian window over (c, h, w).
+            Default: True.
+        quantize (bool): Clamp and round to uint8 levels first, as for the
+            images of tensor2img. Default: False.
+        rgb2bgr (bool): Match the host metric on the BGR images of
+            tensor2img(rgb2bgr=True), for the Y channel. Otherwise the host
+            metric sees RGB images, i.e. raw tensors or the images of
+            tensor2img(rgb2bgr=False). Default: False.
+
+    Returns:
+        Tensor: ssim of each image, with shape (b,).
+    """
+    img1, img2, views = _prepare_pt(img1.float(), img2.float(), crop_border,
+                                    test_y_channel, quantize, rgb2bgr)
+    n, c, h, w = img1.shape
+    if test_y_channel and c == 1:
+        ssim = _ssim_pt(img1, img2, torch.full((n, ), 255., device=img1.device),
+                        replicate=True)
+    elif ssim3d:
+        ssim = _ssim_pt(img1[:, None], img2[:, None], _max_value_pt(img1),
+                        replicate=True)
+    else:
+        # each channel separately, 'valid' window positions only
+        max_value = _max_value_pt(img1).repeat_interleave(c)
+        ssim = _ssim_pt(img1.reshape(n * c, 1, h, w),
+                        img2.reshape(n * c, 1, h, w), max_value,
+                        replicate=False)
+        ssim = ssim.view(n, c).mean(dim=1)
+    return ssim.view(-1, views).mean(dim=1)
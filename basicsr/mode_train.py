@@ -15,7 +15,9 @@ from os import path as osp
 
 from basicsr.data import create_dataloader, create_dataset
 from basicsr.data.data_sampler import EnlargedSampler
-from basicsr.data.prefetch_dataloader import CPUPrefetcher, CUDAPrefetcher
+from basicsr.data.prefetch_dataloader import (AugmentPrefetcher,
+                                             CPUPrefetcher, CUDAPrefetcher)
+from basicsr.data.transforms import BatchAugment
 from basicsr.models import create_model
 from basicsr.utils import (MessageLogger, check_resume, get_env_info,
                            get_root_logger, get_time_str, init_tb_logger,
@@ -261,6 +263,15 @@ def main():
     else:
         raise ValueError(f'Wrong prefetch_mode {prefetch_mode}.'
                          "Supported ones are: None, 'cuda', 'cpu'.")
+    if opt['datasets']['train'].get('batch_augment'):
+        # crop, flip and rotate whole batches after the prefetcher
+        dataset_opt = opt['datasets']['train']
+        prefetcher = AugmentPrefetcher(
+            prefetcher,
+            BatchAugment(dataset_opt['gt_size'], dataset_opt.get('scale', 1),
+                         dataset_opt['use_flip'], dataset_opt['use_rot'],
+                         seed=opt['manual_seed'] + opt['rank']))
+        logger.info('Use batched augmentation after the prefetcher')
 
     # training
     logger.info(
@@ -280,8 +291,10 @@ def main():
         # wheather use uint8 image to compute metrics
         use_image = opt['val'].get('use_image', True)
         if mode == 'Sidd':        
+            # every test condition in one pass over the data
             model.validation(val_loader, current_iter, tb_logger,
-                                opt['val']['save_img'], rgb2bgr, use_image )
+                                opt['val']['save_img'], rgb2bgr, use_image,
+                                modes=opt['val'].get('test_modes', ['Sidd']))
         elif mode == 'gopro':  
             model.validation(val_loader_gopro, current_iter, tb_logger,
                                 opt['val']['save_img'], rgb2bgr, use_image )  
@@ -371,7 +384,8 @@ def main():
                     use_image = opt['val'].get('use_image', True)
                     if mode == 'Sidd':        
                         model.validation(val_loader, current_iter, tb_logger,
-                                            opt['val']['save_img'], rgb2bgr, use_image )
+                                            opt['val']['save_img'], rgb2bgr, use_image,
+                                            modes=opt['val'].get('test_modes', ['Sidd']))
                     elif mode == 'gopro':  
                         model.validation(val_loader_gopro, current_iter, tb_logger,
                                             opt['val']['save_img'], rgb2bgr, use_image )  
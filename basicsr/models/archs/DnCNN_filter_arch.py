@@ -2,86 +2,21 @@ import torch
 import torch.nn as nn
 import torch.nn.init as init
 import torch.nn.functional as F
+from basicsr.models.archs.freq_util import (Random_frequency_replacing,
+                                             fft_float32, hermitian_expand,
+                                             radial_band_index, radial_band_mask,
+                                             rfft_band_index, rfft_band_mask)
 # from models import register_model
 # from models import BFBatchNorm2d
 import math
 
-class Random_frequency_replacing(nn.Module):
-    def __init__(self):
-        super().__init__()
-
-   
-        self.radius_factor_set = torch.arange(0.01, 1.01, 0.01).cuda()
-        self.value_set = torch.arange(1., 0., -0.01).cuda()
-
-   
-    def forward(self, clean, noisy):
-        B, C, H, W = noisy.size()
-        inp = noisy
-
-        a, b = torch.meshgrid(torch.arange(H), torch.arange(W))
-        dist = torch.sqrt((a - H/2)**2 + (b - W/2)**2)
-        dist = dist.to(noisy.device)
-        max_radius = math.sqrt(H*H+W*W)/2
-
-       
-        noisy_fq = torch.fft.fftn(noisy, dim=(-1,-2))
-        noisy_fq = torch.fft.fftshift(noisy_fq)
-        clean_fq = torch.fft.fftn(clean, dim=(-1,-2))
-        clean_fq = torch.fft.fftshift(clean_fq)
-
-
-       
-        radius_set = max_radius*self.radius_factor_set
-
-        value_prob = self.value_set.view(1, -1)
-        value_prob = value_prob.repeat(B, 1)
-
-        value_set =  torch.bernoulli(value_prob*0.3).cuda()
-        # value_set =  torch.bernoulli(torch.ones(B,len(self.radius_factor_set))*0.2).cuda()
-       
-
-        mask = []
-        # zero = torch.tensor(0.0, dtype=torch.float32).cuda()
-        zero_mask = torch.zeros_like(dist).cuda()
-        one_mask = torch.ones_like(dist).cuda()
-        for i in range(len(radius_set)):
-            if i == 0:
-                mask.append(torch.where((dist < radius_set[i]), one_mask, zero_mask))
-            else :
-                mask.append(torch.where((dist < radius_set[i]) & (dist >= radius_set[i-1]), one_mask, zero_mask))
-           
-
-        fq_mask_set = torch.stack(mask, dim=0)
-        fq_mask = value_set.unsqueeze(-1).unsqueeze(-1) * fq_mask_set.unsqueeze(0)
-        fq_mask = torch.sum(fq_mask, dim=1)
-        # print(fq_mask[0])
-    
-        # fq_mask [B,H,W]
-        # bn1이 작은 확률 --> noise에 넣어줌 
-        bn1_mask = fq_mask
-        bn2_mask = torch.ones_like(bn1_mask)-bn1_mask
-
-
-        noisy_fq = (noisy_fq*bn1_mask.unsqueeze(1))
-        clean_fq = (clean_fq*bn2_mask.unsqueeze(1))
-
-        replaced_fq = noisy_fq+clean_fq
-        replaced_fq = torch.fft.ifftshift(replaced_fq)
-
-        replaced_fq = torch.fft.ifftn(replaced_fq, dim=(-1,-2))
-
-        replaced_fq = replaced_fq.real
-        # lowpass = torch.clamp(lowpass.real, 0 , 1)
-
-
-        return replaced_fq
-
-
 class Adaptive_freqfilter_regression(nn.Module):
-    def __init__(self):
+    def __init__(self, rfft=False):
         super().__init__()
 
+        # filter the half spectrum of torch.fft.rfft2 instead of the full one
+        self.rfft = rfft
+
         # self.conv1 = nn.Conv2d(in_channels=3, out_channels=16, kernel_size=1, padding=0, stride=1, groups=1, bias=True)
         self.conv1 = nn.Conv2d(in_channels=6, out_channels=16, kernel_size=3, padding=1, stride=1, groups=1, bias=True)
         # self.down1 = nn.Conv2d(16, 32, 2, 2, bias=True)
@@ -100,27 +35,31 @@ class Adaptive_freqfilter_regression(nn.Module):
         self.sig = nn.Sigmoid()
         self.soft = nn.Softmax(dim=0)
         # reg4 setting
-        self.radius_factor_set = torch.arange(0.01, 1.01, 0.01).cuda()
+        self.register_buffer('radius_factor_set',
+                             torch.arange(0.01, 1.01, 0.01), persistent=False)
+        self.radius_factors = tuple(self.radius_factor_set.tolist())
   
         self.fclayer_v1 = nn.Linear(64, 256)
         self.fclayer_v2 = nn.Linear(256, len(self.radius_factor_set))
         self.leaky_relu = nn.LeakyReLU()
 
    
+    @fft_float32
     def forward(self, x):
         B, C, H, W = x.size()
         inp = x
 
-        a, b = torch.meshgrid(torch.arange(H), torch.arange(W))
-        dist = torch.sqrt((a - H/2)**2 + (b - W/2)**2)
-        dist = dist.to(x.device)
-        max_radius = math.sqrt(H*H+W*W)/2
-
-       
-        x = torch.fft.fftn(x, dim=(-1,-2))
-        x = torch.fft.fftshift(x)
+        if self.rfft:
+            band_index = rfft_band_index(H, W, self.radius_factors, x.device)
+            x = torch.fft.rfft2(x)
+            x_mag = hermitian_expand(torch.abs(x), W)
+            x_mag = torch.fft.fftshift(x_mag)
+        else:
+            band_index = radial_band_index(H, W, self.radius_factors, x.device)
+            x = torch.fft.fftn(x, dim=(-1,-2))
+            x = torch.fft.fftshift(x)
+            x_mag = torch.abs(x)
 
-        x_mag = torch.abs(x)
         x_mag = torch.log10(x_mag + 1)
 
         filter_input = torch.cat((inp,x_mag), dim=1)
@@ -142,36 +81,27 @@ class Adaptive_freqfilter_regression(nn.Module):
         # radius_factor_set = self.sig(self.fclayer_r2(self.fclayer_r1(y)))
         value_set =  self.leaky_relu(self.fclayer_v2(self.fclayer_v1(y)))
         # value_set =  self.sig(self.fclayer_v2(self.fclayer_v1(y)))
-        radius_set = max_radius*self.radius_factor_set
 
+        if self.rfft:
+            # value_set [B, 100] -> fq_mask [B, H, W//2+1], unshifted
+            fq_mask = rfft_band_mask(value_set, band_index)
+            # fftshift/ifftshift of the full path also roll the batch dim,
+            # keep the same sample/mask pairing
+            lowpass = x * torch.fft.ifftshift(fq_mask, dim=0).unsqueeze(1)
+            lowpass = torch.fft.irfft2(lowpass, s=(H, W))
+        else:
+            # value_set [B, 100], band_index [H, W] -> fq_mask [B, H, W]
+            fq_mask = radial_band_mask(value_set, band_index)
 
-        mask = []
+            lowpass = (x*fq_mask.unsqueeze(1))
 
-        zero_mask = torch.zeros_like(dist).cuda()
-        one_mask = torch.ones_like(dist).cuda()
-        for i in range(len(radius_set)):
-            if i == 0:
-                mask.append(torch.where((dist <= radius_set[i]), one_mask, zero_mask))
-            else :
-                mask.append(torch.where((dist <= radius_set[i]) & (dist > radius_set[i-1]), one_mask, zero_mask))
+            lowpass = torch.fft.ifftshift(lowpass)
 
-
-        fq_mask_set = torch.stack(mask, dim=0)
-      
-        # value_set [B, 100, 1, 1], fq_mask_set [1, 100, H, W]
-        fq_mask = value_set.unsqueeze(-1).unsqueeze(-1) * fq_mask_set.unsqueeze(0)
-        fq_mask = torch.sum(fq_mask, dim=1)
-        
-
-
-        lowpass = (x*fq_mask.unsqueeze(1))
-
-        lowpass = torch.fft.ifftshift(lowpass)
-
-        lowpass = torch.fft.ifftn(lowpass, dim=(-1,-2))
+            lowpass = torch.fft.ifftn(lowpass, dim=(-1,-2))
+            lowpass = lowpass.real
 
         # lowpass = torch.abs(lowpass)
-        lowpass = torch.clamp(lowpass.real, 0 , 1)
+        lowpass = torch.clamp(lowpass, 0 , 1)
 
 
         return lowpass, fq_mask, value_set
@@ -257,7 +187,7 @@ class DNCNN_filter(nn.Module):
         # norm_layer = nn.BatchNorm2d
 
         self.depth = depth
-        self.replace = Random_frequency_replacing()
+        self.replace = Random_frequency_replacing(fbr_param=0.3)
 
 
         self.first_layer = nn.Conv2d(in_channels=3, out_channels=n_channels, kernel_size=kernel_size, padding=padding, bias=self.bias)
@@ -17,6 +17,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from basicsr.models.archs.arch_util import LayerNorm2d
+from basicsr.models.archs.freq_util import (fft_float32, hermitian_expand,
+                                             radial_band_index, radial_band_mask,
+                                             rfft_band_index, rfft_band_mask)
 from basicsr.models.archs.local_arch import Local_Base
 from basicsr.utils.flops_util import count_model_param_flops, print_model_param_nums
 
@@ -25,9 +28,12 @@ import math
 
 
 class Adaptive_freqfilter_regression(nn.Module):
-    def __init__(self):
+    def __init__(self, rfft=False):
         super().__init__()
 
+        # filter the half spectrum of torch.fft.rfft2 instead of the full one
+        self.rfft = rfft
+
         # self.conv1 = nn.Conv2d(in_channels=3, out_channels=16, kernel_size=1, padding=0, stride=1, groups=1, bias=True)
         self.conv1 = nn.Conv2d(in_channels=6, out_channels=16, kernel_size=3, padding=1, stride=1, groups=1, bias=True)
         # self.down1 = nn.Conv2d(16, 32, 2, 2, bias=True)
@@ -46,27 +52,31 @@ class Adaptive_freqfilter_regression(nn.Module):
         self.sig = nn.Sigmoid()
         self.soft = nn.Softmax(dim=0)
         # reg4 setting
-        self.radius_factor_set = torch.arange(0.01, 1.01, 0.01).cuda()
+        self.register_buffer('radius_factor_set',
+                             torch.arange(0.01, 1.01, 0.01), persistent=False)
+        self.radius_factors = tuple(self.radius_factor_set.tolist())
   
         self.fclayer_v1 = nn.Linear(64, 256)
         self.fclayer_v2 = nn.Linear(256, len(self.radius_factor_set))
         self.leaky_relu = nn.LeakyReLU()
 
    
+    @fft_float32
     def forward(self, x):
         B, C, H, W = x.size()
         inp = x
 
-        a, b = torch.meshgrid(torch.arange(H), torch.arange(W))
-        dist = torch.sqrt((a - H/2)**2 + (b - W/2)**2)
-        dist = dist.to(x.device)
-        max_radius = math.sqrt(H*H+W*W)/2
-
-       
-        x = torch.fft.fftn(x, dim=(-1,-2))
-        x = torch.fft.fftshift(x)
+        if self.rfft:
+            band_index = rfft_band_index(H, W, self.radius_factors, x.device)
+            x = torch.fft.rfft2(x)
+            x_mag = hermitian_expand(torch.abs(x), W)
+            x_mag = torch.fft.fftshift(x_mag)
+        else:
+            band_index = radial_band_index(H, W, self.radius_factors, x.device)
+            x = torch.fft.fftn(x, dim=(-1,-2))
+            x = torch.fft.fftshift(x)
+            x_mag = torch.abs(x)
 
-        x_mag = torch.abs(x)
         x_mag = torch.log10(x_mag + 1)
 
         filter_input = torch.cat((inp,x_mag), dim=1)
@@ -88,36 +98,27 @@ class Adaptive_freqfilter_regression(nn.Module):
         # radius_factor_set = self.sig(self.fclayer_r2(self.fclayer_r1(y)))
         value_set =  self.leaky_relu(self.fclayer_v2(self.fclayer_v1(y)))
         # value_set =  self.sig(self.fclayer_v2(self.fclayer_v1(y)))
-        radius_set = max_radius*self.radius_factor_set
-
-
-        mask = []
-
-        zero_mask = torch.zeros_like(dist).cuda()
-        one_mask = torch.ones_like(dist).cuda()
-        for i in range(len(radius_set)):
-            if i == 0:
-                mask.append(torch.where((dist <= radius_set[i]), one_mask, zero_mask))
-            else :
-                mask.append(torch.where((dist <= radius_set[i]) & (dist > radius_set[i-1]), one_mask, zero_mask))
-
-
-        fq_mask_set = torch.stack(mask, dim=0)
-      
-        # value_set [B, 100, 1, 1], fq_mask_set [1, 100, H, W]
-        fq_mask = value_set.unsqueeze(-1).unsqueeze(-1) * fq_mask_set.unsqueeze(0)
-        fq_mask = torch.sum(fq_mask, dim=1)
-        
 
+        if self.rfft:
+            # value_set [B, 100] -> fq_mask [B, H, W//2+1], unshifted
+            fq_mask = rfft_band_mask(value_set, band_index)
+            # fftshift/ifftshift of the full path also roll the batch dim,
+            # keep the same sample/mask pairing
+            lowpass = x * torch.fft.ifftshift(fq_mask, dim=0).unsqueeze(1)
+            lowpass = torch.fft.irfft2(lowpass, s=(H, W))
+        else:
+            # value_set [B, 100], band_index [H, W] -> fq_mask [B, H, W]
+            fq_mask = radial_band_mask(value_set, band_index)
 
-        lowpass = (x*fq_mask.unsqueeze(1))
+            lowpass = (x*fq_mask.unsqueeze(1))
 
-        lowpass = torch.fft.ifftshift(lowpass)
+            lowpass = torch.fft.ifftshift(lowpass)
 
-        lowpass = torch.fft.ifftn(lowpass, dim=(-1,-2))
+            lowpass = torch.fft.ifftn(lowpass, dim=(-1,-2))
+            lowpass = lowpass.real
 
         # lowpass = torch.abs(lowpass)
-        lowpass = torch.clamp(lowpass.real, 0 , 1)
+        lowpass = torch.clamp(lowpass, 0 , 1)
 
 
         return lowpass, fq_mask, value_set
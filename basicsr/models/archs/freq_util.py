@@ -0,0 +1,338 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2022 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+import math
+from functools import lru_cache, wraps
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def fft_float32(forward):
+    """Decorator for forward methods with FFTs: runs them outside of
+    autocast with float16/bfloat16 inputs cast to float32, as the spectra
+    and log-magnitudes are not safe in half precision."""
+
+    @wraps(forward)
+    def wrapper(self, x, *args, **kwargs):
+        with torch.autocast(x.device.type, enabled=False):
+            x, *args = [
+                a.float() if torch.is_tensor(a)
+                and a.dtype in (torch.float16, torch.bfloat16) else a
+                for a in (x, *args)
+            ]
+            return forward(self, x, *args, **kwargs)
+
+    return wrapper
+
+
+@lru_cache(maxsize=32)
+def _radial_band_index(h, w, radius_factors, device, right):
+    a, b = torch.meshgrid(torch.arange(h), torch.arange(w))
+    dist = torch.sqrt((a - h / 2)**2 + (b - w / 2)**2)
+    max_radius = math.sqrt(h * h + w * w) / 2
+    radius_set = max_radius * torch.tensor(radius_factors)
+
+    band_index = torch.bucketize(dist, radius_set, right=right)
+    return band_index.to(device)
+
+
+def radial_band_index(h, w, radius_factors, device, right=False):
+    """Band index map of the centered (fftshift-ed) spectrum.
+
+    Pixel (i, j) falls in band k when its distance to the spectrum center
+    lies in (r_{k-1}, r_k], where r_k = radius_factors[k] * max_radius.
+    With ``right=True`` the band is [r_{k-1}, r_k) instead. Pixels outside
+    the last radius get index ``len(radius_factors)``.
+
+    The map only depends on the shape, so it is built once on the CPU and
+    kept per (h, w, device) in an LRU cache.
+
+    Args:
+        h (int): Spectrum height.
+        w (int): Spectrum width.
+        radius_factors (tuple[float]): Increasing band radii, relative to
+            the half diagonal of the spectrum.
+        device (torch.device): Device of the returned map.
+        right (bool): Include the lower instead of the upper band edge.
+            Default: False.
+
+    Returns:
+        LongTensor: Band index map with shape (h, w).
+    """
+    return _radial_band_index(h, w, tuple(radius_factors),
+                              torch.device(device), right)
+
+
+def radial_band_mask(value_set, band_index):
+    """Build the frequency mask for a batch of per-band values.
+
+    Equivalent to summing ``value_set[:, k] * (band_index == k)`` over all
+    bands, without materializing the [B, N, H, W] mask stack.
+
+    Args:
+        value_set (Tensor): Per-band values with shape (b, n).
+        band_index (LongTensor): Band index map with shape (h, w) and values
+            in [0, n], see :func:`radial_band_index`.
+
+    Returns:
+        Tensor: Frequency mask with shape (b, h, w).
+    """
+    # index n marks pixels outside of every band, they get a zero weight
+    value_set = F.pad(value_set, (0, 1))
+    return value_set[:, band_index]
+
+
+@lru_cache(maxsize=32)
+def _fft_band_index(h, w, radius_factors, device, right):
+    # move the centered map back to the unshifted layout of torch.fft.fftn
+    band_index = torch.fft.ifftshift(
+        _radial_band_index(h, w, radius_factors, torch.device('cpu'), right))
+    return band_index.to(device)
+
+
+def fft_band_index(h, w, radius_factors, device, right=False):
+    """Band index map of :func:`radial_band_index` in the unshifted layout
+    of torch.fft.fftn, i.e. ``torch.fft.ifftshift`` of the centered map.
+
+    Args:
+        h (int): Spectrum height.
+        w (int): Spectrum width.
+        radius_factors (tuple[float]): Increasing band radii, relative to
+            the half diagonal of the spectrum.
+        device (torch.device): Device of the returned map.
+        right (bool): Include the lower instead of the upper band edge.
+            Default: False.
+
+    Returns:
+        LongTensor: Band index map with shape (h, w).
+    """
+    return _fft_band_index(h, w, tuple(radius_factors), torch.device(device),
+                           right)
+
+
+@lru_cache(maxsize=32)
+def _rfft_band_index(h, w, radius_factors, device, right):
+    band_index = _fft_band_index(h, w, radius_factors, torch.device('cpu'),
+                                 right)
+    # band of the conjugate bin (-k, -l)
+    mirror_index = torch.roll(band_index.flip(-2, -1), shifts=(1, 1),
+                              dims=(-2, -1))
+
+    band_index = band_index[:, :w // 2 + 1]
+    mirror_index = mirror_index[:, :w // 2 + 1]
+    if torch.equal(band_index, mirror_index):
+        # always the case for even sizes
+        return band_index.to(device), None
+    return band_index.to(device), mirror_index.to(device)
+
+
+def rfft_band_index(h, w, radius_factors, device, right=False):
+    """Band index maps of the half spectrum returned by torch.fft.rfft2.
+
+    The bands are the ones of :func:`radial_band_index`, so a mask built on
+    the half spectrum matches the centered full-spectrum mask. For odd sizes
+    the centered grid is not symmetric around the zero frequency; a second
+    map holds the band of each conjugate bin so that the mask can be
+    symmetrized, which is what taking ``.real`` of the full inverse FFT does.
+
+    Args:
+        h (int): Image height.
+        w (int): Image width.
+        radius_factors (tuple[float]): Increasing band radii, relative to
+            the half diagonal of the spectrum.
+        device (torch.device): Device of the returned maps.
+        right (bool): Include the lower instead of the upper band edge.
+            Default: False.
+
+    Returns:
+        tuple[LongTensor]: Band index map with shape (h, w // 2 + 1) and the
+            one of the conjugate bins, which is None when both are equal.
+    """
+    return _rfft_band_index(h, w, tuple(radius_factors),
+                            torch.device(device), right)
+
+
+def rfft_band_mask(value_set, band_index):
+    """Build the half-spectrum frequency mask for a batch of per-band values.
+
+    Args:
+        value_set (Tensor): Per-band values with shape (b, n).
+        band_index (tuple[LongTensor]): Maps from :func:`rfft_band_index`.
+
+    Returns:
+        Tensor: Frequency mask with shape (b, h, w // 2 + 1).
+    """
+    band_index, mirror_index = band_index
+    mask = radial_band_mask(value_set, band_index)
+    if mirror_index is not None:
+        mask = 0.5 * (mask + radial_band_mask(value_set, mirror_index))
+    return mask
+
+
+def hermitian_expand(x, w):
+    """Expand a real function of a rfft2 spectrum (e.g. its magnitude) to
+    the full (h, w) spectrum, using |X(-k, -l)| = |X(k, l)|.
+
+    Args:
+        x (Tensor): Half-spectrum tensor with shape (..., h, w // 2 + 1).
+        w (int): Width of the full spectrum.
+
+    Returns:
+        Tensor: Full-spectrum tensor with shape (..., h, w).
+    """
+    n = w - x.size(-1)
+    if n == 0:
+        return x
+    # column l > w // 2 mirrors column w - l, row k mirrors row -k
+    mirror = x[..., 1:n + 1].flip(-2, -1)
+    mirror = torch.roll(mirror, shifts=1, dims=-2)
+    return torch.cat([x, mirror], dim=-1)
+
+
+
+class Random_frequency_replacing(nn.Module):
+    """Replace random radial frequency bands of the clean image by the ones
+    of the noisy image.
+
+    Band k is taken from ``noisy`` with probability
+    ``fbr_param * value_set[k]``, one draw per sample and band. The band
+    index maps are cached per patch size and device, so the module runs on
+    whatever device its inputs live on, including the CPU on the dataloader
+    side, where unbatched (C, H, W) inputs are accepted as well.
+
+    Args:
+        fbr_param (float): Scale of the band replacing probabilities.
+            Default: 0.5.
+        mode (str): Decay of the probabilities from the lowest to the
+            highest band, 'linear' or exponential otherwise.
+            Default: 'linear'.
+        rfft (bool): Mix the half spectra of torch.fft.rfft2 instead of the
+            full ones. Default: False.
+    """
+
+    def __init__(self, fbr_param=0.5, mode='linear', rfft=False):
+        super().__init__()
+
+        self.radius_factors = tuple(torch.arange(0.01, 1.01, 0.01).tolist())
+        if mode == 'linear':
+            value_set = torch.arange(1., 0., -0.01)
+        else:
+            value_set = torch.exp(torch.linspace(0, -10, 100))
+        self.fbr_param = fbr_param
+        self.register_buffer('value_prob', value_set * fbr_param,
+                             persistent=False)
+        self.rfft = rfft
+
+    @fft_float32
+    def forward(self, clean, noisy):
+        unbatched = noisy.dim() == 3
+        if unbatched:
+            clean, noisy = clean.unsqueeze(0), noisy.unsqueeze(0)
+        B, C, H, W = noisy.size()
+
+        # bands are [r_{k-1}, r_k)
+        value_prob = self.value_prob.to(noisy.device)
+        value_set = torch.bernoulli(value_prob.expand(B, -1))
+
+        # noisy*m + clean*(1-m) == clean + (noisy-clean)*m, so a single
+        # forward transform is enough. The mask is rolled over the batch like
+        # the all-dim fftshift/ifftshift of the spectra used to do.
+        diff = noisy - clean
+        if self.rfft:
+            band_index = rfft_band_index(H, W, self.radius_factors,
+                                         noisy.device, right=True)
+            fq_mask = rfft_band_mask(value_set, band_index)
+            fq_mask = torch.fft.ifftshift(fq_mask, dim=0).unsqueeze(1)
+            diff = torch.fft.irfft2(torch.fft.rfft2(diff) * fq_mask, s=(H, W))
+        else:
+            band_index = fft_band_index(H, W, self.radius_factors,
+                                        noisy.device, right=True)
+            fq_mask = radial_band_mask(value_set, band_index)
+            fq_mask = torch.fft.ifftshift(fq_mask, dim=0).unsqueeze(1)
+            diff = torch.fft.fftn(diff, dim=(-1, -2)) * fq_mask
+            diff = torch.fft.ifftn(diff, dim=(-1, -2)).real
+
+        replaced = clean + diff
+        if unbatched:
+            replaced = replaced.squeeze(0)
+        return replaced
+
+
+if __name__ == '__main__':
+    # compare the rfft2 and the full fftn masking for even and odd sizes
+    torch.manual_seed(0)
+    radius_factors = torch.arange(0.01, 1.01, 0.01).tolist()
+    for h, w in [(64, 64), (63, 65), (48, 33)]:
+        x = torch.rand(4, 3, h, w, dtype=torch.float64)
+        value_set = torch.rand(4, len(radius_factors), dtype=torch.float64)
+
+        x_fq = torch.fft.fftshift(torch.fft.fftn(x, dim=(-1, -2)))
+        fq_mask = radial_band_mask(value_set,
+                                   radial_band_index(h, w, radius_factors,
+                                                     'cpu'))
+        ref = torch.fft.ifftshift(x_fq * fq_mask.unsqueeze(1))
+        ref = torch.fft.ifftn(ref, dim=(-1, -2)).real
+        ref_mag = torch.abs(x_fq)
+
+        x_fq = torch.fft.rfft2(x)
+        fq_mask = rfft_band_mask(value_set,
+                                 rfft_band_index(h, w, radius_factors, 'cpu'))
+        out = x_fq * torch.fft.ifftshift(fq_mask, dim=0).unsqueeze(1)
+        out = torch.fft.irfft2(out, s=(h, w))
+        out_mag = torch.fft.fftshift(hermitian_expand(torch.abs(x_fq), w))
+
+        print(f'{h}x{w}: output max abs diff '
+              f'{(out - ref).abs().max().item():.3e}, magnitude max abs diff '
+              f'{(out_mag - ref_mag).abs().max().item():.3e}')
+
+    # overhead of the band replacing against the per-band mask stack it
+    # replaces, which mixes both shifted spectra
+    import time
+
+    def replacing_reference(clean, noisy, value_prob):
+        B, C, H, W = noisy.size()
+        a, b = torch.meshgrid(torch.arange(H), torch.arange(W))
+        dist = torch.sqrt((a - H / 2)**2 + (b - W / 2)**2).to(noisy.device)
+        radius_set = math.sqrt(H * H + W * W) / 2 * torch.arange(
+            0.01, 1.01, 0.01, device=noisy.device)
+        value_set = torch.bernoulli(value_prob.view(1, -1).repeat(B, 1))
+        mask = [dist < radius_set[0]]
+        for i in range(1, len(radius_set)):
+            mask.append((dist < radius_set[i]) & (dist >= radius_set[i - 1]))
+        fq_mask_set = torch.stack(mask, dim=0).to(noisy.dtype)
+        fq_mask = torch.sum(value_set[:, :, None, None] * fq_mask_set, dim=1)
+        noisy_fq = torch.fft.fftshift(torch.fft.fftn(noisy, dim=(-1, -2)))
+        clean_fq = torch.fft.fftshift(torch.fft.fftn(clean, dim=(-1, -2)))
+        replaced = noisy_fq * fq_mask.unsqueeze(1) + clean_fq * (
+            1 - fq_mask.unsqueeze(1))
+        replaced = torch.fft.ifftn(torch.fft.ifftshift(replaced),
+                                   dim=(-1, -2))
+        return replaced.real
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    for rfft in [False, True]:
+        replacing = Random_frequency_replacing(rfft=rfft).to(device)
+        clean = torch.rand(8, 3, 256, 256, device=device)
+        noisy = torch.rand(8, 3, 256, 256, device=device)
+
+        torch.manual_seed(0)
+        ref = replacing_reference(clean, noisy, replacing.value_prob)
+        torch.manual_seed(0)
+        out = replacing(clean, noisy)
+        print(f'rfft={rfft}: max abs diff {(out - ref).abs().max().item():.3e}')
+
+        for name, fn in [
+            ('reference',
+             lambda: replacing_reference(clean, noisy, replacing.value_prob)),
+            ('replacing', lambda: replacing(clean, noisy))]:
+            fn()
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+            for _ in range(20):
+                fn()
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            print(f'  {name}: {(time.time() - start) / 20 * 1000:.2f} ms')
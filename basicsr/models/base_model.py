@@ -42,7 +42,7 @@ class BaseModel():
         """Save networks and training state."""
         pass
 
-    def validation(self, dataloader, current_iter, tb_logger, save_img=False, rgb2bgr=True, use_image=True):
+    def validation(self, dataloader, current_iter, tb_logger, save_img=False, rgb2bgr=True, use_image=True, modes=None):
         """Validation function.
 
         Args:
@@ -52,12 +52,15 @@ class BaseModel():
             save_img (bool): Whether to save images. Default: False.
             rgb2bgr (bool): Whether to save images using rgb2bgr. Default: True
             use_image (bool): Whether to use saved images to compute metrics (PSNR, SSIM), if not, then use data directly from network' output. Default: True
+            modes (list[str] | None): Test conditions evaluated in the same
+                pass over the data, if the model supports them. Default: None.
         """
+        kwargs = {} if modes is None else dict(modes=modes)
         if self.opt['dist']:
-            return self.dist_validation(dataloader, current_iter, tb_logger, save_img, rgb2bgr, use_image)
+            return self.dist_validation(dataloader, current_iter, tb_logger, save_img, rgb2bgr, use_image, **kwargs)
         else:
             return self.nondist_validation(dataloader, current_iter, tb_logger,
-                                    save_img, rgb2bgr, use_image)
+                                    save_img, rgb2bgr, use_image, **kwargs)
 
     def get_current_log(self):
         return self.log_dict
@@ -66,6 +69,12 @@ class BaseModel():
         """Model to device. It also warps models with DistributedDataParallel
         or DataParallel.
 
+        Networks with parameters that do not take part in every loss (e.g.
+        auxiliary heads only trained with some options) need
+        `find_unused_parameters: true`. If the set of used parameters does
+        not change between iterations, `static_graph: true` lets DDP find
+        it once in the first iteration instead of at every step.
+
         Args:
             net (nn.Module)
         """
@@ -74,10 +83,14 @@ class BaseModel():
         if self.opt['dist']:
             find_unused_parameters = self.opt.get('find_unused_parameters',
                                                   False)
+            ddp_kwargs = {}
+            if self.opt.get('static_graph', False):
+                ddp_kwargs['static_graph'] = True
             net = DistributedDataParallel(
                 net,
                 device_ids=[torch.cuda.current_device()],
-                find_unused_parameters=find_unused_parameters)
+                find_unused_parameters=find_unused_parameters,
+                **ddp_kwargs)
         elif self.opt['num_gpu'] > 1:
             net = DataParallel(net)
         return net
@@ -14,17 +14,23 @@ from copy import deepcopy
 from os import path as osp
 from tqdm import tqdm
 import time
+from basicsr.data.data_sampler import ShardSampler
 from basicsr.models.archs import define_network
+from basicsr.models.archs.freq_util import Random_frequency_replacing
 from basicsr.models.base_model import BaseModel
-from basicsr.utils import get_root_logger, imwrite, tensor2img
+from basicsr.utils import AsyncImageWriter, get_root_logger, tensor2img
 from basicsr.utils.dist_util import get_dist_info
 from basicsr.utils.mask import Masker
+from basicsr.utils.noise_util import GaussianNoise, build_noise
+from basicsr.utils.tile_util import stream_tiled_forward, tiled_forward
 
 import matplotlib.pyplot as plt
 
 import wandb
 import sys
 
+from advertorch.context import ctx_input_grad_only
+
 # from advertorch.attacks4IP.zero_mean_pgd import L2PGDAttack
 import math
 torch.autograd.set_detect_anomaly(True)
@@ -39,84 +45,6 @@ def forward_hook(module, input, output):
     module.input = inputs
 
 
-class Random_frequency_replacing(nn.Module):
-    def __init__(self, fbr_param=0.5, mode='linear'):
-        super().__init__()
-
-   
-        self.radius_factor_set = torch.arange(0.01, 1.01, 0.01).cuda()
-        if mode == 'linear':
-            print('linear')
-            self.value_set = torch.arange(1., 0., -0.01).cuda()
-        else:
-            self.value_set = torch.exp(torch.linspace(0, -10, 100)).cuda()
-        self.fbr_param = fbr_param
-        
-
-   
-    def forward(self, clean, noisy):
-        B, C, H, W = noisy.size()
-        inp = noisy
-
-        a, b = torch.meshgrid(torch.arange(H), torch.arange(W))
-        dist = torch.sqrt((a - H/2)**2 + (b - W/2)**2)
-        dist = dist.to(noisy.device)
-        max_radius = math.sqrt(H*H+W*W)/2
-
-       
-        noisy_fq = torch.fft.fftn(noisy, dim=(-1,-2))
-        noisy_fq = torch.fft.fftshift(noisy_fq)
-        clean_fq = torch.fft.fftn(clean, dim=(-1,-2))
-        clean_fq = torch.fft.fftshift(clean_fq)
-
-
-       
-        radius_set = max_radius*self.radius_factor_set
-
-        value_prob = self.value_set.view(1, -1)
-        value_prob = value_prob.repeat(B, 1)
-
-        value_set =  torch.bernoulli(value_prob*self.fbr_param).cuda()
-        # value_set =  torch.bernoulli(torch.ones(B,len(self.radius_factor_set))*0.2).cuda()
-       
-
-        mask = []
-        # zero = torch.tensor(0.0, dtype=torch.float32).cuda()
-        zero_mask = torch.zeros_like(dist).cuda()
-        one_mask = torch.ones_like(dist).cuda()
-        for i in range(len(radius_set)):
-            if i == 0:
-                mask.append(torch.where((dist < radius_set[i]), one_mask, zero_mask))
-            else :
-                mask.append(torch.where((dist < radius_set[i]) & (dist >= radius_set[i-1]), one_mask, zero_mask))
-           
-
-        fq_mask_set = torch.stack(mask, dim=0)
-        fq_mask = value_set.unsqueeze(-1).unsqueeze(-1) * fq_mask_set.unsqueeze(0)
-        fq_mask = torch.sum(fq_mask, dim=1)
-        # print(fq_mask[0])
-    
-        # fq_mask [B,H,W]
-        # bn1이 작은 확률 --> noise에 넣어줌 
-        bn1_mask = fq_mask
-        bn2_mask = torch.ones_like(bn1_mask)-bn1_mask
-
-
-        noisy_fq = (noisy_fq*bn1_mask.unsqueeze(1))
-        clean_fq = (clean_fq*bn2_mask.unsqueeze(1))
-
-        replaced_fq = noisy_fq+clean_fq
-        replaced_fq = torch.fft.ifftshift(replaced_fq)
-
-        replaced_fq = torch.fft.ifftn(replaced_fq, dim=(-1,-2))
-
-        replaced_fq = replaced_fq.real
-        # lowpass = torch.clamp(lowpass.real, 0 , 1)
-
-
-        return replaced_fq
-
-
 class ImageRestorationModel(BaseModel):
     """Base Deblur model for single image deblur."""
 
@@ -124,17 +52,43 @@ class ImageRestorationModel(BaseModel):
         super(ImageRestorationModel, self).__init__(opt)
 
         # define network
-        self.net_g = define_network(deepcopy(opt['network_g']))
+        network_opt = deepcopy(opt['network_g'])
+        # rfft2/irfft2 for the frequency filter and replacing, not a
+        # constructor argument of every arch
+        self.rfft = network_opt.pop('rfft', False)
+        self.net_g = define_network(network_opt)
+        for module in self.net_g.modules():
+            if hasattr(module, 'rfft'):
+                module.rfft = self.rfft
         self.net_g = self.model_to_device(self.net_g)
         self.prune_rate = 0
         self.test_mode = 'Sidd'
-        self.Random_frequency_replacing = Random_frequency_replacing(fbr_param=self.opt['train']['fbr_param'], mode=self.opt['train']['fbr_mode'])
+        self.Random_frequency_replacing = Random_frequency_replacing(fbr_param=self.opt['train']['fbr_param'], mode=self.opt['train']['fbr_mode'], rfft=self.rfft).to(self.device)
         self.filter_on = 'on'
         self.masker = Masker(width = 3, mode='zero')
+        # on-device noise synthesis, train.synthetic_opt e.g. sigma_range
+        self.synthetic_noise = None
+        if self.opt['train'].get('synthetic'):
+            self.synthetic_noise = build_noise(
+                self.opt['train'].get('synthetic_type') or 'gaussian',
+                **self.opt['train'].get('synthetic_opt', {}))
+        self.test_noise = {
+            'gaussian': GaussianNoise(sigma_range=(0, 55)),
+            'unseen_noise': GaussianNoise(sigma_range=(90, 90)),
+        }
         self.mseloss =  nn.MSELoss()
         
 
         self.alpha = self.opt['train']['alpha']
+
+        # mixed precision: float16 with loss scaling on GPU, bfloat16 on CPU
+        self.amp = self.opt['train'].get('amp', False)
+        amp_dtype = self.opt['train'].get('amp_dtype', 'float16')
+        if self.device.type == 'cpu':
+            amp_dtype = 'bfloat16'
+        self.amp_dtype = getattr(torch, amp_dtype)
+        self.grad_scaler = torch.cuda.amp.GradScaler(
+            enabled=self.amp and self.amp_dtype == torch.float16)
         # eps = 5
         # patch_size=50
         # l2_adv_tr = eps*1./255 * math.sqrt(patch_size ** 2)
@@ -263,10 +217,10 @@ class ImageRestorationModel(BaseModel):
             self.gt = data['gt'].to(self.device)
 
     def grids(self):
+        """Run the next test() on overlapping crops of val.crop_size_h/w
+        (or their *_ratio), blended with val.tile_blend weights."""
         b, c, h, w = self.gt.size()
-        self.original_size = (b, c, h, w)
 
-        assert b == 1
         if 'crop_size_h' in self.opt['val']:
             crop_size_h = self.opt['val']['crop_size_h']
         else:
@@ -277,70 +231,15 @@ class ImageRestorationModel(BaseModel):
         else:
             crop_size_w = int(self.opt['val'].get('crop_size_w_ratio') * w)
 
-
-        crop_size_h, crop_size_w = crop_size_h // self.scale * self.scale, crop_size_w // self.scale * self.scale
-        #adaptive step_i, step_j
-        num_row = (h - 1) // crop_size_h + 1
-        num_col = (w - 1) // crop_size_w + 1
-
-        import math
-        step_j = crop_size_w if num_col == 1 else math.ceil((w - crop_size_w) / (num_col - 1) - 1e-8)
-        step_i = crop_size_h if num_row == 1 else math.ceil((h - crop_size_h) / (num_row - 1) - 1e-8)
-
-        scale = self.scale
-        step_i = step_i//scale*scale
-        step_j = step_j//scale*scale
-
-        parts = []
-        idxes = []
-
-        i = 0  # 0~h-1
-        last_i = False
-        while i < h and not last_i:
-            j = 0
-            if i + crop_size_h >= h:
-                i = h - crop_size_h
-                last_i = True
-
-            last_j = False
-            while j < w and not last_j:
-                if j + crop_size_w >= w:
-                    j = w - crop_size_w
-                    last_j = True
-                parts.append(self.lq[:, :, i // scale :(i + crop_size_h) // scale, j // scale:(j + crop_size_w) // scale])
-                idxes.append({'i': i, 'j': j})
-                j = j + step_j
-            i = i + step_i
-
-        self.origin_lq = self.lq
-        self.lq = torch.cat(parts, dim=0)
-        self.idxes = idxes
+        # crops are given in gt pixels, tiles in lq pixels
+        self.tile_opt = dict(
+            tile_size=(crop_size_h // self.scale, crop_size_w // self.scale),
+            overlap=self.opt['val'].get('tile_overlap', 0),
+            blend=self.opt['val'].get('tile_blend', 'hann'),
+            scale=self.scale)
 
     def grids_inverse(self):
-        preds = torch.zeros(self.original_size)
-        b, c, h, w = self.original_size
-
-        count_mt = torch.zeros((b, 1, h, w))
-        if 'crop_size_h' in self.opt['val']:
-            crop_size_h = self.opt['val']['crop_size_h']
-        else:
-            crop_size_h = int(self.opt['val'].get('crop_size_h_ratio') * h)
-
-        if 'crop_size_w' in self.opt['val']:
-            crop_size_w = self.opt['val'].get('crop_size_w')
-        else:
-            crop_size_w = int(self.opt['val'].get('crop_size_w_ratio') * w)
-
-        crop_size_h, crop_size_w = crop_size_h // self.scale * self.scale, crop_size_w // self.scale * self.scale
-
-        for cnt, each_idx in enumerate(self.idxes):
-            i = each_idx['i']
-            j = each_idx['j']
-            preds[0, :, i: i + crop_size_h, j: j + crop_size_w] += self.outs[cnt]
-            count_mt[0, 0, i: i + crop_size_h, j: j + crop_size_w] += 1.
-
-        self.output = (preds / count_mt).to(self.device)
-        self.lq = self.origin_lq
+        self.tile_opt = None
 
 
     def gaussian_fgsm(self, model, x, y, epsilon=0.1, alpha=0.03, num_iter=1):
@@ -349,92 +248,87 @@ class ImageRestorationModel(BaseModel):
         x_perturbed = x.clone().detach()
 
         # PGD attack loop
-        for t in range(num_iter):
-            # Forward pass to compute the model's output and loss
-            x_perturbed.requires_grad = True
-            
-            output = model(x_perturbed)
-
-            loss = self.cri_pix(output, y)
- 
-            # Backward pass to compute the gradient of the loss w.r.t. the input
-            model.zero_grad()
-
-            loss.backward()
-            grad = x_perturbed.grad 
-            # B,C,H,W = self.lq.size()
-            # random_noise = torch.randn(B,C,H,W).cuda() * 0.2
+        with ctx_input_grad_only(model) as net:
+            for t in range(num_iter):
+                # Forward pass to compute the model's output and loss
+                x_perturbed.requires_grad = True
 
-            B,C,H,W = self.lq.size()
-            random_noise = torch.randn(B,C,H,W).cuda()
-            adv_random_noise = torch.abs(random_noise*0.2) * torch.sign(grad)
+                output = net(x_perturbed)
 
-   
-
-            adv_random_noise = adv_random_noise.cpu().numpy()
-            adv_random_noise = adv_random_noise.reshape(adv_random_noise.shape[0], -1)
+                loss = self.cri_pix(output, y)
 
-            # plt.hist(grad.flatten(), bins=500, range = [-0.1, 1.1])
-            
+                # gradient of the loss w.r.t. the input only
+                grad, = torch.autograd.grad(loss, x_perturbed)
+                # B,C,H,W = self.lq.size()
+                # random_noise = torch.randn(B,C,H,W).cuda() * 0.2
 
-            random_noise_dist = random_noise.cpu().numpy()*0.2
-            random_noise_dist = random_noise_dist.reshape(random_noise_dist.shape[0], -1)
-    
+                # plt.hist(grad.flatten(), bins=500, range = [-0.1, 1.1])
 
+                # Add perturbation to the input
+                with torch.no_grad():
+                    random_noise = torch.randn_like(x_perturbed)
+                    x_perturbed = x_perturbed + torch.abs(random_noise*0.2) * torch.sign(grad)
+                    # x_perturbed = torch.min(torch.max(x_perturbed, x - epsilon), x + epsilon)
+                    x_perturbed = torch.clamp(x_perturbed, 0, 1)
 
-            # exit()
-            
-            # Add perturbation to the input
-            with torch.no_grad():
-                B,C,H,W = self.lq.size()
-                random_noise = torch.randn(B,C,H,W).cuda()
-                x_perturbed = x_perturbed + torch.abs(random_noise*0.2) * torch.sign(grad)
-                # x_perturbed = torch.min(torch.max(x_perturbed, x - epsilon), x + epsilon)
-                x_perturbed = torch.clamp(x_perturbed, 0, 1)
-            
-        
         return x_perturbed.detach()
 
 
-    def pgd_attack(self, model, x, y, epsilon=0.3, alpha=(16/255), num_iter=1):
+    def perturb_eps(self):
+        """Linf budget of the training attacks, train.perturb.eps in /255,
+        alpha * iter by default."""
+        perturb_opt = self.opt['train']['perturb']
+        eps = perturb_opt.get('eps')
+        if eps is None:
+            eps = perturb_opt['alpha'] * perturb_opt['iter']
+        return eps / 255
+
+    def pgd_attack(self, model, x, y, epsilon=None, alpha=(16/255), num_iter=1, rand_init=False):
     # def pgd_attack(self, model, x, y, epsilon=0.1, alpha=0.01, num_iter=40):
         B,C,H,W = x.size()
         x_pgd = x.clone().detach()
         alpha=(self.opt['train']['perturb']['alpha']/255)
         num_iter = self.opt['train']['perturb']['iter']
-        # PGD attack loop
-        for t in range(num_iter):
-            # Forward pass to compute the model's output and loss
-            x_pgd.requires_grad = True
-            
-            output = model(x_pgd)
+        if epsilon is None:
+            epsilon = self.perturb_eps()
+        if rand_init:
+            # FGSM with a random start: uniform in the eps-ball, then one
+            # 1.25 * eps step projected back on the ball
+            x_pgd = torch.clamp(x_pgd + torch.empty_like(x_pgd).uniform_(-epsilon, epsilon), 0, 1)
+            alpha, num_iter = 1.25 * epsilon, 1
+        # PGD attack loop, the weights are frozen and their gradients skipped
+        with ctx_input_grad_only(model) as net:
+            for t in range(num_iter):
+                # Forward pass to compute the model's output and loss
+                x_pgd.requires_grad = True
+
+                with self.autocast():
+                    output = net(x_pgd)
+
+                loss = self.cri_pix(output, y)
+
+                # gradient of the loss w.r.t. the input only; the scale keeps
+                # float16 gradients from underflowing, only their sign is used
+                grad, = torch.autograd.grad(self.grad_scaler.scale(loss), x_pgd)
+                # inf/nan input gradients of an overflowing float16 loss
+                grad = torch.nan_to_num(grad, posinf=0., neginf=0.)
+                # grad = torch.clamp(grad, -(25/255), 25/255)
+
+                # alpha = (torch.rand(B) * 16) * 1./255
+                # alpha = alpha.cuda()
+
+                # Add perturbation to the input
+                with torch.no_grad():
+                    # pgd_grad_mean = torch.sign(grad).mean(dim=(2,3), keepdim=True)
+                    # pgd_grad = torch.sign(grad)-pgd_grad_mean
+
+                    # x_gpd = x_pgd + torch.sign(grad) * alpha.view(-1,1,1,1)
+                    x_pgd = x_pgd + alpha * torch.sign(grad)
+                    # x_pgd = x_pgd + torch.clamp(grad, -(16/255), (16/255))
+                    x_pgd = torch.min(torch.max(x_pgd, x - epsilon), x + epsilon)
+                    x_pgd = torch.clamp(x_pgd, 0, 1)
+                    # x_pgd = torch.clamp(x_pgd + grad, 0, 1)
 
-            loss = self.cri_pix(output, y) + 0. * sum(p.sum() for p in model.parameters())
- 
-            # Backward pass to compute the gradient of the loss w.r.t. the input
-            model.zero_grad()
-
-            loss.backward()
-            # grad = torch.clamp(x_pgd.grad, -(25/255), 25/255)
-            grad = x_pgd.grad
-
-        
-            # alpha = (torch.rand(B) * 16) * 1./255
-            # alpha = alpha.cuda()
-            
-            # Add perturbation to the input
-            with torch.no_grad():
-                # pgd_grad_mean = torch.sign(grad).mean(dim=(2,3), keepdim=True)
-                # pgd_grad = torch.sign(grad)-pgd_grad_mean
-
-                # x_gpd = x_pgd + torch.sign(grad) * alpha.view(-1,1,1,1)
-                x_pgd = x_pgd + alpha * torch.sign(grad)
-                # x_pgd = x_pgd + torch.clamp(grad, -(16/255), (16/255))
-                x_pgd = torch.min(torch.max(x_pgd, x - epsilon), x + epsilon)
-                x_pgd = torch.clamp(x_pgd, 0, 1)
-                # x_pgd = torch.clamp(x_pgd + grad, 0, 1)
-            
-        
         return x_pgd.detach()
 
 
@@ -458,37 +352,71 @@ class ImageRestorationModel(BaseModel):
 
         return data_adv, noise
         
-    def genearte_poisson_noise(self):
-        B,C,H,W = self.lq.size()
-        sigma = (torch.rand(B) * 55) * 1./255
-        sigma = sigma.cuda()
-        noise = torch.from_numpy(np.random.poisson(lam=1, size=(B,C,H, W))).float().cuda()
-        noise = (noise - noise.mean()) / noise.std() * sigma.view(-1,1,1,1)
-        return noise
-
-    def genearte_gaussian_noise(self):
-        B,C,H,W = self.lq.size()
-        sigma = (torch.rand(B) * 55) * 1./255
-        sigma = sigma.cuda()
-        random_noise = torch.randn(B,C,H,W).cuda()
-        noise = random_noise * sigma.view(-1,1,1,1)
-        return noise
 
+    def net_g_forward(self, *inputs):
+        """Run batches through net_g in a single concatenated forward.
+
+        Returns:
+            tuple[list[Tensor]]: Outputs and feautre_to_img1 feature maps
+                (None without train.feature), split back per batch.
+        """
+        with self.autocast():
+            preds = self.net_g(torch.cat(inputs, dim=0) if len(inputs) > 1 else inputs[0])
+        sizes = [len(x) for x in inputs]
+        preds = preds.split(sizes)
+
+        features = [None] * len(inputs)
+        if self.opt['train']['feature']:
+            for name, module in self.net_g.named_modules():
+                if name == 'module.feautre_to_img1':
+                    features = module.feature_map.split(sizes)
+        return preds, features
+
+    def free_adv_example(self):
+        """Adversarial batch of free adversarial training: the perturbation is
+        carried over from the previous iteration and only updated with the input
+        gradient of the training backward, see update_free_adv."""
+        delta = getattr(self, 'free_delta', None)
+        if delta is None or delta.shape != self.lq.shape:
+            delta = torch.zeros_like(self.lq)
+        adv = torch.clamp(self.lq + delta, 0, 1)
+        return adv.requires_grad_(True)
+
+    def update_free_adv(self, adv, epsilon=None):
+        alpha = self.opt['train']['perturb']['alpha'] / 255
+        if epsilon is None:
+            epsilon = self.perturb_eps()
+        with torch.no_grad():
+            # inf/nan input gradients of a skipped float16 step
+            grad = torch.nan_to_num(adv.grad, posinf=0., neginf=0.)
+            adv = torch.clamp(adv + alpha * torch.sign(grad), 0, 1)
+            self.free_delta = torch.clamp(adv - self.lq, -epsilon, epsilon)
+
+    def autocast(self):
+        """Autocast context of the network forwards, a no-op unless
+        train.amp is set."""
+        return torch.autocast(self.device.type, dtype=self.amp_dtype,
+                              enabled=self.amp)
 
     def optimize_parameters(self, current_iter, tb_logger):
         
-        if self.opt['train']['synthetic']:
-            if self.opt['train']['synthetic_type'] == 'poisson':
-                noise = self.genearte_poisson_noise()
-            else : 
-                noise = self.genearte_gaussian_noise()
-                
-            self.lq = torch.clamp(self.gt+ noise.cuda(), 0, 1)
+        if self.synthetic_noise is not None:
+            self.lq = self.synthetic_noise(self.gt)
 
         
 
-        if self.opt['train']['adv']:
-            adv = self.pgd_attack(self.net_g, self.lq, self.gt)
+        train_opt = self.opt['train']
+        adv_mode = train_opt.get('adv_mode', 'pgd')
+        if train_opt['adv']:
+            if adv_mode == 'free':
+                adv = self.free_adv_example()
+            else:
+                adv = self.pgd_attack(self.net_g, self.lq, self.gt, rand_init=adv_mode == 'fast')
+        # clean and adversarial batches in one forward, opt-in: it is only
+        # equivalent to separate forwards for networks without batch-coupled
+        # layers, i.e. no BatchNorm (DnCNN) and no frequency filter of
+        # freq_util, which mixes samples across the batch
+        concat = train_opt['adv'] and train_opt.get('concat_forward', False)
         
         self.optimizer_g.zero_grad()
         self.optimizer_g_filter.zero_grad()
@@ -497,7 +425,10 @@ class ImageRestorationModel(BaseModel):
             self.mixup_aug()
 
         loss_dict = OrderedDict()
-        preds = self.net_g(self.lq)
+        if concat:
+            (preds, adv_preds), (preds_feature, adv_preds_feature) = self.net_g_forward(self.lq, adv)
+        else:
+            (preds,), (preds_feature,) = self.net_g_forward(self.lq)
 
     
         l_pix = 0.
@@ -506,11 +437,6 @@ class ImageRestorationModel(BaseModel):
 
 
         if self.opt['train']['feature']:
-            for name, module in self.net_g.named_modules():
-                if name == 'module.feautre_to_img1':
-                    preds_feature = module.feature_map
-                    
-
             l_pix_feature = 0.
             l_pix_feature += self.cri_pix(preds_feature, self.gt)
             loss_dict['l_gaussian_0_55_feature'] = l_pix_feature
@@ -518,50 +444,44 @@ class ImageRestorationModel(BaseModel):
 
         if self.opt['train']['fq_aug']:
             fq_replaced = self.Random_frequency_replacing(preds, self.lq)
-            preds_replaced = self.net_g(fq_replaced)
+            if concat:
+                adv_fq_replaced = self.Random_frequency_replacing(adv_preds, adv)
+                (preds_replaced, adv_preds_replaced), (preds_repalced_feature, adv_preds_repalced_feature) = \
+                    self.net_g_forward(fq_replaced, adv_fq_replaced)
+            else:
+                (preds_replaced,), (preds_repalced_feature,) = self.net_g_forward(fq_replaced)
             l_pix_replaced = 0.
             l_pix_replaced += self.cri_pix(preds_replaced, self.gt)
             loss_dict['l_lq_replaced'] = l_pix_replaced
 
             if self.opt['train']['feature']:
-                for name, module in self.net_g.named_modules():
-                    if name == 'module.feautre_to_img1':
-                        preds_repalced_feature = module.feature_map
-
                 l_pix_replaced_feature = 0.
                 l_pix_replaced_feature += self.cri_pix(preds_repalced_feature, self.gt)
                 loss_dict['l_gaussian_0_55_replaced_feature'] = l_pix_replaced_feature
 
     
         if self.opt['train']['adv']:
+            if not concat:
+                (adv_preds,), (adv_preds_feature,) = self.net_g_forward(adv)
             l_adv = 0.
-            adv_preds = self.net_g(adv)
             l_adv += self.cri_pix(adv_preds, preds)
             loss_dict['l_adv'] = l_adv
             
 
             if self.opt['train']['feature']:
-                for name, module in self.net_g.named_modules():
-                    if name == 'module.feautre_to_img1':
-                        adv_preds_feature = module.feature_map
-                        
-
                 l_adv_feature = 0.
                 l_adv_feature += self.cri_pix(adv_preds_feature, preds)
                 loss_dict['l_adv_feature'] = l_adv_feature
 
             if self.opt['train']['fq_aug']:
-                adv_fq_replaced = self.Random_frequency_replacing(adv_preds, adv)
-                adv_preds_replaced = self.net_g(adv_fq_replaced)
+                if not concat:
+                    adv_fq_replaced = self.Random_frequency_replacing(adv_preds, adv)
+                    (adv_preds_replaced,), (adv_preds_repalced_feature,) = self.net_g_forward(adv_fq_replaced)
                 l_adv_replaced = 0.
                 l_adv_replaced += self.cri_pix(adv_preds_replaced, preds)
                 loss_dict['l_adv_replaced'] = l_adv_replaced
                 
                 if self.opt['train']['feature']:
-                    for name, module in self.net_g.named_modules():
-                        if name == 'module.feautre_to_img1':
-                            adv_preds_repalced_feature = module.feature_map
-
                     l_adv_replaced_feature = 0.
                     l_adv_replaced_feature += self.cri_pix(adv_preds_repalced_feature, preds)
                     loss_dict['l_adv_replaced_feature'] = l_adv_replaced_feature
@@ -578,31 +498,44 @@ class ImageRestorationModel(BaseModel):
                     l_feature = ( l_pix_feature * self.alpha + l_adv_feature * (1-self.alpha) )
                     l_replaced_feature =  ( l_pix_replaced_feature * self.alpha + l_adv_replaced_feature * (1-self.alpha))
                     l_total_feature = l_feature + l_replaced_feature
-                    l_total = loss_adv + loss_adv_replaced + 0.1*l_total_feature + 0. * sum(p.sum() for p in self.net_g.parameters())
+                    l_total = loss_adv + loss_adv_replaced + 0.1*l_total_feature
                 else : 
                 
-                    l_total = loss_adv + loss_adv_replaced + 0. * sum(p.sum() for p in self.net_g.parameters())
+                    l_total = loss_adv + loss_adv_replaced
             
             else:
-                l_total = loss_adv + 0. * sum(p.sum() for p in self.net_g.parameters())
+                l_total = loss_adv
         else : 
             if self.opt['train']['fq_aug']:
-                l_total =  l_pix + l_pix_replaced  + 0. * sum(p.sum() for p in self.net_g.parameters())
+                l_total =  l_pix + l_pix_replaced
             else:
-                l_total = l_pix + 0. * sum(p.sum() for p in self.net_g.parameters())
+                l_total = l_pix
 
         # loss_adv = ( l_pix * 1./(1+self.alpha) + l_adv * self.alpha/(1+self.alpha) ) 
         # loss_adv_replaced = ( l_pix_replaced * 1./(1+self.alpha) + l_adv_replaced * self.alpha/(1+self.alpha) ) 
         # l_total = loss_adv  + loss_adv_replaced + 0. * sum(p.sum() for p in self.net_g.parameters())
 
 
-        l_total.backward()
+        self.grad_scaler.scale(l_total).backward()
             
+        # the grad scaler refuses optimizers without gradients, e.g. the
+        # filter one when the network has no filter
+        optimizers = [
+            optimizer for optimizer in (self.optimizer_g, self.optimizer_g_filter)
+            if any(p.grad is not None for group in optimizer.param_groups
+                   for p in group['params'])
+        ]
         use_grad_clip = self.opt['train'].get('use_grad_clip', True)
         if use_grad_clip:
+            for optimizer in optimizers:
+                self.grad_scaler.unscale_(optimizer)
             torch.nn.utils.clip_grad_norm_(self.net_g.parameters(), 0.01)
-        self.optimizer_g.step()
-        self.optimizer_g_filter.step()
+        for optimizer in optimizers:
+            self.grad_scaler.step(optimizer)
+        self.grad_scaler.update()
+
+        if self.opt['train']['adv'] and adv_mode == 'free':
+            self.update_free_adv(adv)
 
         # replacement
 
@@ -635,32 +568,91 @@ class ImageRestorationModel(BaseModel):
    
 
 
-    def test(self):
+    def net_forward(self, x):
+        pred = self.net_g(x)
+        if isinstance(pred, list):
+            pred = pred[-1]
+        return pred
+
+    def stream_test(self, src, dst, strip_height=None):
+        """Denoise an image too large for memory, strip by strip.
+
+        Tiles are val.crop_size_h/w (in gt pixels, 512 by default) with
+        val.tile_overlap and val.tile_blend, see grids().
+
+        Args:
+            src (ndarray): uint8 RGB input with shape (h, w, c), e.g. a
+                np.memmap.
+            dst (ndarray): uint8 RGB output with shape
+                (h * scale, w * scale, c).
+            strip_height (int | None): Input rows per strip, the tile height
+                if None. Default: None.
+        """
+        val_opt = self.opt['val']
+        tile_size = (val_opt.get('crop_size_h', 512) // self.scale,
+                     val_opt.get('crop_size_w', 512) // self.scale)
+
+        self.net_g.eval()
+        stream_tiled_forward(
+            self.net_forward, src, dst, tile_size,
+            overlap=val_opt.get('tile_overlap', 0),
+            blend=val_opt.get('tile_blend', 'hann'),
+            max_minibatch=val_opt.get('max_minibatch'),
+            scale=self.scale, strip_height=strip_height, device=self.device)
         self.net_g.train()
 
-        if self.test_mode == 'real':
-            self.lq = self.lq
-        elif self.test_mode == 'adv':
-            self.lq = self.pgd_attack(self.net_g, self.gt, self.gt)
-        elif self.test_mode =='gaussian':
-  
-            B,C,H,W = self.lq.size()
-            random_noise = torch.randn(B,C,H,W).cuda()
-            sigma = (torch.rand(B) * 55) * 1./255
-            sigma = sigma.cuda()
-            noise = random_noise * sigma.view(-1,1,1,1)
-            noise = noise.cuda()
-            self.lq = torch.clamp(self.gt+ noise, 0, 1)
-            # random_noise = torch.randn(B,C,H,W).cuda()
-            # self.lq = torch.clamp(self.lq+ random_noise*0.2, 0, 1)
-        elif self.test_mode =='unseen_noise':
-            B,C,H,W = self.lq.size()
-            random_noise = torch.randn(B,C,H,W).cuda()
-            self.lq = torch.clamp(self.gt+ random_noise*(90/255), 0, 1)
-        else:
-            self.lq = self.lq
+    def test_input(self, mode):
+        """Network input of a test condition: the loaded lq, or an input
+        synthesized from gt for the 'adv', 'gaussian' and 'unseen_noise'
+        modes."""
+        if mode == 'adv':
+            return self.pgd_attack(self.net_g, self.gt, self.gt)
+        elif mode in self.test_noise:
+            return self.test_noise[mode](self.gt)
+        return self.lq
+
+    def test_conditions(self, modes):
+        """Run several test conditions on the current data.
+
+        The inputs of all conditions are made first and those of the same
+        shape go through the network as one batch.
+
+        Returns:
+            OrderedDict: Test mode to its (input, output) pair.
+        """
+        self.net_g.train()
+        inputs = OrderedDict((mode, self.test_input(mode)) for mode in modes)
+
+        groups = OrderedDict()
+        for mode, lq in inputs.items():
+            groups.setdefault(lq.shape, []).append(mode)
+        results = OrderedDict()
+        for group in groups.values():
+            self.lq = torch.cat([inputs[mode] for mode in group], dim=0)
+            self.forward_test()
+            outputs = self.output.split(len(inputs[group[0]]), dim=0)
+            for mode, output in zip(group, outputs):
+                results[mode] = (inputs[mode], output)
+        return OrderedDict((mode, results[mode]) for mode in modes)
 
+    def test(self):
+        self.net_g.train()
+        self.lq = self.test_input(self.test_mode)
+        self.forward_test()
+
+    def forward_test(self):
+        """Run the network on self.lq in eval mode, into self.output."""
         self.net_g.eval()
+
+        if getattr(self, 'tile_opt', None):
+            with torch.no_grad():
+                self.output = tiled_forward(
+                    self.net_forward, self.lq,
+                    max_minibatch=self.opt['val'].get('max_minibatch'),
+                    **self.tile_opt)
+            self.net_g.train()
+            return
+
         with torch.no_grad():
             n = len(self.lq)
             outs = []
@@ -673,111 +665,144 @@ class ImageRestorationModel(BaseModel):
                 pred = self.net_g(self.lq[i:j])
                 if isinstance(pred, list):
                     pred = pred[-1]
-                outs.append(pred.detach().cpu())
+                # stays on the device for the metrics, see get_current_visuals
+                outs.append(pred.detach())
                 i = j
 
             self.output = torch.cat(outs, dim=0)
         self.net_g.train()
 
-    def dist_validation(self, dataloader, current_iter, tb_logger, save_img, rgb2bgr, use_image):
+    device_metric_types = {
+        'calculate_psnr': metric_module.calculate_psnr_pt,
+        'calculate_ssim': metric_module.calculate_ssim_pt,
+    }
+
+    def dist_validation(self, dataloader, current_iter, tb_logger, save_img, rgb2bgr, use_image, modes=None):
+        """Validate every test condition of ``modes`` (the current test mode
+        if None) in one pass over the data, see :meth:`test_conditions`.
+        Metrics are reported per condition as ``<metric>_<mode>``."""
         dataset_name = dataloader.dataset.opt['name']
+        modes = list(modes or [self.test_mode])
         with_metrics = self.opt['val'].get('metrics') is not None
         if with_metrics:
             self.metric_results = {
-                metric: 0
+                f'{metric}_{mode}': 0
+                for mode in modes
                 for metric in self.opt['val']['metrics'].keys()
             }
+        # psnr/ssim of whole batches on the device, other metrics on the host
+        device_metrics = {}
+        if with_metrics and self.opt['val'].get('metrics_on_device', False):
+            for name, opt_ in self.opt['val']['metrics'].items():
+                if opt_['type'] in self.device_metric_types:
+                    device_metrics[name] = opt_
+        host_metrics = {
+            name: opt_
+            for name, opt_ in (self.opt['val'].get('metrics') or {}).items()
+            if name not in device_metrics
+        }
 
         rank, world_size = get_dist_info()
+        # batched loaders may hand each rank its own images already
+        sharded = isinstance(dataloader.sampler, ShardSampler)
         if rank == 0:
-            pbar = tqdm(total=len(dataloader), unit='image')
+            pbar = tqdm(total=len(dataloader.dataset), unit='image')
+        if save_img:
+            # png encoding overlaps with the next forwards
+            writer = AsyncImageWriter(
+                num_workers=self.opt['val'].get('save_img_workers', 2),
+                png_compression=self.opt['val'].get('png_compression', 3))
 
         cnt = 0
 
-        for idx, val_data in enumerate(dataloader):
-            if idx % world_size != rank:
-                continue
-
-            img_name = osp.splitext(osp.basename(val_data['lq_path'][0]))[0]
-
-            self.feed_data(val_data, is_val=True)
-            if self.opt['val'].get('grids', False):
-                self.grids()
-
-            self.test()
-
-            if self.opt['val'].get('grids', False):
-                self.grids_inverse()
-
-            visuals = self.get_current_visuals()
-            sr_img = tensor2img([visuals['result']], rgb2bgr=rgb2bgr)
-            if 'gt' in visuals:
-                gt_img = tensor2img([visuals['gt']], rgb2bgr=rgb2bgr)
-                del self.gt
-
-            # tentative for out of GPU memory
-            del self.lq
-            del self.output
-            torch.cuda.empty_cache()
+        # queued images are written and the threads stopped even if a
+        # forward fails
+        try:
+            for idx, val_batch in enumerate(dataloader):
+                if not sharded and idx % world_size != rank:
+                    continue
 
-            if save_img:
-                if sr_img.shape[2] == 6:
-                    L_img = sr_img[:, :, :3]
-                    R_img = sr_img[:, :, 3:]
-
-                    # visual_dir = osp.join('visual_results', dataset_name, self.opt['name'])
-                    visual_dir = osp.join(self.opt['path']['visualization'], dataset_name)
-
-                    imwrite(L_img, osp.join(visual_dir, f'{img_name}_L.png'))
-                    imwrite(R_img, osp.join(visual_dir, f'{img_name}_R.png'))
-                else:
-                    if self.opt['is_train']:
-
-                        save_img_path = osp.join(self.opt['path']['visualization'],
-                                                 img_name,
-                                                 f'{img_name}_{current_iter}.png')
-
-                        save_gt_img_path = osp.join(self.opt['path']['visualization'],
-                                                 img_name,
-                                                 f'{img_name}_{current_iter}_gt.png')
-                    else:
-                        save_img_path = osp.join(
-                            self.opt['path']['visualization'], dataset_name,
-                            f'{img_name}.png')
-                        save_gt_img_path = osp.join(
-                            self.opt['path']['visualization'], dataset_name,
-                            f'{img_name}_gt.png')
-
-                    imwrite(sr_img, save_img_path)
-                    imwrite(gt_img, save_gt_img_path)
-
-            if with_metrics:
-                # calculate metrics
-                opt_metric = deepcopy(self.opt['val']['metrics'])
-                if use_image:
-                    for name, opt_ in opt_metric.items():
-                        metric_type = opt_.pop('type')
-                        self.metric_results[name] += getattr(
-                            metric_module, metric_type)(sr_img, gt_img, **opt_)
-                else:
-                    for name, opt_ in opt_metric.items():
-                        metric_type = opt_.pop('type')
-                        self.metric_results[name] += getattr(
-                            metric_module, metric_type)(visuals['result'], visuals['gt'], **opt_)
-
-            cnt += 1
+                # a list of same-shaped batches with shape_grouped_collate
+                groups = val_batch if isinstance(val_batch, list) else [val_batch]
+                for val_data in groups:
+                    base_names = [osp.splitext(osp.basename(path))[0]
+                                  for path in val_data['lq_path']]
+
+                    self.feed_data(val_data, is_val=True)
+                    if self.opt['val'].get('grids', False):
+                        self.grids()
+
+                    conditions = self.test_conditions(modes)
+
+                    if self.opt['val'].get('grids', False):
+                        self.grids_inverse()
+
+                    for mode, (self.lq, self.output) in conditions.items():
+                        if device_metrics:
+                            with torch.no_grad():
+                                for name, opt_ in deepcopy(device_metrics).items():
+                                    metric_fn = self.device_metric_types[opt_.pop('type')]
+                                    opt_.pop('input_order', None)
+                                    # uint8 levels and channel order like the
+                                    # images of tensor2img, raw tensors otherwise
+                                    self.metric_results[f'{name}_{mode}'] += metric_fn(
+                                        self.output, self.gt, quantize=use_image,
+                                        rgb2bgr=use_image and rgb2bgr,
+                                        **opt_).sum()
+
+                        visuals = self.get_current_visuals()
+                        for i, base_name in enumerate(base_names):
+                            img_name = base_name if len(modes) == 1 else f'{base_name}_{mode}'
+                            result = visuals['result'][i:i + 1]
+                            if 'gt' in visuals:
+                                gt = visuals['gt'][i:i + 1]
+                            if save_img or host_metrics:
+                                sr_img = tensor2img([result], rgb2bgr=rgb2bgr)
+                                if 'gt' in visuals:
+                                    gt_img = tensor2img([gt], rgb2bgr=rgb2bgr)
+
+                            if save_img:
+                                self._save_val_images(writer, sr_img, gt_img, img_name,
+                                                      dataset_name, current_iter)
+
+                            if host_metrics:
+                                # calculate metrics
+                                opt_metric = deepcopy(host_metrics)
+                                if use_image:
+                                    for name, opt_ in opt_metric.items():
+                                        metric_type = opt_.pop('type')
+                                        self.metric_results[f'{name}_{mode}'] += getattr(
+                                            metric_module, metric_type)(sr_img, gt_img, **opt_)
+                                else:
+                                    for name, opt_ in opt_metric.items():
+                                        metric_type = opt_.pop('type')
+                                        self.metric_results[f'{name}_{mode}'] += getattr(
+                                            metric_module, metric_type)(result, gt, **opt_)
+
+                    # tentative for out of GPU memory
+                    if hasattr(self, 'gt'):
+                        del self.gt
+                    del self.lq
+                    del self.output
+                    del conditions
+                    if torch.cuda.is_available():
+                        torch.cuda.empty_cache()
+
+                    cnt += len(base_names)
+                    if rank == 0:
+                        pbar.update(len(base_names) * world_size)
+                        pbar.set_description(f'Test {base_names[-1]}')
             if rank == 0:
-                for _ in range(world_size):
-                    pbar.update(1)
-                    pbar.set_description(f'Test {img_name}')
-        if rank == 0:
-            pbar.close()
+                pbar.close()
+        finally:
+            if save_img:
+                writer.close()
 
         # current_metric = 0.
         collected_metrics = OrderedDict()
         if with_metrics:
             for metric in self.metric_results.keys():
-                collected_metrics[metric] = torch.tensor(self.metric_results[metric]).float().to(self.device)
+                collected_metrics[metric] = torch.as_tensor(self.metric_results[metric]).float().to(self.device)
             collected_metrics['cnt'] = torch.tensor(cnt).float().to(self.device)
 
             self.collected_metrics = collected_metrics
@@ -785,11 +810,8 @@ class ImageRestorationModel(BaseModel):
         keys = []
         metrics = []
         for name, value in self.collected_metrics.items():
-            if name != 'cnt':
-                keys.append(name+'_'+self.test_mode)
-            else : 
-                keys.append(name)
-            # keys.append(name)
+            # metric names carry their test mode already
+            keys.append(name)
             metrics.append(value)
         metrics = torch.stack(metrics, 0)
         torch.distributed.reduce(metrics, dst=0)
@@ -809,6 +831,38 @@ class ImageRestorationModel(BaseModel):
                                                tb_logger, metrics_dict)
         return 0.
 
+    def _save_val_images(self, writer, sr_img, gt_img, img_name, dataset_name,
+                         current_iter):
+        if sr_img.shape[2] == 6:
+            L_img = sr_img[:, :, :3]
+            R_img = sr_img[:, :, 3:]
+
+            # visual_dir = osp.join('visual_results', dataset_name, self.opt['name'])
+            visual_dir = osp.join(self.opt['path']['visualization'], dataset_name)
+
+            writer.write(L_img, osp.join(visual_dir, f'{img_name}_L.png'))
+            writer.write(R_img, osp.join(visual_dir, f'{img_name}_R.png'))
+        else:
+            if self.opt['is_train']:
+
+                save_img_path = osp.join(self.opt['path']['visualization'],
+                                         img_name,
+                                         f'{img_name}_{current_iter}.png')
+
+                save_gt_img_path = osp.join(self.opt['path']['visualization'],
+                                         img_name,
+                                         f'{img_name}_{current_iter}_gt.png')
+            else:
+                save_img_path = osp.join(
+                    self.opt['path']['visualization'], dataset_name,
+                    f'{img_name}.png')
+                save_gt_img_path = osp.join(
+                    self.opt['path']['visualization'], dataset_name,
+                    f'{img_name}_gt.png')
+
+            writer.write(sr_img, save_img_path)
+            writer.write(gt_img, save_gt_img_path)
+
     def nondist_validation(self, *args, **kwargs):
         logger = get_root_logger()
         logger.warning('nondist_validation is not implemented. Run dist_validation.')
@@ -0,0 +1,116 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2022 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+# Modified from BasicSR (https://github.com/xinntao/BasicSR)
+# Copyright 2018-2020 BasicSR Authors
+# ------------------------------------------------------------------------
+"""PSNR-vs-epsilon curves of a model under PGD, one per test dataset.
+
+Every validation image is attacked with the grid of the ``robustness``
+options, see pgd_sweep, and the strongest step size per epsilon is kept.
+
+    python basicsr/robustness.py -opt options/test/SIDD/NAFNet-width64.yml
+"""
+import logging
+import torch
+from os import path as osp
+
+from basicsr.data import create_dataloader, create_dataset
+from basicsr.data.data_sampler import ShardSampler
+from basicsr.mode_train import parse_options
+from basicsr.models import create_model
+from basicsr.utils import (get_env_info, get_root_logger, get_time_str,
+                           make_exp_dirs)
+from basicsr.utils.dist_util import get_dist_info
+from basicsr.utils.options import dict2str
+from basicsr.utils.robust_util import RobustnessCurve, pgd_sweep
+
+
+def main():
+    # parse options, set distributed setting, set ramdom seed
+    opt = parse_options(is_train=False)
+
+    torch.backends.cudnn.benchmark = True
+
+    make_exp_dirs(opt)
+    log_file = osp.join(opt['path']['log'],
+                        f"robustness_{opt['name']}_{get_time_str()}.log")
+    logger = get_root_logger(
+        logger_name='basicsr', log_level=logging.INFO, log_file=log_file)
+    logger.info(get_env_info())
+    logger.info(dict2str(opt))
+
+    sweep_opt = opt.get('robustness', {})
+    # budgets and step sizes in /255 units, as train.perturb
+    epsilons = [e / 255. for e in sweep_opt.get('epsilons', [0, 1, 2, 4, 8])]
+    step_sizes = sweep_opt.get('step_sizes')
+    if step_sizes is not None:
+        step_sizes = [s / 255. for s in step_sizes]
+    source = sweep_opt.get('source', 'gt')
+
+    test_loaders = []
+    for phase, dataset_opt in sorted(opt['datasets'].items()):
+        if 'test' in phase:
+            dataset_opt['phase'] = 'test'
+        test_set = create_dataset(dataset_opt)
+        test_loader = create_dataloader(
+            test_set,
+            dataset_opt,
+            num_gpu=opt['num_gpu'],
+            dist=opt['dist'],
+            sampler=None,
+            seed=opt['manual_seed'])
+        logger.info(
+            f"Number of test images in {dataset_opt['name']}: {len(test_set)}")
+        test_loaders.append(test_loader)
+
+    model = create_model(opt)
+    model.net_g.eval()
+    rank, world_size = get_dist_info()
+
+    for test_loader in test_loaders:
+        dataset_name = test_loader.dataset.opt['name']
+        logger.info(f'Robustness sweep on {dataset_name}...')
+        curve = RobustnessCurve(epsilons, step_sizes)
+        # batched loaders may hand each rank its own images already
+        sharded = isinstance(test_loader.sampler, ShardSampler)
+        for idx, val_data in enumerate(test_loader):
+            if not sharded and idx % world_size != rank:
+                continue
+            # shape_grouped_collate yields a list of same-shape groups
+            groups = val_data if isinstance(val_data, list) else [val_data]
+            for data in groups:
+                model.feed_data(data, is_val=True)
+                x = model.gt if source == 'gt' else model.lq
+                curve.update(
+                    pgd_sweep(
+                        model.net_g, x, model.gt, epsilons, step_sizes,
+                        nb_iter=sweep_opt.get('nb_iter', 1),
+                        restarts=sweep_opt.get('restarts', 1),
+                        norm=sweep_opt.get('norm', 'inf'),
+                        rand_init=sweep_opt.get('rand_init', False),
+                        max_minibatch=sweep_opt.get('max_minibatch'),
+                        quantize=opt['val'].get('use_image', True)))
+
+        if world_size > 1:
+            stats = torch.cat([curve.psnr_sum.flatten(),
+                               torch.tensor([curve.count]).double()])
+            stats = stats.to(model.device)
+            torch.distributed.reduce(stats, dst=0)
+            curve.psnr_sum = stats[:-1].cpu().view_as(curve.psnr_sum)
+            curve.count = int(stats[-1].item())
+        if rank != 0:
+            continue
+
+        log_str = f'PSNR vs epsilon on {dataset_name}:\n'
+        for eps, psnr in zip(epsilons, curve.curve().tolist()):
+            log_str += f'\t # eps {eps * 255:g}/255: {psnr:.4f}\n'
+        logger.info(log_str)
+        curve.save(
+            osp.join(opt['path']['results_root'],
+                     f'robustness_{dataset_name}'),
+            title=f"{opt['name']} on {dataset_name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,8 @@
 # Copyright 2018-2020 BasicSR Authors
 # ------------------------------------------------------------------------
 from .file_client import FileClient
-from .img_util import crop_border, imfrombytes, img2tensor, imwrite, tensor2img, padding
+from .img_util import (AsyncImageWriter, PNGStripWriter, crop_border,
+                       imfrombytes, img2tensor, imwrite, tensor2img, padding)
 from .logger import (MessageLogger, get_env_info, get_root_logger,
                      init_tb_logger, init_wandb_logger)
 from .misc import (check_resume, get_time_str, make_exp_dirs, mkdir_and_rename,
@@ -21,6 +22,8 @@ __all__ = [
     'imfrombytes',
     'imwrite',
     'crop_border',
+    'AsyncImageWriter',
+    'PNGStripWriter',
     # logger.py
     'MessageLogger',
     'init_tb_logger',
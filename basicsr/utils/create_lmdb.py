@@ -9,6 +9,7 @@ from os import path as osp
 
 from basicsr.utils import scandir
 from basicsr.utils.lmdb_util import make_lmdb_from_imgs
+from basicsr.utils.mmap_util import make_mmap_from_imgs
 
 def prepare_keys(folder_path, suffix='png'):
     """Prepare image path list and keys for DIV2K dataset.
@@ -131,3 +132,20 @@ def create_lmdb_for_SIDD():
     img_path_list, keys = prepare_keys(folder_path, 'png')
     make_lmdb_from_imgs(folder_path, lmdb_path, img_path_list, keys)
     '''
+
+
+def create_mmap_for_SIDD():
+    """Decoded uint8 counterpart of create_lmdb_for_SIDD, for the 'mmap'
+    io_backend."""
+    folder_path = '/data/sidd/train/input_crops'
+    mmap_path = '/data/sidd/train/input_crops.mmap'
+
+    img_path_list, keys = prepare_keys(folder_path, 'PNG')
+    make_mmap_from_imgs(folder_path, mmap_path, img_path_list, keys)
+
+    folder_path = '/data/sidd/train/gt_crops'
+    mmap_path = '/data/sidd/train/gt_crops.mmap'
+
+    img_path_list, keys = prepare_keys(folder_path, 'PNG')
+    make_mmap_from_imgs(folder_path, mmap_path, img_path_list, keys)
+
@@ -5,7 +5,11 @@
 # Copyright 2018-2020 BasicSR Authors
 # ------------------------------------------------------------------------
 # Modified from https://github.com/open-mmlab/mmcv/blob/master/mmcv/fileio/file_client.py  # noqa: E501
+import os
 from abc import ABCMeta, abstractmethod
+from os import path as osp
+
+import numpy as np
 
 
 class BaseStorageBackend(metaclass=ABCMeta):
@@ -107,7 +111,7 @@ class LmdbBackend(BaseStorageBackend):
                  readahead=False,
                  **kwargs):
         try:
-            import lmdb
+            import lmdb  # noqa: F401
         except ImportError:
             raise ImportError('Please install lmdb to enable LmdbBackend.')
 
@@ -122,17 +126,44 @@ class LmdbBackend(BaseStorageBackend):
             'client_keys and db_paths should have the same length, '
             f'but received {len(client_keys)} and {len(self.db_paths)}.')
 
-        self._client = {}
+        self.client_keys = client_keys
+        self._env_kwargs = dict(
+            readonly=readonly,
+            lock=lock,
+            readahead=readahead,
+            map_size=8*1024*10485760,
+            # max_readers=1,
+            **kwargs)
+        self._open()
+
+    def _open(self):
+        """Open the envs and one long-lived read txn per env.
+
+        lmdb envs and txns must not be used across fork, so they are opened
+        again when the backend is used from another process, e.g. a
+        dataloader worker forked after the dataset created its FileClient.
+        """
+        import lmdb
 
-        for client, path in zip(client_keys, self.db_paths):
-            self._client[client] = lmdb.open(
-                path,
-                readonly=readonly,
-                lock=lock,
-                readahead=readahead,
-                map_size=8*1024*10485760,
-                # max_readers=1,
-                **kwargs)
+        # keep the parent's handles alive, closing them in the child would
+        # touch state shared with the parent
+        self._parent_handles = getattr(self, '_client', None)
+        self._pid = os.getpid()
+        self._client = {}
+        self._txn = {}
+        for client, path in zip(self.client_keys, self.db_paths):
+            self._client[client] = lmdb.open(path, **self._env_kwargs)
+            # buffers=True: values are memoryviews into the map, valid as
+            # long as the txn
+            self._txn[client] = self._client[client].begin(
+                write=False, buffers=True)
+
+    def _get_txn(self, client_key):
+        if os.getpid() != self._pid:
+            self._open()
+        assert client_key in self._txn, (f'client_key {client_key} is not '
+                                         'in lmdb clients.')
+        return self._txn[client_key]
 
     def get(self, filepath, client_key):
         """Get values according to the filepath from one lmdb named client_key.
@@ -141,13 +172,81 @@ class LmdbBackend(BaseStorageBackend):
             filepath (str | obj:`Path`): Here, filepath is the lmdb key.
             client_key (str): Used for distinguishing differnet lmdb envs.
         """
-        filepath = str(filepath)
-        assert client_key in self._client, (f'client_key {client_key} is not '
-                                            'in lmdb clients.')
-        client = self._client[client_key]
-        with client.begin(write=False) as txn:
-            value_buf = txn.get(filepath.encode('ascii'))
-        return value_buf
+        value_buf = self._get_txn(client_key).get(str(filepath).encode('ascii'))
+        return None if value_buf is None else bytes(value_buf)
+
+    def get_many(self, filepaths, client_keys):
+        """Get several values at once, without copying them.
+
+        Args:
+            filepaths (list[str | obj:`Path`]): The lmdb keys.
+            client_keys (str | list[str]): The lmdb env of all keys, or of
+                each key, e.g. ['gt', 'lq'] for a pair.
+
+        Returns:
+            list[memoryview]: Values as read-only views into the lmdb map,
+                e.g. for :func:`imfrombytes`. They stay valid until the
+                backend is reopened in another process.
+        """
+        if isinstance(client_keys, str):
+            client_keys = [client_keys] * len(filepaths)
+        return [
+            self._get_txn(client_key).get(str(filepath).encode('ascii'))
+            for filepath, client_key in zip(filepaths, client_keys)
+        ]
+
+    def get_text(self, filepath):
+        raise NotImplementedError
+
+
+class MmapBackend(BaseStorageBackend):
+    """Memory-mapped store of decoded images.
+
+    Stores are made with :func:`basicsr.utils.mmap_util.make_mmap_from_imgs`.
+    Unlike the other backends, ``get()`` returns the decoded uint8 image
+    (HWC, BGR) as a read-only view into the mapping, not encoded bytes, so
+    crops of it are zero-copy.
+
+    Args:
+        db_paths (str | list[str]): Store paths.
+        client_keys (str | list[str]): Store client keys. Default: 'default'.
+    """
+
+    def __init__(self, db_paths, client_keys='default', **kwargs):
+        from basicsr.utils.mmap_util import read_mmap_meta_info
+
+        if isinstance(client_keys, str):
+            client_keys = [client_keys]
+        if isinstance(db_paths, str):
+            db_paths = [db_paths]
+        self.db_paths = [str(v) for v in db_paths]
+        assert len(client_keys) == len(self.db_paths), (
+            'client_keys and db_paths should have the same length, '
+            f'but received {len(client_keys)} and {len(self.db_paths)}.')
+
+        self._data = {}
+        self._index = {}
+        for client, path in zip(client_keys, self.db_paths):
+            # read-only file mappings, shared by forked dataloader workers
+            self._data[client] = np.memmap(
+                osp.join(path, 'data.bin'), dtype=np.uint8, mode='r')
+            self._index[client] = read_mmap_meta_info(path)
+
+    def get(self, filepath, client_key):
+        """Get an image according to the filepath from one store.
+
+        Args:
+            filepath (str | obj:`Path`): Here, filepath is the image key.
+            client_key (str): Used for distinguishing differnet stores.
+
+        Returns:
+            ndarray: uint8 image view with shape (h, w, c).
+        """
+        assert client_key in self._data, (f'client_key {client_key} is not '
+                                          'in mmap clients.')
+        offset, shape = self._index[client_key][str(filepath)]
+        size = shape[0] * shape[1] * shape[2]
+        return self._data[client_key][offset:offset + size].reshape(shape)
 
     def get_text(self, filepath):
         raise NotImplementedError
@@ -162,7 +261,7 @@ class FileClient(object):
 
     Attributes:
         backend (str): The storage backend type. Options are "disk",
-            "memcached" and "lmdb".
+            "memcached", "lmdb" and "mmap".
         client (:obj:`BaseStorageBackend`): The backend object.
     """
 
@@ -170,6 +269,7 @@ class FileClient(object):
         'disk': HardDiskBackend,
         'memcached': MemcachedBackend,
         'lmdb': LmdbBackend,
+        'mmap': MmapBackend,
     }
 
     def __init__(self, backend='disk', **kwargs):
@@ -181,12 +281,23 @@ class FileClient(object):
         self.client = self._backends[backend](**kwargs)
 
     def get(self, filepath, client_key='default'):
-        # client_key is used only for lmdb, where different fileclients have
-        # different lmdb environments.
-        if self.backend == 'lmdb':
+        # client_key is used only for lmdb and mmap, where different
+        # fileclients have different lmdb environments or stores.
+        if self.backend in ('lmdb', 'mmap'):
             return self.client.get(filepath, client_key)
         else:
             return self.client.get(filepath)
 
+    def get_many(self, filepaths, client_keys='default'):
+        """Get several files at once, see :meth:`LmdbBackend.get_many`."""
+        if hasattr(self.client, 'get_many'):
+            return self.client.get_many(filepaths, client_keys)
+        if isinstance(client_keys, str):
+            client_keys = [client_keys] * len(filepaths)
+        return [
+            self.get(filepath, client_key)
+            for filepath, client_key in zip(filepaths, client_keys)
+        ]
+
     def get_text(self, filepath):
         return self.client.get_text(filepath)
@@ -1,9 +1,15 @@
+from functools import lru_cache
+
 import numpy as np
 import torch
 
 
 class Masker():
-    """Object for masking and demasking"""
+    """Object for masking and demasking
+
+    The grid masks are built once per (shape, width, device, dtype) and
+    kept in a small LRU cache shared by all maskers.
+    """
 
     def __init__(self, width=3, mode='zero', infer_single_pass=False, include_mask_as_input=False):
         self.grid_size = width
@@ -13,63 +19,106 @@ class Masker():
         self.infer_single_pass = infer_single_pass
         self.include_mask_as_input = include_mask_as_input
 
-    def mask(self, X, i):
-
-        phasex = i % self.grid_size
-        phasey = (i // self.grid_size) % self.grid_size
-        mask = pixel_grid_mask(X[0, 0].shape, self.grid_size, phasex, phasey)
-        mask = mask.to(X.device)
+    def grid_masks(self, X):
+        """All masks of the grid for images like X, in phase order.
 
-        mask_inv = torch.ones(mask.shape).to(X.device) - mask
+        Returns:
+            tuple[Tensor]: Masks and inverse masks, each with shape
+                (n_masks, h, w).
+        """
+        return _grid_masks(tuple(X.shape[-2:]), self.grid_size, X.device,
+                           X.dtype)
 
+    def apply(self, X, mask, mask_inv):
+        """Mask X (b, c, h, w) with masks broadcastable to it."""
         if self.mode == 'interpolate':
             masked = interpolate_mask(X, mask, mask_inv)
         elif self.mode == 'zero':
             masked = X * mask_inv
         else:
             raise NotImplementedError
-            
+
         if self.include_mask_as_input:
-            net_input = torch.cat((masked, mask.repeat(X.shape[0], 1, 1, 1)), dim=1)
-        else:
-            net_input = masked
+            mask = mask.expand(X.shape[0], 1, *X.shape[-2:])
+            return torch.cat((masked, mask), dim=1)
+        return masked
 
-        return net_input, mask
+    def mask(self, X, i):
+        masks, masks_inv = self.grid_masks(X)
+        mask, mask_inv = masks[i % self.n_masks], masks_inv[i % self.n_masks]
+        return self.apply(X, mask, mask_inv), mask
 
     def __len__(self):
         return self.n_masks
 
-    def infer_full_image(self, X, model):
+    def infer_full_image(self, X, model, batched=False, max_minibatch=None):
+        """Blind-spot inference: every pixel is predicted from a copy of X in
+        which it was masked.
+
+        Args:
+            X (Tensor): Input with shape (b, c, h, w).
+            model (callable): Network.
+            batched (bool): Run the masked copies of X as batches instead of
+                one forward per mask. Default: False.
+            max_minibatch (int | None): With batched, number of masked
+                copies per forward, all of them if None. Default: None.
+
+        Returns:
+            Tensor: Output on the device of X.
+        """
 
         if self.infer_single_pass:
             if self.include_mask_as_input:
-                net_input = torch.cat((X, torch.zeros(X[:, 0:1].shape).to(X.device)), dim=1)
+                net_input = torch.cat((X, torch.zeros_like(X[:, 0:1])), dim=1)
             else:
                 net_input = X
             net_output = model(net_input)
             return net_output
 
-        else:
-            net_input, mask = self.mask(X, 0)
-            net_output = model(net_input)
-
-            acc_tensor = torch.zeros(net_output.shape).cpu()
-
+        masks, masks_inv = self.grid_masks(X)
+        acc_tensor = 0
+        if not batched:
             for i in range(self.n_masks):
                 net_input, mask = self.mask(X, i)
                 net_output = model(net_input)
-                acc_tensor = acc_tensor + (net_output * mask).cpu()
-
+                acc_tensor = acc_tensor + net_output * mask
             return acc_tensor
 
+        b, c, h, w = X.shape
+        step = max_minibatch or self.n_masks
+        for i in range(0, self.n_masks, step):
+            # (m, 1, 1, h, w) masks against (b, c, h, w) images, mask-major
+            mask = masks[i:i + step, None, None]
+            mask_inv = masks_inv[i:i + step, None, None]
+            m = len(mask)
+
+            def flat(t, channels):
+                return t.expand(m, b, channels, h, w).reshape(m * b, channels, h, w)
+
+            net_input = self.apply(flat(X.unsqueeze(0), c), flat(mask, 1),
+                                   flat(mask_inv, 1))
+            net_output = model(net_input)
+            net_output = net_output.reshape(m, b, *net_output.shape[1:])
+            acc_tensor = acc_tensor + (net_output * mask).sum(dim=0)
+        return acc_tensor
+
+
+# each entry holds 2 * width ** 2 full resolution masks, only keep the
+# shapes in use
+@lru_cache(maxsize=4)
+def _grid_masks(shape, grid_size, device, dtype):
+    masks = torch.stack([
+        pixel_grid_mask(shape, grid_size, i % grid_size,
+                        (i // grid_size) % grid_size, device=device,
+                        dtype=dtype)
+        for i in range(grid_size ** 2)])
+    return masks, 1 - masks
 
-def pixel_grid_mask(shape, patch_size, phase_x, phase_y):
-    A = torch.zeros(shape[-2:])
-    for i in range(shape[-2]):
-        for j in range(shape[-1]):
-            if (i % patch_size == phase_x and j % patch_size == phase_y):
-                A[i, j] = 1
-    return torch.Tensor(A)
+
+def pixel_grid_mask(shape, patch_size, phase_x, phase_y, device=None, dtype=None):
+    A = torch.zeros(tuple(shape[-2:]), device=device, dtype=dtype)
+    A[phase_x::patch_size, phase_y::patch_size] = 1
+    return A
 
 
 def interpolate_mask(tensor, mask, mask_inv):
@@ -79,9 +128,44 @@ def interpolate_mask(tensor, mask, mask_inv):
 
     kernel = np.array([[0.5, 1.0, 0.5], [1.0, 0.0, 1.0], (0.5, 1.0, 0.5)])
     kernel = kernel[np.newaxis, np.newaxis, :, :]
-    kernel = torch.Tensor(kernel).to(device)
+    kernel = torch.tensor(kernel, device=device, dtype=tensor.dtype)
     kernel = kernel / kernel.sum()
 
-    filtered_tensor = torch.nn.functional.conv2d(tensor, kernel, stride=1, padding=1)
-
-    return filtered_tensor * mask + tensor * mask_inv
\ No newline at end of file
+    # one kernel per channel
+    channels = tensor.shape[1]
+    kernel = kernel.expand(channels, 1, 3, 3)
+    filtered_tensor = torch.nn.functional.conv2d(tensor, kernel, stride=1, padding=1, groups=channels)
+
+    return filtered_tensor * mask + tensor * mask_inv
+
+
+if __name__ == '__main__':
+    import time
+
+    def pixel_grid_mask_loop(shape, patch_size, phase_x, phase_y):
+        A = torch.zeros(shape[-2:])
+        for i in range(shape[-2]):
+            for j in range(shape[-1]):
+                if (i % patch_size == phase_x and j % patch_size == phase_y):
+                    A[i, j] = 1
+        return A
+
+    shape = (512, 512)
+    start = time.time()
+    ref = pixel_grid_mask_loop(shape, 3, 1, 2)
+    print(f'loop mask 512x512: {time.time() - start:.3f} s')
+    start = time.time()
+    out = pixel_grid_mask(shape, 3, 1, 2)
+    print(f'strided mask 512x512: {time.time() - start:.5f} s')
+    assert torch.equal(ref, out)
+
+    net = torch.nn.Conv2d(3, 3, 3, padding=1)
+    x = torch.rand(2, 3, 64, 64)
+    for mode in ['zero', 'interpolate']:
+        masker = Masker(width=3, mode=mode)
+        with torch.no_grad():
+            seq = masker.infer_full_image(x, net)
+            for m in [None, 4]:
+                bat = masker.infer_full_image(x, net, batched=True,
+                                              max_minibatch=m)
+                print(mode, m, (seq - bat).abs().max().item())
@@ -0,0 +1,283 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2022 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+import cv2
+import numpy as np
+import os
+import sys
+import zlib
+from multiprocessing import Pool
+from os import path as osp
+from PIL import Image
+from tqdm import tqdm
+
+
+def make_mmap_from_imgs(data_path, mmap_path, img_path_list, keys,
+                        n_thread=40):
+    """Make a memory-mapped store of decoded images.
+
+    Contents of the store. The file structure is:
+    example.mmap
+    ├── data.bin
+    ├── meta_info.txt
+
+    data.bin holds the decoded uint8 images (HWC, BGR as read by cv2) one
+    after the other. Each line in meta_info.txt records 1)image key,
+    2)image shape and 3)byte offset in data.bin, separated by a white space,
+    e.g. `0001_s001 (512,512,3) 786432`.
+
+    Images are read and decoded with a process pool and written in order.
+
+    Args:
+        data_path (str): Data path for reading images.
+        mmap_path (str): Store save path, must end with '.mmap'.
+        img_path_list (str): Image path list.
+        keys (str): Image keys, the same for corresponding lq and gt images.
+        n_thread (int): Number of decoding processes. Default: 40.
+    """
+    assert len(img_path_list) == len(keys), (
+        'img_path_list and keys should have the same length, '
+        f'but got {len(img_path_list)} and {len(keys)}')
+    print(f'Create mmap store for {data_path}, save to {mmap_path}...')
+    print(f'Total images: {len(img_path_list)}')
+    maker = MmapMaker(mmap_path)
+
+    pbar = tqdm(total=len(img_path_list), unit='image')
+    with Pool(n_thread) as pool:
+        paths = [osp.join(data_path, path) for path in img_path_list]
+        for key, img in zip(keys, pool.imap(read_img_worker, paths,
+                                            chunksize=16)):
+            pbar.update(1)
+            pbar.set_description(f'Write {key}')
+            maker.put(img, key)
+    pbar.close()
+    maker.close()
+    print('\nFinish writing mmap store.')
+
+
+def read_img_worker(path):
+    """Read and decode one image as uint8 HWC BGR, like imfrombytes."""
+    return np.ascontiguousarray(cv2.imread(path, cv2.IMREAD_COLOR))
+
+
+def read_mmap_meta_info(mmap_path):
+    """Read the index of a store made by :func:`make_mmap_from_imgs`.
+
+    Returns:
+        dict: Image key to (byte offset, shape).
+    """
+    index = {}
+    with open(osp.join(mmap_path, 'meta_info.txt')) as fin:
+        for line in fin:
+            # packed stores add a crc32 column, see pack_mmap_store
+            key, shape, offset = line.split()[:3]
+            shape = tuple(int(v) for v in shape.strip('()').split(','))
+            index[key] = (int(offset), shape)
+    return index
+
+
+def load_mmap_images(mmap_path):
+    """Map all images of a store, in the order of its meta_info.txt.
+
+    The file is mapped read-only, so all processes opening the same store,
+    e.g. dataloader workers, share one copy in the page cache.
+
+    Returns:
+        list[ndarray]: uint8 image views with shape (h, w, c).
+    """
+    data = np.memmap(osp.join(mmap_path, 'data.bin'), dtype=np.uint8,
+                     mode='r')
+    imgs = []
+    for offset, shape in read_mmap_meta_info(mmap_path).values():
+        size = shape[0] * shape[1] * shape[2]
+        imgs.append(data[offset:offset + size].reshape(shape))
+    return imgs
+
+
+class MmapMaker():
+    """Memory-mapped store maker, see :func:`make_mmap_from_imgs`.
+
+    Args:
+        mmap_path (str): Store save path, must end with '.mmap'.
+    """
+
+    def __init__(self, mmap_path):
+        if not mmap_path.endswith('.mmap'):
+            raise ValueError("mmap_path must end with '.mmap'.")
+        if osp.exists(mmap_path):
+            print(f'Folder {mmap_path} already exists. Exit.')
+            sys.exit(1)
+        os.makedirs(mmap_path)
+
+        self.mmap_path = mmap_path
+        self.data_file = open(osp.join(mmap_path, 'data.bin'), 'wb')
+        self.txt_file = open(osp.join(mmap_path, 'meta_info.txt'), 'w')
+        self.offset = 0
+
+    def put(self, img, key):
+        """Append a uint8 HWC image."""
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        h, w, c = img.shape
+        self.data_file.write(img.tobytes())
+        self.txt_file.write(f'{key} ({h},{w},{c}) {self.offset}\n')
+        self.offset += img.nbytes
+
+    def close(self):
+        self.data_file.close()
+        self.txt_file.close()
+
+
+def read_group_shape(paths):
+    """Shape of the images of a group stacked along the channels, read from
+    the file headers only."""
+    h, w, c = None, None, 0
+    for path in paths:
+        with Image.open(path) as img:
+            size = img.size
+        assert h is None or (w, h) == size, f'{paths} differ in size.'
+        w, h = size
+        c += 3
+    return h, w, c
+
+
+_pack_data = {}
+
+
+def pack_worker(args):
+    """Decode a group of images and write them, stacked along the channels,
+    at their offset of the store. Returns the entry index and the crc32 of
+    the written bytes."""
+    idx, data_path, offset, shape, paths = args
+    if data_path not in _pack_data:
+        _pack_data[data_path] = np.memmap(data_path, dtype=np.uint8, mode='r+')
+    img = np.concatenate([read_img_worker(path) for path in paths], axis=-1)
+    assert img.shape == tuple(shape), f'{paths}: {img.shape} != {shape}'
+    _pack_data[data_path][offset:offset + img.size] = img.reshape(-1)
+    return idx, zlib.crc32(img)
+
+
+def pack_mmap_store(mmap_path, keys, path_groups, n_thread=None):
+    """Pack images into a memory-mapped store with a process pool.
+
+    The store has the layout of :func:`make_mmap_from_imgs`. The images of
+    each group are stacked along the channels, e.g. the left and right
+    views of a stereo pair. Shapes are read from the file headers to lay
+    out and preallocate data.bin; the workers then decode the images and
+    write them straight into the mapping, in whatever order they finish.
+
+    The crc32 of each finished entry is appended to progress.txt, so an
+    interrupted run resumes with the remaining entries when called again
+    with the same arguments. Once all entries are written, the checksums
+    become the last column of meta_info.txt, see
+    :func:`verify_mmap_store`.
+
+    Args:
+        mmap_path (str): Store save path, must end with '.mmap'.
+        keys (list[str]): Entry keys.
+        path_groups (list[list[str]]): Image paths of each entry.
+        n_thread (int | None): Number of processes, all cores if None.
+            Default: None.
+    """
+    assert len(keys) == len(path_groups), (
+        'keys and path_groups should have the same length, '
+        f'but got {len(keys)} and {len(path_groups)}')
+    if not mmap_path.endswith('.mmap'):
+        raise ValueError("mmap_path must end with '.mmap'.")
+    data_path = osp.join(mmap_path, 'data.bin')
+    meta_path = osp.join(mmap_path, 'meta_info.txt')
+    progress_path = osp.join(mmap_path, 'progress.txt')
+
+    with Pool(n_thread) as pool:
+        shapes = pool.map(read_group_shape, path_groups, chunksize=16)
+        offsets = np.cumsum([0] + [h * w * c for h, w, c in shapes])
+        plan = [f'{key} ({h},{w},{c}) {offset}'
+                for key, (h, w, c), offset in zip(keys, shapes, offsets)]
+
+        if osp.exists(mmap_path):
+            if not osp.exists(progress_path):
+                print(f'Folder {mmap_path} already exists. Exit.')
+                sys.exit(1)
+            with open(meta_path) as fin:
+                if fin.read().splitlines() != plan:
+                    raise ValueError(
+                        f'{mmap_path} was packed from other images, remove '
+                        'it to start over.')
+            done = read_progress(progress_path, keys)
+            print(f'Resume {mmap_path}: {len(done)}/{len(keys)} done.')
+        else:
+            os.makedirs(mmap_path)
+            with open(meta_path, 'w') as fout:
+                fout.write(''.join(f'{line}\n' for line in plan))
+            # preallocate, sparse until written
+            with open(data_path, 'wb') as fout:
+                fout.truncate(int(offsets[-1]))
+            open(progress_path, 'w').close()
+            done = {}
+
+        todo = [i for i, key in enumerate(keys) if key not in done]
+        tasks = [(i, data_path, int(offsets[i]), shapes[i], path_groups[i])
+                 for i in todo]
+        pbar = tqdm(total=len(keys), initial=len(done), unit='image')
+        with open(progress_path, 'a') as progress:
+            for i, crc in pool.imap_unordered(pack_worker, tasks):
+                done[keys[i]] = str(crc)
+                progress.write(f'{keys[i]} {crc}\n')
+                progress.flush()
+                pbar.update(1)
+        pbar.close()
+
+    with open(meta_path, 'w') as fout:
+        fout.write(''.join(f'{line} {done[key]}\n'
+                           for key, line in zip(keys, plan)))
+    os.remove(progress_path)
+    print('\nFinish packing mmap store.')
+
+
+def read_progress(progress_path, keys):
+    """Checksums of the entries already packed, from progress.txt.
+
+    An interrupted run may leave a truncated last line: lines without their
+    newline, with other than two fields, an unknown key or a crc that is not
+    an integer are dropped, so that their entries are packed again. The
+    file is rewritten with the valid lines only, ready to be appended to.
+
+    Returns:
+        dict[str, str]: crc32 of each packed key.
+    """
+    keys = set(keys)
+    done = {}
+    with open(progress_path) as fin:
+        for line in fin:
+            if not line.endswith('\n'):
+                continue
+            fields = line[:-1].rsplit(' ', 1)
+            if len(fields) != 2 or fields[0] not in keys:
+                continue
+            key, crc = fields
+            try:
+                int(crc)
+            except ValueError:
+                continue
+            done[key] = crc
+    with open(progress_path, 'w') as fout:
+        fout.write(''.join(f'{key} {crc}\n' for key, crc in done.items()))
+    return done
+
+
+def verify_mmap_store(mmap_path):
+    """Check the crc32 column written by :func:`pack_mmap_store`.
+
+    Returns:
+        list[str]: Keys of the corrupted entries.
+    """
+    data = np.memmap(osp.join(mmap_path, 'data.bin'), dtype=np.uint8,
+                     mode='r')
+    corrupted = []
+    with open(osp.join(mmap_path, 'meta_info.txt')) as fin:
+        for line in fin:
+            key, shape, offset, crc = line.rstrip('\n').rsplit(' ', 3)
+            h, w, c = (int(v) for v in shape.strip('()').split(','))
+            offset = int(offset)
+            if zlib.crc32(data[offset:offset + h * w * c]) != int(crc):
+                corrupted.append(key)
+    return corrupted
@@ -0,0 +1,123 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2022 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+import torch
+
+
+def per_sample_standardize(x, eps=1e-8):
+    """Zero mean and unit std over all but the batch dimension."""
+    dims = tuple(range(1, x.dim()))
+    mean = x.mean(dim=dims, keepdim=True)
+    std = x.std(dim=dims, keepdim=True)
+    return (x - mean) / (std + eps)
+
+
+class SyntheticNoise():
+    """Base class of the noise synthesizers.
+
+    Noise is generated on the device and in the dtype of the clean batch,
+    with one noise level per sample drawn uniformly from ``sigma_range``.
+
+    Args:
+        sigma_range (tuple[float]): Range of the noise std, in [0, 255]
+            units. Default: (0, 55).
+    """
+
+    def __init__(self, sigma_range=(0, 55)):
+        if not isinstance(sigma_range, (list, tuple)):
+            sigma_range = (sigma_range, sigma_range)
+        self.sigma_range = tuple(sigma_range)
+
+    def sample_sigma(self, img):
+        """Per-sample std with shape (b, 1, 1, 1), in [0, 1] units."""
+        low, high = self.sigma_range
+        sigma = torch.rand(img.size(0), device=img.device, dtype=img.dtype)
+        sigma = (low + sigma * (high - low)) / 255.
+        return sigma.view(-1, *([1] * (img.dim() - 1)))
+
+    def noise(self, img):
+        raise NotImplementedError
+
+    def __call__(self, img):
+        """Add noise to a clean batch (b, c, h, w) in [0, 1] and clip."""
+        return torch.clamp(img + self.noise(img), 0, 1)
+
+
+class GaussianNoise(SyntheticNoise):
+    """Additive white Gaussian noise."""
+
+    def noise(self, img):
+        return torch.randn_like(img) * self.sample_sigma(img)
+
+
+class PoissonNoise(SyntheticNoise):
+    """Signal-independent Poisson noise.
+
+    Unit-rate Poisson samples, standardized per sample and scaled to the
+    noise level of the sample.
+
+    Args:
+        sigma_range (tuple[float]): See :class:`SyntheticNoise`.
+        lam (float): Rate of the Poisson samples. Default: 1.
+    """
+
+    def __init__(self, sigma_range=(0, 55), lam=1.):
+        super(PoissonNoise, self).__init__(sigma_range)
+        self.lam = lam
+
+    def noise(self, img):
+        noise = torch.poisson(torch.full_like(img, self.lam))
+        return per_sample_standardize(noise) * self.sample_sigma(img)
+
+
+class PoissonGaussianNoise(SyntheticNoise):
+    """Signal-dependent Poisson shot noise plus Gaussian read noise.
+
+    ``poisson(img * peak) / peak - img + n`` with ``n`` Gaussian with std
+    drawn from ``sigma_range``, and one ``peak`` per sample drawn
+    log-uniformly from ``peak_range``; lower peaks give stronger shot noise.
+
+    Args:
+        sigma_range (tuple[float]): Range of the read noise std, see
+            :class:`SyntheticNoise`. Default: (0, 25).
+        peak_range (tuple[float]): Range of the photon count of a white
+            pixel. Default: (10, 1000).
+    """
+
+    def __init__(self, sigma_range=(0, 25), peak_range=(10, 1000)):
+        super(PoissonGaussianNoise, self).__init__(sigma_range)
+        self.peak_range = tuple(peak_range)
+
+    def noise(self, img):
+        low, high = torch.tensor(self.peak_range, dtype=torch.float32).log()
+        peak = torch.rand(img.size(0), device=img.device)
+        peak = (low + peak * (high - low)).exp()
+        peak = peak.view(-1, *([1] * (img.dim() - 1)))
+        # sample in float32, poisson is not implemented for half
+        clean = img.float().clamp(0, 1)
+        shot = torch.poisson(clean * peak) / peak - clean
+        return shot.to(img.dtype) + torch.randn_like(img) * self.sample_sigma(img)
+
+
+NOISE_TYPES = {
+    'gaussian': GaussianNoise,
+    'poisson': PoissonNoise,
+    'poisson_gaussian': PoissonGaussianNoise,
+}
+
+
+def build_noise(noise_type, **kwargs):
+    """Create a noise synthesizer.
+
+    Args:
+        noise_type (str): One of 'gaussian', 'poisson' and
+            'poisson_gaussian'.
+        kwargs: Arguments of the synthesizer, e.g. sigma_range.
+
+    Returns:
+        SyntheticNoise: Maps a clean batch to a noisy one.
+    """
+    if noise_type not in NOISE_TYPES:
+        raise ValueError(f'Unsupported synthetic noise {noise_type}. '
+                         f'Supported ones are: {list(NOISE_TYPES)}.')
+    return NOISE_TYPES[noise_type](**kwargs)
@@ -0,0 +1,208 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2022 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+import csv
+import itertools
+import os
+
+import numpy as np
+import torch
+
+from advertorch.context import ctx_input_grad_only
+from basicsr.metrics.psnr_ssim import calculate_psnr_pt
+
+
+def per_sample_mse(output, target):
+    """Loss maximized by :func:`pgd_sweep`, one value per sample."""
+    return ((output - target)**2).flatten(1).mean(dim=1)
+
+
+def _project(x_adv, x, eps, norm):
+    """Project x_adv on the eps-ball around x, eps of shape (n, 1, 1, 1)."""
+    delta = x_adv - x
+    if norm == 'inf':
+        delta = torch.max(torch.min(delta, eps), -eps)
+    else:
+        l2 = delta.flatten(1).norm(dim=1).view_as(eps).clamp(min=1e-12)
+        delta = delta * torch.clamp(eps / l2, max=1.)
+    return torch.clamp(x + delta, 0, 1)
+
+
+def _rand_init(x, eps, norm):
+    """Uniform start in the Linf ball, or uniform direction and radius in
+    the L2 ball."""
+    if norm == 'inf':
+        delta = (torch.rand_like(x) * 2 - 1) * eps
+    else:
+        delta = torch.randn_like(x)
+        delta = delta / delta.flatten(1).norm(dim=1).view_as(eps).clamp(
+            min=1e-12)
+        delta = delta * eps * torch.rand_like(eps)
+    return torch.clamp(x + delta, 0, 1)
+
+
+def _forward(net, x):
+    output = net(x)
+    if isinstance(output, list):
+        output = output[-1]
+    return output
+
+
+def pgd_sweep(net, x, y, epsilons, step_sizes=None, nb_iter=1, restarts=1,
+              norm='inf', rand_init=False, loss_fn=per_sample_mse,
+              max_minibatch=None, quantize=True, return_adv=False):
+    """PGD attacks of a grid of epsilons, step sizes and random restarts,
+    stacked along the batch dimension.
+
+    Every image of ``x`` is repeated once per (epsilon, step size, restart)
+    configuration. The copies are attacked together, ``max_minibatch`` at a
+    time, each one with its own budget and step size. Per configuration,
+    the restart that yields the lowest PSNR of ``net`` against ``y`` is
+    kept.
+
+    Args:
+        net (nn.Module): Restoration network in eval mode, attacked with
+            input gradients only, see ctx_input_grad_only.
+        x (Tensor): Inputs with shape (b, c, h, w), range [0, 1].
+        y (Tensor): Targets with shape (b, c', h', w'), range [0, 1].
+        epsilons (list[float]): Attack budgets, Linf or L2 norm in [0, 1]
+            units. 0 gives the clean result.
+        step_sizes (list[float] | None): Step sizes, 2.5 * eps / nb_iter if
+            None. Default: None.
+        nb_iter (int): Number of PGD iterations. Default: 1.
+        restarts (int): Number of random restarts, which implies
+            rand_init when above 1. Default: 1.
+        norm (str): 'inf' or '2'. Default: 'inf'.
+        rand_init (bool): Start from a random point of the ball.
+            Default: False.
+        loss_fn (callable): Maps (output, target) to one loss per sample,
+            maximized by the attack. Default: :func:`per_sample_mse`.
+        max_minibatch (int | None): Number of attacked copies per forward,
+            all at once if None. Default: None.
+        quantize (bool): PSNR on uint8 levels, see calculate_psnr_pt.
+            Default: True.
+        return_adv (bool): Also return the kept adversarial inputs.
+            Default: False.
+
+    Returns:
+        Tensor: PSNR with shape (len(epsilons), len(step_sizes), b), with
+            a single step size if step_sizes is None.
+        Tensor: With return_adv, the adversarial inputs with shape
+            (len(epsilons), len(step_sizes), b, c, h, w).
+    """
+    norm = str(norm)
+    if norm not in ('inf', '2'):
+        raise ValueError(f"Unsupported norm {norm}, use 'inf' or '2'.")
+    rand_init = rand_init or restarts > 1
+    n_step = 1 if step_sizes is None else len(step_sizes)
+    b = x.size(0)
+
+    # (eps, step, restart, image) order along the batch
+    configs = list(itertools.product(range(len(epsilons)), range(n_step),
+                                     range(restarts), range(b)))
+    eps = torch.tensor([epsilons[e] for e, _, _, _ in configs],
+                       dtype=x.dtype, device=x.device)
+    if step_sizes is None:
+        alpha = eps * 2.5 / nb_iter
+    else:
+        alpha = torch.tensor([step_sizes[s] for _, s, _, _ in configs],
+                             dtype=x.dtype, device=x.device)
+    index = torch.tensor([i for _, _, _, i in configs], device=x.device)
+
+    n = len(configs)
+    m = max_minibatch or n
+    psnrs, advs = [], []
+    with ctx_input_grad_only(net) as predict:
+        for i in range(0, n, m):
+            x0, y0 = x[index[i:i + m]], y[index[i:i + m]]
+            e = eps[i:i + m].view(-1, 1, 1, 1)
+            a = alpha[i:i + m].view(-1, 1, 1, 1)
+            x_adv = _rand_init(x0, e, norm) if rand_init else x0.clone()
+            for _ in range(nb_iter):
+                x_adv.requires_grad_(True)
+                # the copies are independent, the gradient of the sum is the
+                # gradient of each loss
+                loss = loss_fn(_forward(predict, x_adv), y0).sum()
+                grad, = torch.autograd.grad(loss, x_adv)
+                with torch.no_grad():
+                    if norm == 'inf':
+                        step = grad.sign()
+                    else:
+                        step = grad / grad.flatten(1).norm(dim=1).clamp(
+                            min=1e-12).view(-1, 1, 1, 1)
+                    x_adv = _project(x_adv + a * step, x0, e, norm)
+            with torch.no_grad():
+                output = _forward(predict, x_adv)
+                psnrs.append(calculate_psnr_pt(output, y0, 0,
+                                               quantize=quantize))
+            if return_adv:
+                advs.append(x_adv.detach())
+
+    # worst case over the restarts
+    psnr = torch.cat(psnrs).view(len(epsilons), n_step, restarts, b)
+    psnr, best = psnr.min(dim=2)
+    if not return_adv:
+        return psnr
+    adv = torch.cat(advs).view(len(epsilons), n_step, restarts, b,
+                               *x.shape[1:])
+    best = best.view(*best.shape[:2], 1, b, *([1] * (x.dim() - 1)))
+    adv = adv.gather(2, best.expand(-1, -1, 1, -1, *x.shape[1:]))
+    return psnr, adv.squeeze(2)
+
+
+class RobustnessCurve():
+    """Accumulates the sweep results of a dataset into a PSNR-vs-epsilon
+    curve.
+
+    Args:
+        epsilons (list[float]): Attack budgets of the sweep.
+        step_sizes (list[float] | None): Step sizes of the sweep.
+    """
+
+    def __init__(self, epsilons, step_sizes=None):
+        self.epsilons = list(epsilons)
+        self.step_sizes = step_sizes
+        n_step = 1 if step_sizes is None else len(step_sizes)
+        self.psnr_sum = torch.zeros(len(self.epsilons), n_step,
+                                    dtype=torch.float64)
+        self.count = 0
+
+    def update(self, psnr):
+        """Add the (n_eps, n_step, b) PSNR of :func:`pgd_sweep`."""
+        self.psnr_sum = self.psnr_sum + psnr.double().sum(dim=-1).cpu()
+        self.count += psnr.size(-1)
+
+    def per_config(self):
+        """Mean PSNR of each (epsilon, step size), shape (n_eps, n_step)."""
+        return self.psnr_sum / max(self.count, 1)
+
+    def curve(self):
+        """Mean PSNR per epsilon for the strongest step size."""
+        return self.per_config().min(dim=1)[0]
+
+    def save(self, path, title=None):
+        """Write the per-config table to ``path``.csv and the curve to
+        ``path``.png."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        table = self.per_config()
+        steps = self.step_sizes or ['auto']
+        with open(f'{path}.csv', 'w', newline='') as fout:
+            writer = csv.writer(fout)
+            writer.writerow(['epsilon'] + [f'psnr@step={s}' for s in steps] +
+                            ['psnr_worst'])
+            for eps, row, worst in zip(self.epsilons, table, self.curve()):
+                writer.writerow([eps] + [f'{v:.4f}' for v in row.tolist()] +
+                                [f'{worst:.4f}'])
+
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        fig = plt.figure()
+        plt.plot(np.array(self.epsilons) * 255, self.curve().numpy(), 'o-')
+        plt.xlabel('epsilon (/255)')
+        plt.ylabel('PSNR (dB)')
+        if title is not None:
+            plt.title(title)
+        plt.grid(True)
+        fig.savefig(f'{path}.png', bbox_inches='tight')
+        plt.close(fig)
@@ -0,0 +1,160 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2022 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def tile_grid(size, tile, overlap=0):
+    """Regular tiling of one image dimension.
+
+    Uses the fewest tiles of the given size that overlap by at least
+    ``overlap`` pixels, spread evenly like the former grids(). The image is
+    then padded at the end so that the last tile fits the regular stride.
+
+    Args:
+        size (int): Image size.
+        tile (int): Tile size.
+        overlap (int): Minimal overlap of two neighbouring tiles.
+            Default: 0.
+
+    Returns:
+        tuple[int]: Tile size, stride and padding at the end.
+    """
+    tile = min(tile, size)
+    if tile == size:
+        return tile, tile, 0
+    assert overlap < tile, 'tile overlap must be smaller than the tile size'
+
+    num_tiles = math.ceil((size - overlap) / (tile - overlap))
+    stride = math.ceil((size - tile) / (num_tiles - 1))
+    return tile, stride, tile + (num_tiles - 1) * stride - size
+
+
+def blend_window(h, w, blend='hann', device=None, dtype=None):
+    """Blending weights of one output tile.
+
+    Args:
+        h (int): Tile height.
+        w (int): Tile width.
+        blend (str): 'hann' for weights fading towards the tile borders,
+            'mean' for uniform weights. Default: 'hann'.
+
+    Returns:
+        Tensor: Weights with shape (h, w).
+    """
+    if blend == 'mean':
+        return torch.ones(h, w, device=device, dtype=dtype)
+    if blend != 'hann':
+        raise ValueError(f'Unsupported tile blending {blend}.')
+
+    # drop the zero end points, every pixel keeps a positive weight
+    def window(n):
+        return torch.hann_window(
+            n + 2, periodic=False, device=device, dtype=dtype)[1:-1]
+
+    return window(h)[:, None] * window(w)[None, :]
+
+
+@torch.no_grad()
+def tiled_forward(net, img, tile_size, overlap=0, blend='hann',
+                  max_minibatch=None, scale=1):
+    """Run a network on overlapping tiles of an image and blend the outputs.
+
+    The tiles are extracted with ``F.unfold`` and the weighted outputs put
+    back with ``F.fold``, all on the device of ``img``. They go through the
+    network ``max_minibatch`` at a time.
+
+    Args:
+        net (callable): Maps a (n, c, th, tw) batch of tiles to a
+            (n, c_out, th * scale, tw * scale) batch.
+        img (Tensor): Input images with shape (b, c, h, w).
+        tile_size (tuple[int]): Tile height and width in input pixels.
+        overlap (int | tuple[int]): Minimal overlap of neighbouring tiles in
+            input pixels. Default: 0.
+        blend (str): Blending weights, see :func:`blend_window`.
+            Default: 'hann'.
+        max_minibatch (int | None): Number of tiles per network call, all
+            at once if None. Default: None.
+        scale (int): Upsampling factor of the network. Default: 1.
+
+    Returns:
+        Tensor: Blended output with shape (b, c_out, h * scale, w * scale).
+    """
+    b, c, h, w = img.size()
+    if isinstance(overlap, int):
+        overlap = (overlap, overlap)
+    th, sh, ph = tile_grid(h, tile_size[0], overlap[0])
+    tw, sw, pw = tile_grid(w, tile_size[1], overlap[1])
+    if ph or pw:
+        img = F.pad(img, (0, pw, 0, ph), mode='replicate')
+
+    # [b, c*th*tw, L] -> [b*L, c, th, tw]
+    tiles = F.unfold(img, (th, tw), stride=(sh, sw))
+    num_tiles = tiles.size(-1)
+    tiles = tiles.transpose(1, 2).reshape(b * num_tiles, c, th, tw)
+
+    weight = blend_window(th * scale, tw * scale, blend, img.device, img.dtype)
+    n = len(tiles)
+    m = max_minibatch or n
+    outs = []
+    for i in range(0, n, m):
+        outs.append(net(tiles[i:i + m]) * weight)
+    outs = torch.cat(outs, dim=0)
+    del tiles
+
+    out_size = ((h + ph) * scale, (w + pw) * scale)
+    fold_opt = dict(kernel_size=(th * scale, tw * scale),
+                    stride=(sh * scale, sw * scale))
+    outs = outs.reshape(b, num_tiles, -1).transpose(1, 2)
+    out = F.fold(outs, out_size, **fold_opt)
+    weight = weight.reshape(1, -1, 1).expand(1, -1, num_tiles)
+    out = out / F.fold(weight, out_size, **fold_opt)
+    return out[:, :, :h * scale, :w * scale]
+
+
+def stream_tiled_forward(net, src, dst, tile_size, overlap=0, blend='hann',
+                         max_minibatch=None, scale=1, strip_height=None,
+                         device=None):
+    """Tiled inference on an image that is read and written in row strips.
+
+    Each strip of ``strip_height`` output rows is computed from the input
+    rows it covers plus ``overlap`` rows of context on both sides, with
+    :func:`tiled_forward`, and written to ``dst`` right away. Only one
+    strip is ever held as float, so ``src`` and ``dst`` can be memory
+    mapped arrays larger than the available RAM.
+
+    Args:
+        net (callable): See :func:`tiled_forward`.
+        src (ndarray): uint8 input image with shape (h, w, c), RGB order.
+        dst (ndarray): uint8 output image with shape
+            (h * scale, w * scale, c_out), written strip by strip.
+        tile_size (tuple[int]): Tile height and width in input pixels.
+        overlap (int): Minimal overlap of neighbouring tiles and context
+            rows around each strip, in input pixels. Default: 0.
+        blend (str): Blending weights, see :func:`blend_window`.
+            Default: 'hann'.
+        max_minibatch (int | None): Number of tiles per network call.
+            Default: None.
+        scale (int): Upsampling factor of the network. Default: 1.
+        strip_height (int | None): Input rows per strip, the tile height if
+            None. Default: None.
+        device (torch.device | None): Device to run on. Default: None.
+    """
+    h = src.shape[0]
+    strip_height = strip_height or tile_size[0]
+    for y0 in range(0, h, strip_height):
+        y1 = min(y0 + strip_height, h)
+        r0, r1 = max(y0 - overlap, 0), min(y1 + overlap, h)
+
+        strip = torch.from_numpy(np.ascontiguousarray(src[r0:r1]))
+        strip = strip.to(device).permute(2, 0, 1).unsqueeze(0).float() / 255.
+        out = tiled_forward(net, strip, tile_size, overlap, blend,
+                            max_minibatch, scale)
+        out = out[0, :, (y0 - r0) * scale:(y1 - r0) * scale]
+
+        out = (out.clamp(0, 1) * 255.).round().byte()
+        dst[y0 * scale:y1 * scale] = out.permute(1, 2, 0).cpu().numpy()
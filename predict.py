@@ -6,7 +6,7 @@ import matplotlib.pyplot as plt
 from cog import BasePredictor, Path, Input, BaseModel
 
 from basicsr.models import create_model
-from basicsr.utils import img2tensor as _img2tensor, tensor2img, imwrite
+from basicsr.utils import img2tensor as _img2tensor, tensor2img, imwrite, AsyncImageWriter, PNGStripWriter
 from basicsr.utils.options import parse
 
 
@@ -29,6 +29,7 @@ class Predictor(BasePredictor):
             "Image Debluring": create_model(opt_deblur),
             "Stereo Image Super-Resolution": create_model(opt_stereo),
         }
+        self.writer = AsyncImageWriter()
 
     def predict(
         self,
@@ -66,13 +67,17 @@ class Predictor(BasePredictor):
             inp_r = img2tensor(img_r)
             stereo_image_inference(model, inp_l, inp_r, str(out_path))
 
+        elif model.opt["val"].get("stream", False):
+            stream_image_inference(model, str(image), str(out_path))
+
         else:
 
             img_input = imread(str(image))
             inp = img2tensor(img_input)
             out_path = Path(tempfile.mkdtemp()) / "output.png"
-            single_image_inference(model, inp, str(out_path))
+            single_image_inference(model, inp, str(out_path), writer=self.writer)
 
+        self.writer.flush()
         return out_path
 
 
@@ -87,7 +92,9 @@ def img2tensor(img, bgr2rgb=False, float32=True):
     return _img2tensor(img, bgr2rgb=bgr2rgb, float32=float32)
 
 
-def single_image_inference(model, img, save_path):
+def single_image_inference(model, img, save_path, writer=None):
+    """Restore one image; with an AsyncImageWriter the output is written in
+    the background, flush the writer before reading it."""
     model.feed_data(data={"lq": img.unsqueeze(dim=0)})
 
     if model.opt["val"].get("grids", False):
@@ -100,7 +107,67 @@ def single_image_inference(model, img, save_path):
 
     visuals = model.get_current_visuals()
     sr_img = tensor2img([visuals["result"]])
-    imwrite(sr_img, save_path)
+    if writer is not None:
+        writer.write(sr_img, save_path)
+    else:
+        imwrite(sr_img, save_path)
+
+
+def imread_stream(img_path):
+    """Open an RGB uint8 image without decoding it into memory when possible.
+
+    Only .npy files and uncompressed TIFFs are memory mapped and actually
+    streamed; compressed TIFFs, PNGs, JPEGs and other formats are decoded
+    whole into memory.
+    """
+    if img_path.endswith(".npy"):
+        return np.load(img_path, mmap_mode="r")
+    if img_path.endswith((".tif", ".tiff")):
+        try:
+            import tifffile
+        except ImportError:
+            raise ImportError("Please install tifffile to stream TIFF images.")
+        try:
+            return tifffile.memmap(img_path, mode="r")
+        except ValueError:
+            # compressed or tiled layout, cannot be mapped
+            return tifffile.imread(img_path)
+    return imread(img_path)
+
+
+def stream_image_inference(model, img_path, save_path, strip_height=None):
+    """Denoise an image strip by strip, see ImageRestorationModel.stream_test.
+
+    The output is written as the strips come: .npy and .tif outputs are
+    memory mapped and .png outputs are encoded row by row. Memory only stays
+    independent of the image size for inputs that are streamed too, .npy
+    and uncompressed .tif, see imread_stream.
+    """
+    src = imread_stream(img_path)
+    if src.ndim == 2:
+        # grayscale, a (h, w, 1) view
+        src = src[..., None]
+    h, w, c = src.shape
+    shape = (h * model.scale, w * model.scale, c)
+
+    if save_path.endswith(".npy"):
+        dst = np.lib.format.open_memmap(save_path, mode="w+", dtype=np.uint8,
+                                        shape=shape)
+    elif save_path.endswith((".tif", ".tiff")):
+        import tifffile
+        dst = tifffile.memmap(save_path, shape=shape, dtype=np.uint8,
+                              photometric="rgb" if c == 3 else "minisblack")
+    elif save_path.endswith(".png"):
+        with PNGStripWriter(save_path, shape,
+                            model.opt["val"].get("png_compression", 3)) as dst:
+            model.stream_test(src, dst, strip_height=strip_height)
+        return
+    else:
+        raise ValueError(
+            f"Streaming writes .png, .npy or .tif outputs, got {save_path}.")
+
+    model.stream_test(src, dst, strip_height=strip_height)
+    dst.flush()
 
 
 def stereo_image_inference(model, img_l, img_r, out_path):
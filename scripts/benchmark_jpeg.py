@@ -0,0 +1,86 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2022 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+"""Throughput of the JPEG defense.
+
+Compares the former per-image PIL loop with the thread-pool libjpeg path of
+``JPEGEncodingDecoding`` and with the on-device ``jpeg_dct_approximation``,
+and reports how far each one is from the loop.
+
+    python scripts/benchmark_jpeg.py --batch-size 32 --size 256 --quality 75
+"""
+import argparse
+import time
+from io import BytesIO
+
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from advertorch.functional import (JPEGEncodingDecoding,
+                                   jpeg_dct_approximation)
+
+_to_pil_image = transforms.ToPILImage()
+_to_tensor = transforms.ToTensor()
+
+
+def reference_jpeg(x, quality):
+    lst_img = []
+    for img in x:
+        img = _to_pil_image(img.detach().clone().cpu())
+        virtualpath = BytesIO()
+        img.save(virtualpath, 'JPEG', quality=quality)
+        lst_img.append(_to_tensor(Image.open(virtualpath)))
+    return x.new_tensor(torch.stack(lst_img))
+
+
+def timeit(fn, iters, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / iters
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--quality', type=int, default=75)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--iters', type=int, default=5)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # smooth images, closer to photographs than uniform noise
+    x = torch.rand(args.batch_size, 3, args.size // 8, args.size // 8,
+                   device=device)
+    x = torch.nn.functional.interpolate(x, size=(args.size, args.size),
+                                        mode='bilinear', align_corners=False)
+    q = args.quality
+
+    ref = reference_jpeg(x, q)
+    for name, fn in [
+            ('pil loop', lambda: reference_jpeg(x, q)),
+            ('threaded libjpeg',
+             lambda: JPEGEncodingDecoding.apply(x, q, args.workers)),
+            ('dct approximation', lambda: jpeg_dct_approximation(x, q))]:
+        with torch.no_grad():
+            out = fn()
+            sec = timeit(fn, args.iters, device)
+        diff = (out - ref).abs() * 255
+        print(f'{name}: {args.batch_size / sec:.1f} img/s on {device}, '
+              f'diff to pil loop mean {diff.mean().item():.3f} '
+              f'max {diff.max().item():.0f} (/255)')
+
+    xg = x.clone().requires_grad_(True)
+    jpeg_dct_approximation(xg, q).sum().backward()
+    print(f'dct approximation gradient mean {xg.grad.mean().item():.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2022 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+"""Time the L1-ball projection of an ord=1 PGD step.
+
+Compares the former round trip, ``batch_l1_proj_flat`` on the host followed
+by a copy back to the device, with the on-device ``batch_l1_proj`` and its
+sparse variant, on perturbations shaped like image batches.
+
+    python scripts/benchmark_l1_proj.py --batch-size 8 --size 256
+"""
+import argparse
+import time
+
+import torch
+
+from advertorch.utils import (batch_l1_proj, batch_l1_proj_flat,
+                              batch_l1_proj_sparse)
+
+
+def reference_proj(delta, eps):
+    flat = batch_l1_proj_flat(delta.cpu().view(len(delta), -1), z=eps)
+    return flat.view_as(delta).to(delta.device)
+
+
+def timeit(fn, iters, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--eps', type=float, default=100.)
+    parser.add_argument('--sparsity', type=float, default=0.99)
+    parser.add_argument('--iters', type=int, default=20)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    delta = torch.randn(args.batch_size, 3, args.size, args.size,
+                        device=device) * 0.01
+    # one sample inside the ball, left untouched by both
+    delta[0] *= 1e-4
+    k = int(round((1 - args.sparsity) * delta[0].numel()))
+
+    ref = reference_proj(delta, args.eps)
+    out = batch_l1_proj(delta, args.eps)
+    print(f'max abs diff {(ref - out).abs().max().item():.2e}, '
+          f'l1 norms {out.abs().flatten(1).sum(1).tolist()}')
+    sparse = batch_l1_proj_sparse(delta, args.eps, k)
+    print(f'sparse: nonzeros {(sparse != 0).flatten(1).sum(1).tolist()} '
+          f'(k={k})')
+
+    for name, fn in [
+            ('host round trip', lambda: reference_proj(delta, args.eps)),
+            ('on device', lambda: batch_l1_proj(delta, args.eps)),
+            ('sparse on device',
+             lambda: batch_l1_proj_sparse(delta, args.eps, k))]:
+        ms = timeit(fn, args.iters, device)
+        print(f'{name}: {ms:.2f} ms on {device}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2022 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+"""Compare the tensor PSNR/SSIM with the NumPy ones on random images.
+
+Checks that calculate_psnr_pt/calculate_ssim_pt agree with
+calculate_psnr/calculate_ssim on the uint8 images of tensor2img, and times
+both on a batch of SIDD sized patches.
+
+    python scripts/benchmark_metrics.py --batch-size 32 --size 256
+"""
+import argparse
+import time
+
+import torch
+
+from basicsr.metrics import (calculate_psnr, calculate_psnr_pt,
+                             calculate_ssim, calculate_ssim_pt)
+from basicsr.utils import tensor2img
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--size', type=int, default=256)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    gt = torch.rand(args.batch_size, 3, args.size, args.size, device=device)
+    out = (gt + 0.05 * torch.randn_like(gt)).clamp(0, 1)
+
+    for name, fn, fn_pt, kwargs in [
+            ('psnr', calculate_psnr, calculate_psnr_pt, {}),
+            ('psnr_y', calculate_psnr, calculate_psnr_pt,
+             dict(test_y_channel=True)),
+            ('ssim3d', calculate_ssim, calculate_ssim_pt, {}),
+            ('ssim', calculate_ssim, calculate_ssim_pt, dict(ssim3d=False)),
+            ('ssim_y', calculate_ssim, calculate_ssim_pt,
+             dict(test_y_channel=True))]:
+        start = time.time()
+        ref = []
+        for i in range(args.batch_size):
+            ref.append(fn(tensor2img(out[i]), tensor2img(gt[i]), 0,
+                          **kwargs))
+        host = time.time() - start
+
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        res = fn_pt(out, gt, 0, quantize=True, rgb2bgr=True, **kwargs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        dev = time.time() - start
+
+        diff = (res.cpu().double() - torch.tensor(ref).double()).abs().max()
+        print(f'{name}: max abs diff {diff:.2e}, numpy {host * 1000:.1f} ms, '
+              f'tensor {dev * 1000:.1f} ms on {device}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2022 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+"""Time one training step of NAFNet_filter at width 64.
+
+Compares the plain loss with the former
+``loss + 0. * sum(p.sum() for p in net.parameters())``, which was added to
+every loss so that DDP would not complain about unused parameters.
+
+    python scripts/benchmark_train_step.py --batch-size 8 --patch-size 256
+"""
+import argparse
+import time
+
+import torch
+
+from basicsr.models.archs.NAFNet_filter_arch import NAFNet_filter
+
+
+def timeit(fn, iters, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--patch-size', type=int, default=256)
+    parser.add_argument('--iters', type=int, default=20)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    net = NAFNet_filter(width=64, enc_blk_nums=[2, 2, 4, 8],
+                        middle_blk_num=12, dec_blk_nums=[2, 2, 2, 2]).to(device)
+    optimizer = torch.optim.AdamW(net.parameters(), lr=1e-4)
+    lq = torch.rand(args.batch_size, 3, args.patch_size, args.patch_size,
+                    device=device)
+    gt = torch.rand_like(lq)
+
+    def step(param_sum):
+        optimizer.zero_grad()
+        loss = torch.nn.functional.l1_loss(net(lq), gt)
+        if param_sum:
+            loss = loss + 0. * sum(p.sum() for p in net.parameters())
+        loss.backward()
+        optimizer.step()
+
+    print(f'{len(list(net.parameters()))} parameter tensors on {device}')
+    for name, param_sum in [('loss + 0 * sum(p.sum())', True),
+                            ('loss', False)]:
+        ms = timeit(lambda: step(param_sum), args.iters, device)
+        print(f'{name}: {ms:.2f} ms/iter')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# ------------------------------------------------------------------------
+# Copyright (c) 2022 megvii-model. All Rights Reserved.
+# ------------------------------------------------------------------------
+"""Check and time the fused L2 zero-mean PGD step.
+
+Compares ``l2_zero_mean_step_`` with the reference sequence of
+``perturb_iterative`` (normalize, step, clamp, ``zero_mean_projection``,
+``clamp_by_pnorm``) on image-shaped perturbations.
+
+    python scripts/benchmark_zero_mean_pgd.py --batch-size 8 --size 256
+"""
+import argparse
+import time
+
+import torch
+
+from advertorch.attacks4IP.zero_mean_pgd import (l2_zero_mean_step_,
+                                                 zero_mean_projection)
+from advertorch.utils import (batch_multiply, clamp, clamp_by_pnorm,
+                              normalize_by_pnorm)
+
+
+def reference_step(delta, grad, xvar, eps_iter, eps, clip_min, clip_max):
+    grad = normalize_by_pnorm(grad)
+    delta = delta + batch_multiply(eps_iter, grad)
+    delta = clamp(xvar + delta, clip_min, clip_max) - xvar
+    delta = zero_mean_projection(delta)
+    return clamp_by_pnorm(delta, 2, eps)
+
+
+def timeit(fn, iters, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / iters * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--iters', type=int, default=20)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    shape = (args.batch_size, 3, args.size, args.size)
+    xvar = torch.rand(shape, device=device)
+    grad = torch.randn(shape, device=device)
+    delta = torch.randn(shape, device=device) * 0.01
+    # 5/255 per pixel in L2, as in the training attack
+    eps = 5. / 255 * args.size
+    eps_iter = eps / 2
+
+    for name, e, e_iter in [
+            ('float eps', eps, eps_iter),
+            ('per-sample eps',
+             torch.linspace(0.5, 1.5, args.batch_size, device=device) * eps,
+             torch.full((args.batch_size, ), eps_iter, device=device))]:
+        ref = reference_step(delta, grad, xvar, e_iter, e, 0., 1.)
+        out = l2_zero_mean_step_(delta.clone(), grad, xvar, e_iter, e, 0., 1.)
+        print(f'{name}: max abs diff {(ref - out).abs().max().item():.2e}, '
+              f'max |mean| {out.flatten(1).mean(1).abs().max().item():.2e}')
+
+    buf = delta.clone()
+    for name, fn in [
+            ('reference', lambda: reference_step(
+                delta, grad, xvar, eps_iter, eps, 0., 1.)),
+            ('fused', lambda: l2_zero_mean_step_(
+                buf.copy_(delta), grad, xvar, eps_iter, eps, 0., 1.))]:
+        ms = timeit(fn, args.iters, device)
+        print(f'{name}: {ms:.2f} ms/step on {device}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,55 +1,46 @@
-import numpy as np
+"""Pack the NTIRE22 stereo SR training set into memory-mapped stores.
+
+Each entry holds the left and right views of a pair stacked along the
+channels (HWC, BGR-BGR, uint8). Images are decoded by a process pool and
+written straight into the preallocated stores; rerun the same command to
+resume an interrupted run. The stores are read by
+PairedImageSRLRFullImageMemoryDataset, set dataroot_lq/dataroot_gt to
+them.
+
+    python scripts/make_pickle.py --n-thread 64
+"""
+import argparse
 import os
-import cv2
-
-PATH = './datasets/SR/NTIRE22-StereoSR/Train'
-
-LR_FOLDER = 'LR_x4'
-HR_FOLDER = 'HR'
-
-
-lr_lists = []
-hr_lists = []
-
-cnt = 0
-
-for idx in range(1, 801):
-
-    L_name = f'{idx:04}_L.png'
-    R_name = f'{idx:04}_R.png'
-
-
-    LR_L = cv2.imread(os.path.join(PATH, LR_FOLDER, L_name))
-    LR_R = cv2.imread(os.path.join(PATH, LR_FOLDER, R_name))
-
-    HR_L = cv2.imread(os.path.join(PATH, HR_FOLDER, L_name))
-    HR_R = cv2.imread(os.path.join(PATH, HR_FOLDER, R_name))
-
-    LR = np.concatenate([LR_L, LR_R], axis=-1)
-    HR = np.concatenate([HR_L, HR_R], axis=-1)
-
-    lr_lists.append(LR)
-    hr_lists.append(HR)
-
-    cnt = cnt + 1
-    if cnt % 50 == 0:
-        print(f'cnt .. {cnt}, idx: {idx}')
-
-
-
-import pickle
-with open('./datasets/ntire-stereo-sr.train.lr.pickle', 'wb') as f:
-    pickle.dump(lr_lists, f)
-
-with open('./datasets/ntire-stereo-sr.train.hr.pickle', 'wb') as f:
-    pickle.dump(hr_lists, f)
-
-
-
-# print(f'... {lr_all_np.shape}, {lr_all_np.dtype}')
-# print(f'... {hr_all_np.shape}, {hr_all_np.dtype}')
-
-# np.save('./datasets/ntire-stereo-sr.train.lr.npy', lr_all_np)
-# np.save('./datasets/ntire-stereo-sr.train.hr.npy', hr_all_np)
-
 
+from basicsr.utils.mmap_util import pack_mmap_store, verify_mmap_store
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', default='./datasets/SR/NTIRE22-StereoSR/Train')
+    parser.add_argument('--lr-folder', default='LR_x4')
+    parser.add_argument('--hr-folder', default='HR')
+    parser.add_argument('--num', type=int, default=800)
+    parser.add_argument('--output', default='./datasets/ntire-stereo-sr.train')
+    parser.add_argument('--n-thread', type=int, default=None)
+    parser.add_argument('--verify', action='store_true',
+                        help='check the checksums after packing')
+    args = parser.parse_args()
+
+    keys = [f'{idx:04}' for idx in range(1, args.num + 1)]
+    for folder, suffix in [(args.lr_folder, 'lr'), (args.hr_folder, 'hr')]:
+        path_groups = [[
+            os.path.join(args.path, folder, f'{key}_L.png'),
+            os.path.join(args.path, folder, f'{key}_R.png')
+        ] for key in keys]
+        mmap_path = f'{args.output}.{suffix}.mmap'
+        pack_mmap_store(mmap_path, keys, path_groups, n_thread=args.n_thread)
+
+        if args.verify:
+            corrupted = verify_mmap_store(mmap_path)
+            print(f'{mmap_path}: {len(corrupted)} corrupted entries '
+                  f'{corrupted}')
+
+
+if __name__ == '__main__':
+    main()